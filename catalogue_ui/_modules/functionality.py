@@ -1,13 +1,31 @@
 '''Module for data preparation for display.'''
+import os
+import re
 import math
 import logging
-from collections import OrderedDict
-from datetime import datetime, timedelta
+from flask import g, has_app_context
 from modules.mongo_lib import MongoLib
-from typing import List, Dict, Union
+from typing import List, Dict, Tuple, Union
+import pymongo
+
+# Fields of the tag table columns, in order
+TAG_COLUMNS = ["tag", "dicomID", "public", "promotionStatus", "description",
+               "modalities", "informationEntity", "basicProfile",
+               "completenessRaw", "type", "valueRepresentation",
+               "valueMultiplicity", "retired"]
+# Columns joined from the modality document, not searchable or orderable
+MODALITY_COLUMNS = ["completenessRaw"]
+# Indexed tag columns matched by prefix by the server-side global search
+PREFIX_SEARCH_COLUMNS = ["tag", "dicomID"]
+# Tag document fields read by format_tag_row()
+TAG_ROW_FIELDS = {"_id": 0, "promotionStatusDate": 1, "tagQualityDateRaw": 1, "blockReason": 1,
+                  **{field: 1 for field in TAG_COLUMNS if field not in MODALITY_COLUMNS}}
+# Maximum number of rows of a server-side table page
+MAX_PAGE_LENGTH = 1000
 
 def get_db_connection(log: str) -> MongoLib:
-    '''Creates and returns a connection to MongoDB.
+    '''Returns the MongoDB handle of the current request, created on first
+       use. Handles share the client of the process, see MongoLib.share_client().
 
     Args:
         log (str): Name of log to use.
@@ -15,13 +33,31 @@ def get_db_connection(log: str) -> MongoLib:
     Returns:
         MongoLib: MongoLib object.
     '''
+    if has_app_context() and "conn" in g:
+        return g.conn
+
     logging.getLogger(log)
     conn = MongoLib(log)
-    conn.switch_db("analytics")
+    conn.switch_db(os.environ.get("METACAT_DB", "analytics"))
+
+    if has_app_context():
+        g.conn = conn
 
     return conn
 
 
+def close_db_connection(error: Exception = None) -> None:
+    '''Releases the MongoDB handle of the current request, if any.
+
+    Args:
+        error (Exception, optional): Error that ended the request.
+    '''
+    conn = g.pop("conn", None)
+
+    if conn is not None:
+        conn.disconnect()
+
+
 def merge_lists(list1: List[Dict], list2: List[Dict], type: str) -> List[Dict]:
     '''Merges two metadata lists by modality or tag, as specified by the type.
        The first list is to be the main, largest list. The second list is to be
@@ -35,16 +71,17 @@ def merge_lists(list1: List[Dict], list2: List[Dict], type: str) -> List[Dict]:
     Returns:
         List[Dict]: Merged metadata.
     '''
-    if type == "modality":
-        for mod2 in list2:
-            for mod1 in list1:
-                if mod2["modality"] == mod1["modality"]:
-                    mod1.update(mod2)
-    elif type == "tag":
-        for tag1 in list1:
-            for tag2 in list2:
-                if tag2["tag"] == tag1["tag"]:
-                    tag1.update(tag2)
+    if type not in ("modality", "tag"):
+        return list1
+
+    by_key: Dict[str, List[Dict]] = {}
+
+    for item1 in list1:
+        by_key.setdefault(item1[type], []).append(item1)
+
+    for item2 in list2:
+        for item1 in by_key.get(item2[type], []):
+            item1.update(item2)
 
     return list1
 
@@ -67,171 +104,6 @@ def format_mods(tags: List) -> List:
     return tags
 
 
-def format_counts(modality: Dict) -> Dict:
-    '''Formats a modality's count metadata for plotting.
-
-    Args:
-        modality (Dict): Modality metadata.
-
-    Returns:
-        Dict: Dictionary of lists for plotting.
-    '''
-    plot_format = {
-        "dates": [],
-        "images_raw": [],
-        "series_raw": [],
-        "study_raw": [],
-        "images_staging": [],
-        "series_staging": [],
-        "study_staging": [],
-        "images_live": [],
-        "series_live": [],
-        "study_live": [],
-    }
-
-    for attr in modality:
-        if "countsPerMonth" in attr:
-            modality[attr] = fix_month_counts(modality[attr])
-
-            if "Raw" in attr:
-                for count in modality[attr]:
-                    plot_format["dates"].append(count["date"])
-                    plot_format["images_raw"].append(count["imageCount"])
-                    plot_format["series_raw"].append(count["seriesCount"])
-                    plot_format["study_raw"].append(count["studyCount"])
-
-            if "Staging" in attr:
-                for count in modality[attr]:
-                    plot_format["images_staging"].append(count["imageCount"])
-                    plot_format["series_staging"].append(count["seriesCount"])
-                    plot_format["study_staging"].append(count["studyCount"])
-
-            if "Live" in attr:
-                for count in modality[attr]:
-                    plot_format["images_live"].append(count["imageCount"])
-                    plot_format["series_live"].append(count["seriesCount"])
-                    plot_format["study_live"].append(count["studyCount"])
-        elif any(term in attr for term in ["No", "std"]):
-            modality[attr] = "{:,}".format(float(modality[attr]))
-
-    return plot_format
-
-
-def tag_stats(tags: List[Dict], modality: bool=False) -> Dict:
-    stats = {
-        "public": {
-          "Public": 0,
-          "Private": 0
-        },
-        "confidentiality": {},
-        "promotion": {}
-    }
-
-    if modality:
-        stats["sparseness"] = {
-            "Unknown": 0,
-            "<50%": 0,
-            "50-60%": 0,
-            "60-70%": 0,
-            "70-80%": 0,
-            "80-90%": 0,
-            ">=90%": 0
-        }
-
-    for tag in tags:
-        # Group tags by public status
-        if tag["public"] == "true":
-            stats["public"]["Public"] += 1
-        else:
-            stats["public"]["Private"] += 1
-
-        # Group tags by promotion status
-        if tag["promotionStatus"] in stats["promotion"].keys():
-            stats["promotion"][tag["promotionStatus"]] += 1
-        else:
-            stats["promotion"][tag["promotionStatus"]] = 0 
-
-        # Group tags by confidentiality profile
-        if tag.get("basicProfile", None):
-            if tag["basicProfile"] in stats["confidentiality"].keys():
-                stats["confidentiality"][tag["basicProfile"]] += 1
-            else:
-                stats["confidentiality"][tag["basicProfile"]] = 0
-        else:
-            if "Unknown" in stats["confidentiality"].keys():
-                stats["confidentiality"]["Unknown"] += 1
-            else:
-                stats["confidentiality"]["Unknown"] = 0
-
-        if modality:
-            # Group tags by completeness
-            if tag.get("completenessRaw", None):
-                frequency = float(tag["completenessRaw"])
-
-                if frequency > 0 and frequency < 50:
-                    stats["sparseness"]["<50%"] += 1
-                elif frequency >= 50 and frequency < 60:
-                    stats["sparseness"]["50-60%"] += 1
-                elif frequency >= 60 and frequency < 70:
-                    stats["sparseness"]["60-70%"] += 1
-                elif frequency >= 70 and frequency < 80:
-                    stats["sparseness"]["70-80%"] += 1
-                elif frequency >= 80 and frequency < 90:
-                    stats["sparseness"]["80-90%"] += 1
-                elif frequency >= 90:
-                    stats["sparseness"][">=90%"] += 1
-            else:
-                stats["sparseness"]["Unknown"] += 1
-
-    return stats
-
-
-def monthly_counts(modalities, stage):
-    min_date = datetime.now()
-    max_date = datetime.strptime("2010/01", "%Y/%m")
-
-    for mod in modalities:
-        for attr in mod:
-            if "countsPerMonth" in attr:
-                mod[attr] = fix_month_counts(mod[attr])
-
-        if mod["promotionStatus"] == "available":
-            mod_min_date = min(datetime.strptime(count["date"], "%Y/%m") for count in mod["countsPerMonthRaw"])
-            mod_max_date = max(datetime.strptime(count["date"], "%Y/%m") for count in mod["countsPerMonthRaw"])
-
-            if mod_min_date < min_date:
-                min_date = mod_min_date
-
-            if mod_max_date > max_date:
-                max_date = mod_max_date
-
-    dates = {
-        "dates": list(OrderedDict(((min_date + timedelta(_)).strftime("%Y/%m"), None) for _ in range((max_date - min_date).days)).keys()),
-        "image_counts": {},
-        "series_counts": {},
-        "study_counts": {}
-    }
-
-    for mod in modalities:
-        if mod["promotionStatus"] == "available":
-            image_counts = {}
-            series_counts = {}
-            study_counts = {}
-
-            for vdate in dates["dates"]:
-                for count in mod[f"countsPerMonth{stage}"]:
-                    if datetime.strptime(vdate, "%Y/%m") == datetime.strptime(count["date"], "%Y/%m"):
-                        image_counts[vdate] = count["imageCount"]
-                        series_counts[vdate] = count["seriesCount"]
-                        study_counts[vdate] = count["studyCount"]
-
-            dates["image_counts"][mod["modality"]] = list(image_counts.values())
-            dates["series_counts"][mod["modality"]] = list(series_counts.values())
-            dates["study_counts"][mod["modality"]] = list(study_counts.values())
-
-    return dates
-
-
 def format_label_stats(labels):
     modalities = []
     chartLabels = []
@@ -286,26 +158,98 @@ def calculate_percentage(no1: Union[int, str], no2: Union[int, str]) -> str:
     return "{:.2f}".format(perc)
 
 
-def fix_month_counts(counts: List[Dict]) -> List[Dict]:
-    '''Monthly count cleaning required for live datasets.
-       Edge cases such as dates below the expected minimum date and
-       dates such as "1/1" can cause the counts at different stages to be
-       misaligned.
+def tag_table_query(params: Dict, modality: str) -> Tuple[int, Dict, Dict, List, int, int]:
+    '''Translates the parameters of a DataTables server-side request into
+       a tags collection query. The global search matches the start of the
+       tag name or DICOM ID, case-sensitively, on their indexes. With
+       search[regex] set, it instead matches anywhere in any searchable
+       column, case-insensitively, which scans the tags of the table. A
+       column search matches its value exactly, as chosen from the column
+       filters, on the tag indexes.
 
     Args:
-        counts (List): List of counts by monthly date.
+        params (Dict): Request parameters, e.g. request.args.
+        modality (str): Modality name, or all.
 
     Returns:
-        List[Dict]: Cleaned counts in the same format.
+        Tuple[int, Dict, Dict, List, int, int]: (<DRAW>, <TOTAL CONDITION>,
+            <FILTERED CONDITION>, <SORT>, <SKIP>, <LIMIT>)
     '''
-    fixed_counts = []
-    mincount = datetime.strptime("2010/01", "%Y/%m")
+    total = {} if modality == "all" else {"modalities": modality}
+    searchable = [field for field in TAG_COLUMNS if field not in MODALITY_COLUMNS]
+    conditions = [total] if total else []
+
+    search = params.get("search[value]", "").strip()
+
+    if search and params.get("search[regex]", "false") == "true":
+        pattern = {"$regex": re.escape(search), "$options": "i"}
+        conditions.append({"$or": [{field: pattern} for field in searchable]})
+    elif search:
+        # Only anchored, case-sensitive patterns are answered from an index
+        pattern = {"$regex": f"^{re.escape(search)}"}
+        conditions.append({"$or": [{field: pattern} for field in PREFIX_SEARCH_COLUMNS]})
 
-    for count in counts:
-        if count.get("date", None):
-            fcount = datetime.strptime(count["date"], "%Y/%m")
+    columns = {match.group(1): params[key] for key in params
+               for match in [re.fullmatch(r"columns\[(\d+)\]\[data\]", key)] if match}
 
-            if count["date"] != "1/1" and fcount >= mincount:
-                fixed_counts.append(count)
+    for column, field in columns.items():
+        value = params.get(f"columns[{column}][search][value]", "")
 
-    return fixed_counts
+        if value and field in searchable:
+            conditions.append({field: value})
+
+    orders = sorted(int(match.group(1)) for key in params
+                    for match in [re.fullmatch(r"order\[(\d+)\]\[column\]", key)] if match)
+    sort = []
+
+    for i in orders:
+        field = columns.get(params[f"order[{i}][column]"], None)
+
+        if field in searchable:
+            direction = pymongo.DESCENDING if params.get(f"order[{i}][dir]") == "desc" else pymongo.ASCENDING
+            sort.append((field, direction))
+
+    # A unique last key keeps pages stable
+    if not any(field == "tag" for field, _ in sort):
+        sort.append(("tag", pymongo.ASCENDING))
+
+    length = int(params.get("length", 50))
+    length = MAX_PAGE_LENGTH if length < 0 else min(length, MAX_PAGE_LENGTH)
+    filtered = {"$and": conditions} if len(conditions) > 1 else (conditions[0] if conditions else {})
+
+    return (int(params.get("draw", 0)), total, filtered, sort,
+            max(int(params.get("start", 0)), 0), length)
+
+
+def format_tag_row(tag: Dict, completeness: Dict) -> Dict:
+    '''Formats a tag document as a tag table row, as rendered by tags.html.
+
+    Args:
+        tag (Dict): Tag document.
+        completeness (Dict): {<TAG>: {"completenessRaw": <PERCENT>,
+                                      "tagQualityDateRaw": <TIMESTAMP>}}
+                             of the modality, empty for all tags.
+
+    Returns:
+        Dict: Row.
+    '''
+    quality = completeness.get(tag.get("tag", None), {})
+    modalities = tag.get("modalities", None)
+
+    return {
+        "tag": tag.get("tag", None),
+        "dicomID": tag.get("dicomID", "Unknown"),
+        "public": tag.get("public", "Unknown"),
+        "promotionStatus": tag.get("promotionStatus", "Unknown"),
+        "promotionStatusDate": tag.get("promotionStatusDate", None),
+        "description": tag.get("blockReason", None) or tag.get("description", "Unknown"),
+        "modalities": ", ".join(str(mod) for mod in modalities) if modalities else None,
+        "informationEntity": tag.get("informationEntity", "Unkown"),
+        "basicProfile": tag.get("basicProfile", "Unknown"),
+        "completenessRaw": quality.get("completenessRaw", "Unknown"),
+        "tagQualityDateRaw": quality.get("tagQualityDateRaw", None),
+        "type": tag.get("type", "Unknown"),
+        "valueRepresentation": tag.get("valueRepresentation", "Unknown"),
+        "valueMultiplicity": tag.get("valueMultiplicity", "Unknown"),
+        "retired": tag.get("retired", "Unknown")
+    }
@@ -0,0 +1,161 @@
+'''Module for request latency metrics, exposed in Prometheus text format.'''
+import time
+import bisect
+import threading
+from typing import Dict, List, Tuple
+from pymongo import monitoring
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class RequestTimer(threading.local):
+    '''Time spent in each phase by the request of the current thread.
+    '''
+    def __init__(self):
+        self.active = False
+        self.started = 0.0
+        self.db = 0.0
+        self.render = 0.0
+        self.render_start = 0.0
+
+    def start(self) -> None:
+        '''Starts timing a request.
+        '''
+        self.active = True
+        self.started = time.perf_counter()
+        self.db = 0.0
+        self.render = 0.0
+
+    def stop(self) -> Tuple[float, Dict[str, float]]:
+        '''Stops timing the request.
+
+        Returns:
+            Tuple[float, Dict[str, float]]: Request duration and duration of
+                                            each phase, in seconds.
+        '''
+        total = time.perf_counter() - self.started
+        self.active = False
+
+        return total, {"db": self.db, "compute": max(total - self.db - self.render, 0.0),
+                       "render": self.render}
+
+
+timer = RequestTimer()
+
+
+class CommandTimer(monitoring.CommandListener):
+    '''Adds the duration of the Mongo commands run by a request to its
+       timer. Commands run on the thread that issues them, so that commands
+       of background threads are not counted.
+    '''
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        if timer.active:
+            timer.db += event.duration_micros / 1e6
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        if timer.active:
+            timer.db += event.duration_micros / 1e6
+
+
+class Metrics:
+    '''Per-route latency histograms, per-route phase totals and cached
+       value lookups of the process.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, List[int]] = {}
+        self.totals: Dict[str, List[float]] = {}
+        self.phases: Dict[Tuple[str, str], float] = {}
+        self.cache: Dict[Tuple[str, str], int] = {}
+
+    def observe(self, route: str, total: float, phases: Dict[str, float]) -> None:
+        '''Records the latency of a request.
+
+        Args:
+            route (str): Route rule, e.g. /api/<modality>.
+            total (float): Request duration in seconds.
+            phases (Dict[str, float]): Duration of each phase in seconds.
+        '''
+        with self.lock:
+            counts = self.buckets.setdefault(route, [0] * (len(BUCKETS) + 1))
+            counts[bisect.bisect_left(BUCKETS, total)] += 1
+            sums = self.totals.setdefault(route, [0, 0.0])
+            sums[0] += 1
+            sums[1] += total
+
+            for phase, duration in phases.items():
+                self.phases[(route, phase)] = self.phases.get((route, phase), 0.0) + duration
+
+    def count_cache(self, function: str, result: str) -> None:
+        '''Records a lookup of a cached value.
+
+        Args:
+            function (str): Cached function name.
+            result (str): hit, stale or miss.
+        '''
+        with self.lock:
+            self.cache[(function, result)] = self.cache.get((function, result), 0) + 1
+
+    def exposition(self) -> str:
+        '''Returns the metrics in Prometheus text format.
+
+        Returns:
+            str: Metrics.
+        '''
+        lines = ["# HELP metacat_request_duration_seconds Request latency per route.",
+                 "# TYPE metacat_request_duration_seconds histogram"]
+
+        with self.lock:
+            for route, counts in sorted(self.buckets.items()):
+                cumulative = 0
+
+                for bound, count in zip(BUCKETS + ["+Inf"], counts):
+                    cumulative += count
+                    lines.append(f'metacat_request_duration_seconds_bucket{{route="{route}",'
+                                 f'le="{bound}"}} {cumulative}')
+
+                lines.append(f'metacat_request_duration_seconds_sum{{route="{route}"}} '
+                             f'{self.totals[route][1]:.6f}')
+                lines.append(f'metacat_request_duration_seconds_count{{route="{route}"}} '
+                             f'{self.totals[route][0]}')
+
+            lines += ["# HELP metacat_request_phase_seconds_total Request time per route and phase.",
+                      "# TYPE metacat_request_phase_seconds_total counter"]
+            lines += [f'metacat_request_phase_seconds_total{{route="{route}",phase="{phase}"}} '
+                      f'{duration:.6f}'
+                      for (route, phase), duration in sorted(self.phases.items())]
+
+            lines += ["# HELP metacat_cache_lookups_total Cached page lookups per result.",
+                      "# TYPE metacat_cache_lookups_total counter"]
+            lines += [f'metacat_cache_lookups_total{{function="{function}",result="{result}"}} {count}'
+                      for (function, result), count in sorted(self.cache.items())]
+
+            lines += ["# HELP metacat_cache_hit_ratio Share of cached page lookups served "
+                      "from the cache, fresh or stale.",
+                      "# TYPE metacat_cache_hit_ratio gauge"]
+
+            for function in sorted({function for function, _ in self.cache}):
+                lookups = sum(count for (name, _), count in self.cache.items() if name == function)
+                served = lookups - self.cache.get((function, "miss"), 0)
+                lines.append(f'metacat_cache_hit_ratio{{function="{function}"}} {served / lookups:.4f}')
+
+        return "\n".join(lines) + "\n"
+
+
+def server_timing(phases: Dict[str, float], total: float) -> str:
+    '''Returns a Server-Timing header value.
+
+    Args:
+        phases (Dict[str, float]): Duration of each phase in seconds.
+        total (float): Request duration in seconds.
+
+    Returns:
+        str: Header value, durations in milliseconds.
+    '''
+    timings = [f"{phase};dur={duration * 1000:.1f}" for phase, duration in phases.items()]
+
+    return ", ".join(timings + [f"total;dur={total * 1000:.1f}"])
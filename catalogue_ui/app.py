@@ -1,22 +1,63 @@
 '''Custom medical imaging metadata catalogue.
    Client-side processing decision based on: https://datatables.net/faqs/index#speed
 '''
+import os
+import gzip
+import json
+import time
 import logging
 import argparse
+import functools
+import threading
+from typing import Any, Callable, Dict
 import _modules.functionality as funct
+import _modules.metrics as metrics
 import modules.file_lib as flib
+import modules.view_lib as vlib
+from modules.mongo_lib import MongoLib
 from waitress import serve
-from flask import Flask, render_template
+from bson import json_util
+from pymongo import monitoring
+from flask import (Flask, Response, before_render_template, g, has_app_context,
+                   jsonify, render_template, request, template_rendered)
 from werkzeug.exceptions import abort
 from flask_caching import Cache
 
 
 app = Flask(__name__)
-app.config.from_mapping({"CACHE_TYPE": "SimpleCache"})
+# Pages are cached on disk per catalogue version, so they survive restarts,
+# are shared by processes and only expire when collectors change the data
+app.config.from_mapping({
+    "CACHE_TYPE": "FileSystemCache",
+    "CACHE_DIR": os.environ.get("METACAT_CACHE_DIR", "cache"),
+    "CACHE_DEFAULT_TIMEOUT": 0,
+    "CACHE_THRESHOLD": 1000
+})
 cache = Cache(app)
 log = flib.setup_logging("logs", "catalogue_ui", "debug")
 logging.getLogger(log)
 
+# Format revision of the data API, part of its ETags
+DATA_REVISION = 1
+# Tag tables with more rows are paged by the server
+SERVER_SIDE_TAGS = 5000
+# Whether the previous value of a page is served while it is recomputed
+SERVE_STALE = True
+# Columns of the tag tables filtered with a list of values
+TAG_FILTERS = ["public", "promotionStatus", "basicProfile"]
+
+# Times Mongo commands, registered before the shared client is created
+monitoring.register(metrics.CommandTimer())
+request_metrics = metrics.Metrics()
+
+# One pooled client per process, shared by the request handles of all threads
+MongoLib.share_client()
+app.teardown_appcontext(funct.close_db_connection)
+
+# Locks of the cached values being computed, per function and arguments
+computing: Dict[str, threading.Lock] = {}
+computing_lock = threading.Lock()
+
 
 def argparser() -> argparse.Namespace:
     '''Terminal argument parser function.
@@ -35,33 +76,246 @@ def argparser() -> argparse.Namespace:
     parser.add_argument("--port", "-p",
                         help="Port number. Default to 5002",
                         type=int, required=False, default=5002)
+    parser.add_argument("--warm-interval", "-w",
+                        help=("Seconds between checks of the catalogue version "
+                              "that recompute the main pages when it changes. "
+                              "Default to 60, 0 to disable."),
+                        type=float, required=False, default=60.0)
 
     return parser.parse_args()
 
 
+@app.before_request
+def start_timer() -> None:
+    '''Starts timing the request.'''
+    metrics.timer.start()
+
+
+@before_render_template.connect_via(app)
+def start_render(sender, template, context, **extra) -> None:
+    metrics.timer.render_start = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def stop_render(sender, template, context, **extra) -> None:
+    metrics.timer.render += time.perf_counter() - metrics.timer.render_start
+
+
+@app.after_request
+def record_timing(response: Response) -> Response:
+    '''Records the latency of the request, split into Mongo, Python and
+       rendering time, and reports it in a Server-Timing header.
+
+    Args:
+        response (Response): Response.
+
+    Returns:
+        Response: Response with a Server-Timing header.
+    '''
+    if not metrics.timer.active:
+        return response
+
+    total, phases = metrics.timer.stop()
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    request_metrics.observe(route, total, phases)
+    response.headers["Server-Timing"] = metrics.server_timing(phases, total)
+
+    return response
+
+
+@app.route('/metrics')
+def metrics_page() -> Response:
+    '''Metrics of the process in Prometheus text format.'''
+    return Response(request_metrics.exposition(),
+                    mimetype="text/plain; version=0.0.4")
+
+
+def catalogue_version() -> int:
+    '''Returns the current catalogue version, part of the key of every
+       cached page.
+
+    Returns:
+        int: Catalogue version.
+    '''
+    conn = funct.get_db_connection(log)
+
+    return conn.get_version()
+
+
+def revalidated(func: Callable) -> Callable:
+    '''Caches the value of a function of the catalogue version, given as
+       its last argument, keeping only the value of the latest version.
+       When the version changes, the previous value is served while a single
+       background thread computes the new one, and the version of the value
+       actually served is recorded for served_version(). Concurrent calls
+       missing the same value wait for a single computation.
+
+    Args:
+        func (Callable): Function of (*args, version).
+
+    Returns:
+        Callable: Cached function, with a warm(*args, version) attribute
+                  computing the value of the version if it is not cached.
+    '''
+    def cache_key(args: tuple) -> str:
+        return f"{func.__name__}:{args[:-1]!r}"
+
+    def key_lock(key: str) -> threading.Lock:
+        with computing_lock:
+            return computing.setdefault(key, threading.Lock())
+
+    def release(key: str, lock: threading.Lock) -> None:
+        # Locks are dropped once released, as URLs give unbounded keys
+        with computing_lock:
+            lock.release()
+
+            if computing.get(key, None) is lock:
+                del computing[key]
+
+    def compute(key: str, args: tuple) -> Any:
+        value = func(*args)
+        cache.set(key, (args[-1], value))
+
+        return value
+
+    def refresh(key: str, args: tuple, lock: threading.Lock) -> None:
+        try:
+            with app.app_context():
+                compute(key, args)
+        except Exception as error:
+            logging.exception("Failed refreshing %s: %s", key, error)
+        finally:
+            release(key, lock)
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = cache_key(args)
+        cached = cache.get(key)
+
+        if cached is not None and cached[0] == args[-1]:
+            request_metrics.count_cache(func.__name__, "hit")
+            return cached[1]
+
+        if cached is not None and SERVE_STALE:
+            # Stale: refresh once in the background and serve the old value
+            lock = key_lock(key)
+
+            if lock.acquire(blocking=False):
+                threading.Thread(target=refresh, args=[key, args, lock], daemon=True).start()
+
+            if has_app_context():
+                g.served_version = min(g.get("served_version", cached[0]), cached[0])
+
+            request_metrics.count_cache(func.__name__, "stale")
+            return cached[1]
+
+        request_metrics.count_cache(func.__name__, "miss")
+        return warm(*args)
+
+    def warm(*args):
+        key = cache_key(args)
+        lock = key_lock(key)
+        lock.acquire()
+
+        try:
+            cached = cache.get(key)
+
+            if cached is not None and cached[0] == args[-1]:
+                return cached[1]
+
+            return compute(key, args)
+        finally:
+            release(key, lock)
+
+    wrapper.warm = warm
+
+    return wrapper
+
+
+def served_version(version: int) -> int:
+    '''Returns the oldest catalogue version of the cached values served
+       since the last call in this request, which is older than the given
+       current version if a stale value was served.
+
+    Args:
+        version (int): Current catalogue version.
+
+    Returns:
+        int: Catalogue version of the data served.
+    '''
+    return g.pop("served_version", version)
+
+
+def warm_pages(version: int) -> None:
+    '''Computes the main pages of a catalogue version that are not cached.
+       The all tags page is warmed with the data render_tags() reads in its
+       mode, the filters of a server-side table or every tag otherwise.
+
+    Args:
+        version (int): Catalogue version.
+    '''
+    start = time.time()
+    pages = [(get_mods, []), (get_report, []), (get_labels, []),
+             (get_tag_count, ["all"])]
+
+    try:
+        server_side = get_tag_count.warm("all", version) > SERVER_SIDE_TAGS
+        pages.append((get_tag_filters, ["all"]) if server_side else (get_tags, ["all"]))
+    except Exception as error:
+        logging.warning("Failed counting tags to warm: %s", error)
+
+    pages += [(get_modality, [mod["modality"]])
+              for mod in get_mods.warm(version) if mod.get("modality", None)]
+
+    for getter, args in pages:
+        try:
+            getter.warm(*args, version)
+        except Exception as error:
+            logging.warning("Failed warming %s%s: %s", getter.__name__, args, error)
+
+    logging.info("Warmed %s pages of catalogue version %s in %.1fs.",
+                 len(pages), version, time.time() - start)
+
+
+def warm_cache(interval: float) -> None:
+    '''Computes the main pages on start up, and again whenever the
+       catalogue version changes, so that visitors do not wait for them.
+
+    Args:
+        interval (float): Seconds between checks of the catalogue version.
+    '''
+    warmed = None
+
+    while True:
+        try:
+            with app.app_context():
+                version = catalogue_version()
+
+                if version != warmed:
+                    warm_pages(version)
+                    warmed = version
+        except Exception as error:
+            logging.exception("Failed warming the cache: %s", error)
+
+        time.sleep(interval)
+
+
 @app.route('/')
 def index() -> str:
     '''Main page showing modalities summary.'''
-    data = get_mods()
+    data = get_mods(catalogue_version())
 
     return render_template("index.html",
                            modalities=data,
                            calculate_percentage=funct.calculate_percentage)
 
 
-@cache.cached(timeout=500)
-def get_mods():
+@revalidated
+def get_mods(version: int):
     conn = funct.get_db_connection(log)
-    modalities = list(conn.search("modalities", {}, {
-        "modality": 1, "promotionStatus": 1, "promotionStatusDate": 1,
-        "totalNoImagesRaw": 1, "totalNoImagesStaging": 1, "totalNoImagesLive": 1
-    }))
-    blocked_mods = list(conn.search("modality_blocklist"))
-    conn.disconnect()
+    view = vlib.load_view(conn, "index") or vlib.index_view(conn)
 
-    modalities = funct.merge_lists(modalities, blocked_mods, "modality")
-
-    return modalities
+    return view["modalities"]
 
 
 @app.route('/api/<modality>')
@@ -71,20 +325,23 @@ def modality(modality: str) -> str:
     Args:
         modality (str): Modality name.
     '''
-    conn = funct.get_db_connection(log)
-    mod_meta = conn.get_modality_meta(modality)
-    tag_meta = conn.get_tag_meta(modality)
-
     if modality is None:
         abort(404)
 
-    tag_meta = funct.merge_lists(mod_meta.pop("tags"), tag_meta, "tag")
-    tag_stats = funct.tag_stats(tag_meta, modality=True)
-    counts = funct.format_counts(mod_meta)
-    conn.disconnect()
+    mod_meta = get_modality(modality, catalogue_version())[0]
+
+    return render_template("modality.html", modality=mod_meta)
+
 
-    return render_template("modality.html", modality=mod_meta,
-                           tags=tag_stats, counts=counts)
+@revalidated
+def get_modality(modality: str, version: int):
+    conn = funct.get_db_connection(log)
+    view = vlib.load_view(conn, f"modality/{modality}") or vlib.modality_view(conn, modality)
+
+    if view is None:
+        abort(404)
+
+    return view["modality"], view["tagStats"], view["counts"]
 
 
 @app.route('/api/<modality>/tags')
@@ -94,21 +351,99 @@ def modality_tags(modality: str) -> str:
     Args:
         modality (str): Modality name.
     '''
-    data = get_tags(modality)
-
-    return render_template("tags.html", modality=modality, tags=data)
+    return render_tags(modality, modality)
 
 
 @app.route('/api/all_tags')
 def all_tags() -> str:
     '''Page showing all tags.'''
-    data = get_tags("all")
+    return render_tags("all", "All Tags")
+
+
+def render_tags(modality: str, title: str) -> str:
+    '''Renders a tag table, rendering every tag into the page, or paging
+       them from /api/tags_data when there are more than SERVER_SIDE_TAGS
+       tags or ?mode=server is given.
+
+    Args:
+        modality (str): Modality name, or all.
+        title (str): Page title.
+    '''
+    version = catalogue_version()
+    mode = request.args.get("mode", None)
+
+    if mode is None:
+        mode = "server" if get_tag_count(modality, version) > SERVER_SIDE_TAGS else "client"
+
+    if mode == "server":
+        columns = [column for column in funct.TAG_COLUMNS
+                   if modality != "all" or column not in funct.MODALITY_COLUMNS]
+
+        return render_template("tags.html", modality=title, tags=[],
+                               server_side=modality, columns=columns,
+                               filters=get_tag_filters(modality, version))
+
+    data = get_tags(modality, version)
+
+    return render_template("tags.html", modality=title, tags=data)
+
+
+@app.route('/api/tags_data/<modality>')
+def tags_data(modality: str):
+    '''Tag table rows of a modality, or all, following the DataTables
+       server-side processing protocol.
+
+    Args:
+        modality (str): Modality name, or all.
+    '''
+    try:
+        draw, total, condition, sort, skip, limit = funct.tag_table_query(request.args, modality)
+    except ValueError:
+        abort(400)
+
+    version = catalogue_version()
+    conn = funct.get_db_connection(log)
+    tags = conn.search_page("tags", condition, funct.TAG_ROW_FIELDS, sort, skip, limit)
+    completeness = {} if modality == "all" else get_completeness(modality, version)
+    records = get_tag_count(modality, version)
+
+    return jsonify({
+        "draw": draw,
+        "recordsTotal": records,
+        "recordsFiltered": records if condition == total else conn.count("tags", condition),
+        "data": [funct.format_tag_row(tag, completeness) for tag in tags]
+    })
+
+
+@revalidated
+def get_tag_count(modality: str, version: int) -> int:
+    conn = funct.get_db_connection(log)
+
+    return conn.count("tags", {} if modality == "all" else {"modalities": modality})
+
+
+@revalidated
+def get_tag_filters(modality: str, version: int) -> dict:
+    conn = funct.get_db_connection(log)
+    condition = {} if modality == "all" else {"modalities": modality}
+
+    return {field: sorted(str(value) for value in conn.get_field_values("tags", field, condition=condition)
+                          if value is not None)
+            for field in TAG_FILTERS}
+
+
+@revalidated
+def get_completeness(modality: str, version: int) -> dict:
+    conn = funct.get_db_connection(log)
+    mod_meta = list(conn.search("modalities", {"modality": modality}, {
+        "tags.tag": 1, "tags.completenessRaw": 1, "tags.tagQualityDateRaw": 1
+    }))
 
-    return render_template("tags.html", modality="All Tags", tags=data)
+    return {tag["tag"]: tag for tag in mod_meta[0].get("tags", [])} if mod_meta else {}
 
 
-@cache.cached(timeout=500)
-def get_tags(modality):
+@revalidated
+def get_tags(modality: str, version: int):
     conn = funct.get_db_connection(log)
 
     if modality != "all":
@@ -124,8 +459,6 @@ def get_tags(modality):
     else:
         tag_meta = list(conn.search("tags"))
 
-    conn.disconnect()
-
     tag_meta = funct.format_mods(tag_meta)
     data = sorted(tag_meta, key=lambda tag: tag["tag"])
 
@@ -135,13 +468,19 @@ def get_tags(modality):
 @app.route('/api/labels')
 def labels() -> str:
     '''Body part labelling page showing body part statistics.'''
+    label_meta = get_labels(catalogue_version())[2]
+
+    return render_template("body.html", logs=label_meta)
+
+
+@revalidated
+def get_labels(version: int):
     conn = funct.get_db_connection(log)
     label_meta = list(conn.search("bodyparts"))
-    conn.disconnect()
 
     labels, data = funct.format_label_stats(label_meta[0]["stats"])
 
-    return render_template("body.html", labels=labels, data=data, logs=label_meta)
+    return labels, data, label_meta
 
 
 @app.route('/api/codes')
@@ -167,25 +506,96 @@ def codes() -> str:
 @app.route('/api/report')
 def report() -> str:
     '''Report page.'''
-    tag_stats, monthly_counts = get_report()
-
-    return render_template("report.html", tag_stats=tag_stats,
-                           monthly_counts=monthly_counts)
+    return render_template("report.html")
 
 
-@cache.cached(timeout=500)
-def get_report():
+@revalidated
+def get_report(version: int):
     conn = funct.get_db_connection(log)
-    modalities = list(conn.search("modalities", {}, {
-        "modality": 1, "countsPerMonthRaw": 1, "countsPerMonthStaging": 1,
-        "countsPerMonthLive": 1, "promotionStatus": 1
-    }))
-    tags = conn.get_tag_meta("all")
+    view = vlib.load_view(conn, "report") or vlib.report_view(conn)
+
+    return view["tagStats"], view["monthlyCounts"]
+
+
+def data_response(build: Callable[[int], Any]) -> Response:
+    '''Returns a data API response, compressed with gzip when accepted. The
+       strong ETag is derived from the catalogue version of the data, so
+       unchanged data is answered with 304 Not Modified without being built,
+       and data served stale while it is recomputed is not.
+
+    Args:
+        build (Callable[[int], Any]): Builds the data of a catalogue version.
+
+    Returns:
+        Response: JSON response.
+    '''
+    version = catalogue_version()
+    compress = "gzip" in request.accept_encodings
+
+    def etag(data_version: int) -> str:
+        # Representations of different encodings need different strong ETags
+        return f"{DATA_REVISION}.{data_version}{'-gzip' if compress else ''}"
+
+    if request.if_none_match.contains_weak(etag(version)):
+        response = Response(status=304)
+        response.set_etag(etag(version))
+    else:
+        served_version(version)
+        body = json.dumps(build(version), default=json_util.default).encode("utf-8")
+        response = Response(gzip.compress(body, 6) if compress else body,
+                            mimetype="application/json")
+
+        if compress:
+            response.headers["Content-Encoding"] = "gzip"
+
+        # Stale data is tagged with its own version, so it is not revalidated
+        response.set_etag(etag(served_version(version)))
+
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "public, no-cache"
 
-    tag_stats = funct.tag_stats(tags)
-    monthly_counts = funct.monthly_counts(modalities, "Live")
+    return response
 
-    return tag_stats, monthly_counts
+
+@app.route('/data/modalities')
+def modalities_data() -> Response:
+    '''Modality summaries.'''
+    return data_response(get_mods)
+
+
+@app.route('/data/<modality>/counts')
+def counts_data(modality: str) -> Response:
+    '''Monthly counts of a modality, per stage.
+
+    Args:
+        modality (str): Modality name.
+    '''
+    return data_response(lambda version: get_modality(modality, version)[2])
+
+
+@app.route('/data/<modality>/tag_stats')
+def tag_stats_data(modality: str) -> Response:
+    '''Tag statistics of a modality, or of all tags.
+
+    Args:
+        modality (str): Modality name, or all.
+    '''
+    if modality == "all":
+        return data_response(lambda version: get_report(version)[0])
+
+    return data_response(lambda version: get_modality(modality, version)[1])
+
+
+@app.route('/data/report')
+def report_data() -> Response:
+    '''Monthly live counts of the available modalities.'''
+    return data_response(lambda version: get_report(version)[1])
+
+
+@app.route('/data/labels')
+def labels_data() -> Response:
+    '''Body part labelling chart data.'''
+    return data_response(lambda version: dict(zip(["labels", "data"], get_labels(version)[:2])))
 
 
 def main(args: argparse.Namespace) -> None:
@@ -198,6 +608,12 @@ def main(args: argparse.Namespace) -> None:
     host = args.address
     port = args.port
 
+    # Open the shared client before the first request
+    funct.get_db_connection(log).disconnect()
+
+    if args.warm_interval > 0:
+        threading.Thread(target=warm_cache, args=[args.warm_interval], daemon=True).start()
+
     if env == "dev":
         app.run(host=host, port=port, debug=True)
     else:
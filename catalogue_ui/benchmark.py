@@ -0,0 +1,539 @@
+'''Latency benchmark of the catalogue UI.
+   Builds a synthetic catalogue of a given scale in a dedicated database,
+   drives every route of the UI with concurrent clients, in process through
+   the Flask test client and over HTTP against waitress, with a cold and a
+   warm cache, and saves throughput and latency percentiles to JSON so that
+   commits can be compared.
+   Output:
+   {
+       "commit": <GIT COMMIT>,
+       "date": <TIMESTAMP>,
+       "parameters": {<ARGUMENT>: <VALUE>},
+       "results": {
+           <test|http>: {
+               <cold|warm>: {
+                   "requests": <COUNT>, "errors": <COUNT>,
+                   "throughput": <REQUESTS PER SECOND>,
+                   "latency": {"mean": <MS>, "p50": <MS>, "p95": <MS>, "p99": <MS>},
+                   "serverTiming": {<PHASE>: <MEAN MS>},
+                   "routes": {<ROUTE>: {"requests": ..., "latency": ..., "serverTiming": ...}}
+               }
+           }
+       }
+   }
+'''
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import tempfile
+import importlib
+import subprocess
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+import modules.file_lib as flib
+import modules.view_lib as vlib
+from modules.mongo_lib import MongoLib
+
+MODALITIES = ["CT", "MR", "CR", "DX", "US", "PT", "NM", "MG", "XA", "RF", "OT", "SR"]
+PROMOTION = ["available", "processing", "unavailable", "blocked"]
+PROFILES = ["D", "Z", "X", "K", "C", "U", "X/Z", "X/D", "X/Z/D"]
+COLLECTIONS = ["modalities", "tags", "bodyparts", "modality_blocklist", vlib.VIEWS]
+# Query of a server-side tag table page
+TAGS_PAGE = ("draw=1&start=0&length=50&columns[0][data]=tag&columns[1][data]=dicomID"
+             "&order[0][column]=0&order[0][dir]=asc&search[value]=1")
+
+
+def argparser() -> argparse.Namespace:
+    '''Terminal argument parser function.
+
+    Returns:
+        argparse.Namespace: Terminal arguments.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modalities", "-m",
+                        help="Number of synthetic modalities. Default to 10.",
+                        type=int, required=False, default=10)
+    parser.add_argument("--tags", "-t",
+                        help="Number of synthetic tags. Default to 2000.",
+                        type=int, required=False, default=2000)
+    parser.add_argument("--months", "-n",
+                        help="Number of months of counts. Default to 120.",
+                        type=int, required=False, default=120)
+    parser.add_argument("--clients", "-c",
+                        help="Number of concurrent clients. Default to 8.",
+                        type=int, required=False, default=8)
+    parser.add_argument("--requests", "-r",
+                        help=("Number of warm requests per route. "
+                              "Default to 50."), type=int, required=False,
+                        default=50)
+    parser.add_argument("--cold-rounds",
+                        help=("Number of times every route is requested "
+                              "after clearing the cache. Default to 3."),
+                        type=int, required=False, default=3)
+    parser.add_argument("--modes",
+                        help="Clients to run. Default to test and http.",
+                        nargs="+", choices=["test", "http"],
+                        default=["test", "http"])
+    parser.add_argument("--database", "-d",
+                        help=("Database of the synthetic catalogue, emptied "
+                              "first. Default to metacat_benchmark."),
+                        type=str, required=False, default="metacat_benchmark")
+    parser.add_argument("--mock",
+                        help=("Use an in-memory mongomock stand-in instead of "
+                              "the Mongo server given by MONGOHOST."),
+                        action="store_true")
+    parser.add_argument("--seed",
+                        help="Random seed of the catalogue. Default to 0.",
+                        type=int, required=False, default=0)
+    parser.add_argument("--output", "-o",
+                        help="JSON results path. Default to benchmark.json.",
+                        type=str, required=False, default="benchmark.json")
+
+    args = parser.parse_args()
+
+    if args.database == "analytics":
+        parser.error("Refusing to overwrite the analytics catalogue, use another --database.")
+
+    return args
+
+
+def month_counts(months: List[str], scale: float, rand: random.Random) -> List[Dict]:
+    '''Returns synthetic monthly counts.
+
+    Args:
+        months (List[str]): Months, YYYY/M.
+        scale (float): Fraction of the raw counts.
+        rand (random.Random): Random generator.
+
+    Returns:
+        List[Dict]: [{"date", "imageCount", "seriesCount", "studyCount"}]
+    '''
+    counts = []
+
+    for month in months:
+        studies = int(rand.randint(50, 500) * scale)
+        counts.append({"date": month, "studyCount": studies, "seriesCount": studies * 3,
+                       "imageCount": studies * rand.randint(100, 300)})
+
+    return counts
+
+
+def build_catalogue(mongo: MongoLib, modalities: int, tags: int, months: int,
+                    seed: int) -> List[str]:
+    '''Writes a synthetic catalogue, replacing the catalogue collections.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the benchmark database.
+        modalities (int): Number of modalities.
+        tags (int): Number of tags.
+        months (int): Number of months of counts.
+        seed (int): Random seed.
+
+    Returns:
+        List[str]: Modality names.
+    '''
+    rand = random.Random(seed)
+    names = (MODALITIES + [f"M{index:03d}" for index in range(modalities)])[:modalities]
+    date = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+    start = datetime.today().year * 12 - months
+    dates = [f"{month // 12}/{month % 12 + 1}" for month in range(start, start + months)]
+
+    for collection in COLLECTIONS:
+        mongo.delete_many(collection, {})
+
+    tag_docs = []
+
+    for index in range(tags):
+        tag_docs.append({
+            "tag": f"SyntheticTag{index:05d}",
+            "dicomID": f"({index >> 16:04X},{index & 0xFFFF:04X})",
+            "public": rand.choice(["true", "false"]),
+            "promotionStatus": rand.choice(PROMOTION),
+            "promotionStatusDate": date,
+            "description": f"Synthetic tag {index}",
+            "modalities": sorted(rand.sample(names, rand.randint(1, len(names)))),
+            "informationEntity": rand.choice(["Patient", "Study", "Series", "Image"]),
+            "basicProfile": rand.choice(PROFILES),
+            "type": rand.choice(["1", "2", "3"]),
+            "valueRepresentation": rand.choice(["CS", "DA", "LO", "SH", "UI", "US"]),
+            "valueMultiplicity": "1",
+            "retired": rand.choice(["true", "false"])
+        })
+
+    mod_docs = []
+
+    for name in names:
+        raw = month_counts(dates, 1, rand)
+        status = rand.choice(PROMOTION)
+        doc = {"modality": name, "description": f"Synthetic modality {name}",
+               "descriptionSource": "benchmark", "promotionStatus": status,
+               "promotionStatusDate": date,
+               "countsPerMonthRaw": raw,
+               "countsPerMonthStaging": month_counts(dates, 0.8, rand),
+               "countsPerMonthLive": month_counts(dates, 0.5, rand),
+               "tags": [{"tag": tag["tag"], "completenessRaw": round(rand.uniform(0, 100), 2),
+                         "tagQualityDateRaw": date}
+                        for tag in tag_docs if name in tag["modalities"]]}
+
+        for stage, scale in (("Raw", 1), ("Staging", 0.8), ("Live", 0.5)):
+            doc[f"totalNoImages{stage}"] = int(sum(count["imageCount"] for count in raw) * scale)
+            doc[f"totalNoSeries{stage}"] = int(sum(count["seriesCount"] for count in raw) * scale)
+            doc[f"totalNoStudies{stage}"] = int(sum(count["studyCount"] for count in raw) * scale)
+            doc[f"countsDate{stage}"] = date
+
+        for attr, value in (("avgNoImagesPerSeriesRaw", 150), ("minNoImagesPerSeriesRaw", 1),
+                            ("maxNoImagesPerSeriesRaw", 3000), ("stdDevImagesPerSeriesRaw", 80.5),
+                            ("avgNoSeriesPerStudyRaw", 3), ("minNoSeriesPerStudyRaw", 1),
+                            ("maxNoSeriesPerStudyRaw", 40), ("stdDevSeriesPerStudyRaw", 2.5)):
+            doc[attr] = value
+
+        mod_docs.append(doc)
+
+    mongo.insert_many("tags", tag_docs)
+    mongo.insert_many("modalities", mod_docs)
+    mongo.insert_many("modality_blocklist", [
+        {"modality": doc["modality"], "blockReason": "Synthetic block."}
+        for doc in mod_docs if doc["promotionStatus"] == "blocked"
+    ])
+    mongo.insert_many("bodyparts", [{"stats": [
+        {"modality": name,
+         "labels": {label: {"percentLabelledSeries": f"{rand.uniform(0, 100):.2f}"}
+                    for label in ("HEAD", "CHEST", "ABDOMEN", "PELVIS")}}
+        for name in names
+    ]}])
+
+    mongo.create_index("tags", "tag", uniq=True)
+    mongo.create_index("tags", ["modalities", "tag"])
+    mongo.create_index("modalities", "modality", uniq=True)
+
+    if not vlib.refresh_views(mongo):
+        logging.warning("Views not written, pages build them on the fly.")
+
+    logging.info("Built a synthetic catalogue of %s modalities, %s tags and %s months.",
+                 len(names), tags, months)
+
+    return names
+
+
+def list_routes(modalities: List[str]) -> List[Tuple[str, str]]:
+    '''Lists a URL of every route of the UI.
+
+    Args:
+        modalities (List[str]): Modality names.
+
+    Returns:
+        List[Tuple[str, str]]: [(<ROUTE>, <URL>)]
+    '''
+    routes = [("/", "/"), ("/api/report", "/api/report"), ("/api/all_tags", "/api/all_tags"),
+              ("/api/labels", "/api/labels"), ("/api/codes", "/api/codes"),
+              ("/data/modalities", "/data/modalities"), ("/data/report", "/data/report"),
+              ("/data/labels", "/data/labels"),
+              ("/api/tags_data/<modality>", f"/api/tags_data/all?{TAGS_PAGE}")]
+
+    for mod in modalities:
+        routes += [("/api/<modality>", f"/api/{mod}"),
+                   ("/api/<modality>/tags", f"/api/{mod}/tags"),
+                   ("/data/<modality>/counts", f"/data/{mod}/counts"),
+                   ("/data/<modality>/tag_stats", f"/data/{mod}/tag_stats")]
+
+    return routes
+
+
+def parse_timing(header: str) -> Dict[str, float]:
+    '''Parses a Server-Timing header.
+
+    Args:
+        header (str): Header value, e.g. db;dur=1.2, total;dur=3.4
+
+    Returns:
+        Dict[str, float]: {<PHASE>: <MS>}
+    '''
+    timing = {}
+
+    for metric in (header or "").split(","):
+        name, _, duration = metric.strip().partition(";dur=")
+
+        if name and duration:
+            timing[name] = float(duration)
+
+    return timing
+
+
+def test_client_get(app) -> Callable[[str], Tuple[int, Dict]]:
+    '''Returns a function requesting a URL in process through a Flask test
+       client of the current thread.
+
+    Args:
+        app (Flask): UI application.
+
+    Returns:
+        Callable[[str], Tuple[int, Dict]]: URL -> (<STATUS>, <SERVER TIMING>)
+    '''
+    local = threading.local()
+
+    def get(url: str) -> Tuple[int, Dict]:
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+
+        response = local.client.get(url)
+        response.get_data()
+
+        return response.status_code, parse_timing(response.headers.get("Server-Timing"))
+
+    return get
+
+
+def http_get(base: str) -> Callable[[str], Tuple[int, Dict]]:
+    '''Returns a function requesting a URL over HTTP.
+
+    Args:
+        base (str): Server address, e.g. http://127.0.0.1:8080
+
+    Returns:
+        Callable[[str], Tuple[int, Dict]]: URL -> (<STATUS>, <SERVER TIMING>)
+    '''
+    def get(url: str) -> Tuple[int, Dict]:
+        try:
+            with urllib.request.urlopen(f"{base}{url}", timeout=60) as response:
+                response.read()
+                return response.status, parse_timing(response.headers.get("Server-Timing"))
+        except urllib.error.HTTPError as error:
+            return error.code, {}
+
+    return get
+
+
+def percentile(values: List[float], quantile: float) -> float:
+    '''Returns the nearest-rank percentile of values.
+
+    Args:
+        values (List[float]): Sorted values.
+        quantile (float): Quantile between 0 and 1.
+
+    Returns:
+        float: Percentile, 0 if there are no values.
+    '''
+    if not values:
+        return 0.0
+
+    return values[min(max(math.ceil(quantile * len(values)) - 1, 0), len(values) - 1)]
+
+
+def summarise(samples: List[Tuple[str, float, int, Dict]], duration: float) -> Dict:
+    '''Summarises request samples.
+
+    Args:
+        samples (List[Tuple[str, float, int, Dict]]): (<ROUTE>, <SECONDS>,
+                                                      <STATUS>, <SERVER TIMING>)
+        duration (float): Wall time of the requests in seconds.
+
+    Returns:
+        Dict: Requests, errors, throughput, latency and Server-Timing means.
+    '''
+    latencies = sorted(sample[1] * 1000 for sample in samples)
+    phases: Dict[str, List[float]] = {}
+
+    for _, _, _, timing in samples:
+        for phase, value in timing.items():
+            phases.setdefault(phase, []).append(value)
+
+    return {
+        "requests": len(samples),
+        "errors": sum(1 for sample in samples if sample[2] != 200),
+        "throughput": round(len(samples) / duration, 2) if duration else 0.0,
+        "latency": {"mean": round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+                    **{f"p{int(quantile * 100)}": round(percentile(latencies, quantile), 3)
+                       for quantile in (0.5, 0.95, 0.99)}},
+        "serverTiming": {phase: round(sum(values) / len(values), 3)
+                         for phase, values in phases.items()}
+    }
+
+
+def drive(get: Callable, urls: List[Tuple[str, str]],
+          clients: int) -> Tuple[List[Tuple[str, float, int, Dict]], float]:
+    '''Requests URLs with concurrent clients.
+
+    Args:
+        get (Callable): Output of test_client_get() or http_get().
+        urls (List[Tuple[str, str]]): [(<ROUTE>, <URL>)] to request, in order.
+        clients (int): Number of concurrent clients.
+
+    Returns:
+        Tuple[List[Tuple[str, float, int, Dict]], float]: Samples, see
+            summarise(), and wall time in seconds.
+    '''
+    def timed(route_url: Tuple[str, str]) -> Tuple[str, float, int, Dict]:
+        start = time.perf_counter()
+        status, timing = get(route_url[1])
+
+        return route_url[0], time.perf_counter() - start, status, timing
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        samples = list(pool.map(timed, urls))
+
+    return samples, time.perf_counter() - start
+
+
+def report(samples: List[Tuple[str, float, int, Dict]], duration: float) -> Dict:
+    '''Summarises request samples, overall and per route.
+
+    Args:
+        samples (List[Tuple[str, float, int, Dict]]): Output of drive().
+        duration (float): Wall time of the requests in seconds.
+
+    Returns:
+        Dict: Summary with a routes summary.
+    '''
+    by_route: Dict[str, List] = {}
+
+    for sample in samples:
+        by_route.setdefault(sample[0], []).append(sample)
+
+    summary = summarise(samples, duration)
+    summary["routes"] = {route: {key: value for key, value in summarise(route_samples, 0).items()
+                                 if key != "throughput"}
+                         for route, route_samples in sorted(by_route.items())}
+
+    return summary
+
+
+def run_benchmark(ui, get: Callable, routes: List[Tuple[str, str]],
+                  args: argparse.Namespace) -> Dict:
+    '''Runs the cold and warm cache phases with one kind of client. Each
+       cold round requests every route once after clearing the cache. The
+       warm phase requests every route --requests times in random order.
+
+    Args:
+        ui (module): UI application module.
+        get (Callable): Output of test_client_get() or http_get().
+        routes (List[Tuple[str, str]]): Output of list_routes().
+        args (argparse.Namespace): Terminal arguments.
+
+    Returns:
+        Dict: {"cold": <SUMMARY>, "warm": <SUMMARY>}
+    '''
+    samples: List = []
+    duration = 0.0
+
+    for _ in range(args.cold_rounds):
+        ui.cache.clear()
+        round_samples, round_duration = drive(get, routes, args.clients)
+        samples += round_samples
+        duration += round_duration
+
+    results = {"cold": report(samples, duration)}
+
+    urls = routes * args.requests
+    random.Random(args.seed).shuffle(urls)
+    # Caches every page, in case no cold round ran
+    drive(get, routes, args.clients)
+    results["warm"] = report(*drive(get, urls, args.clients))
+
+    return results
+
+
+def git_commit() -> str:
+    '''Returns the commit of the working tree, if any.
+
+    Returns:
+        str: Commit hash, or unknown.
+    '''
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_summary(results: Dict) -> None:
+    '''Prints a table of the results.
+
+    Args:
+        results (Dict): Results per mode and phase.
+    '''
+    print(f"{'mode':<6}{'cache':<7}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}"
+          f"{'p99 ms':>10}{'errors':>8}")
+
+    for mode, phases in results.items():
+        for phase, summary in phases.items():
+            latency = summary["latency"]
+            print(f"{mode:<6}{phase:<7}{summary['throughput']:>10}{latency['p50']:>10}"
+                  f"{latency['p95']:>10}{latency['p99']:>10}{summary['errors']:>8}")
+
+
+def main(args: argparse.Namespace) -> None:
+    '''Main function benchmarking the catalogue UI.
+
+    Args:
+        args (argparse.Namespace): Carries terminal arguments from argparse().
+    '''
+    # The UI reads the benchmark database and caches into a scratch directory
+    os.environ["METACAT_DB"] = args.database
+    os.environ["METACAT_CACHE_DIR"] = tempfile.mkdtemp(prefix="metacat_benchmark_")
+
+    if args.mock:
+        try:
+            import mongomock
+        except ImportError:
+            sys.exit("--mock requires mongomock: pip install mongomock")
+
+        mock.patch("pymongo.MongoClient", return_value=mongomock.MongoClient()).start()
+
+    # Set up before importing the app, which would otherwise set up its own
+    log = flib.setup_logging("logs", "catalogue_benchmark", "debug")
+    logging.getLogger(log)
+    ui = importlib.import_module("app")
+    ui.app.logger.disabled = True
+
+    mongo = MongoLib(log)
+    mongo.switch_db(args.database)
+    modalities = build_catalogue(mongo, args.modalities, args.tags, args.months, args.seed)
+    mongo.disconnect()
+
+    routes = list_routes(modalities)
+    results: Dict[str, Dict] = {}
+
+    if "test" in args.modes:
+        results["test"] = run_benchmark(ui, test_client_get(ui.app), routes, args)
+
+    if "http" in args.modes:
+        from waitress.server import create_server
+
+        server = create_server(ui.app, host="127.0.0.1", port=0, threads=args.clients)
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+
+        try:
+            results["http"] = run_benchmark(
+                ui, http_get(f"http://127.0.0.1:{server.effective_port}"), routes, args
+            )
+        finally:
+            server.close()
+
+    output = {"commit": git_commit(),
+              "date": datetime.today().strftime("%Y-%m-%d %H:%M:%S"),
+              "parameters": vars(args),
+              "results": results}
+
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        json.dump(output, output_file, indent=4)
+
+    print_summary(results)
+    logging.info("Saved benchmark results to %s", args.output)
+
+
+if __name__ == '__main__':
+    commands = argparser()
+    main(commands)
@@ -0,0 +1,248 @@
+'''Static export of the catalogue UI.
+   Renders every page and data endpoint of the UI, with the static assets,
+   into a directory that any static file server can serve read-only. Pages
+   are rendered in parallel, and a manifest of the sources of each page
+   lets later exports regenerate only the pages whose data changed.
+   Manifest, <OUTPUT>/manifest.json:
+   {
+       "version": <CATALOGUE VERSION>,
+       "pages": {<PATH>: {"source": <SOURCE>, "sha256": <CONTENT HASH>}}
+   }
+'''
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import logging
+import argparse
+from typing import Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import modules.file_lib as flib
+import modules.view_lib as vlib
+import _modules.functionality as funct
+
+# Set up before importing the app, which would otherwise log the export to
+# its own catalogue_ui log
+log = flib.setup_logging("logs", "catalogue_export", "debug")
+
+import app as ui  # noqa: E402 pylint: disable=C0413
+
+MANIFEST = "manifest.json"
+
+# Exported pages are recorded as current, so they must never be stale
+ui.SERVE_STALE = False
+
+
+def argparser() -> argparse.Namespace:
+    '''Terminal argument parser function.
+
+    Returns:
+        argparse.Namespace: Terminal arguments.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", "-o",
+                        help="Export directory. Default to export.",
+                        type=str, required=False, default="export")
+    parser.add_argument("--threads", "-t",
+                        help="Number of pages rendered at a time. Default to 8.",
+                        type=int, required=False, default=8)
+    parser.add_argument("--gzip", "-z",
+                        help=("Also write gzipped copies of the pages, for "
+                              "servers that serve precompressed files."),
+                        action="store_true")
+    parser.add_argument("--force", "-f",
+                        help=("Render every page, e.g. after changing the "
+                              "templates."), action="store_true")
+
+    return parser.parse_args()
+
+
+def list_pages(version: int) -> List[Tuple[str, str]]:
+    '''Lists the pages of the UI with the view they are built from.
+
+    Args:
+        version (int): Catalogue version.
+
+    Returns:
+        List[Tuple[str, str]]: [(<URL PATH>, <VIEW ID OR NONE>)]
+    '''
+    modalities = [mod["modality"] for mod in ui.get_mods(version) if mod.get("modality", None)]
+    pages = [("/", "index"), ("/api/report", "report"), ("/data/report", "report"),
+             ("/data/all/tag_stats", "report"), ("/data/modalities", "index"),
+             ("/api/all_tags", None), ("/api/labels", None), ("/data/labels", None),
+             ("/api/codes", None)]
+
+    for mod in modalities:
+        pages += [(f"/api/{mod}", f"modality/{mod}"), (f"/data/{mod}/counts", f"modality/{mod}"),
+                  (f"/data/{mod}/tag_stats", f"modality/{mod}"), (f"/api/{mod}/tags", None)]
+
+    return pages
+
+
+def page_sources(pages: List[Tuple[str, str]], version: int) -> Dict[str, str]:
+    '''Returns the source of each page, which changes when the data of the
+       page changes: the date of its view, or the catalogue version for
+       pages not built from a view.
+
+    Args:
+        pages (List[Tuple[str, str]]): Output of list_pages().
+        version (int): Catalogue version.
+
+    Returns:
+        Dict[str, str]: {<URL PATH>: <SOURCE>}
+    '''
+    conn = funct.get_db_connection(ui.log)
+    view_ids = sorted({view_id for _, view_id in pages if view_id})
+    dates = {view["_id"]: view.get("viewDate", None)
+             for view in conn.search(vlib.VIEWS, {"_id": {"$in": view_ids}}, {"viewDate": 1})}
+
+    return {path: f"view:{dates[view_id]}" if view_id in dates else f"version:{version}"
+            for path, view_id in pages}
+
+
+def file_path(output: str, path: str) -> str:
+    '''Returns the file of a page, an index.html for HTML pages so that
+       links to /api/<MODALITY> resolve on a static server.
+
+    Args:
+        output (str): Export directory.
+        path (str): URL path.
+
+    Returns:
+        str: File path.
+    '''
+    if path.startswith("/data/"):
+        return os.path.join(output, path.lstrip("/"))
+
+    return os.path.join(output, path.lstrip("/"), "index.html")
+
+
+def render_page(path: str) -> Optional[bytes]:
+    '''Renders a page through the UI. Tag tables are rendered client-side,
+       as a static export cannot page them on the server. Pages cached for
+       a previous catalogue version, e.g. by a running UI sharing the cache
+       directory, are recomputed rather than served stale.
+
+    Args:
+        path (str): URL path.
+
+    Returns:
+        Optional[bytes]: Page content, None if the page failed.
+    '''
+    with ui.app.test_client() as client:
+        response = client.get(path, query_string={"mode": "client"} if path.endswith("tags") else None)
+
+    if response.status_code != 200:
+        logging.error("Failed rendering %s: %s", path, response.status)
+        return None
+
+    return response.get_data()
+
+
+def write_page(output: str, path: str, content: bytes, compress: bool) -> None:
+    '''Writes a page, and its gzipped copy if requested.
+
+    Args:
+        output (str): Export directory.
+        path (str): URL path.
+        content (bytes): Page content.
+        compress (bool): Whether to write a gzipped copy.
+    '''
+    target = file_path(output, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+
+    with open(target, "wb") as page_file:
+        page_file.write(content)
+
+    if compress:
+        with open(f"{target}.gz", "wb") as page_file:
+            page_file.write(gzip.compress(content, 9, mtime=0))
+
+
+def export_page(output: str, path: str, compress: bool) -> Optional[str]:
+    '''Renders a page and writes it if its content changed.
+
+    Args:
+        output (str): Export directory.
+        path (str): URL path.
+        compress (bool): Whether to write a gzipped copy.
+
+    Returns:
+        Optional[str]: SHA-256 of the content, None if the page failed.
+    '''
+    content = render_page(path)
+
+    if content is None:
+        return None
+
+    sha = hashlib.sha256(content).hexdigest()
+    target = file_path(output, path)
+
+    if os.path.exists(target) and (not compress or os.path.exists(f"{target}.gz")):
+        with open(target, "rb") as page_file:
+            if hashlib.sha256(page_file.read()).hexdigest() == sha:
+                return sha
+
+    write_page(output, path, content, compress)
+
+    return sha
+
+
+def main(args: argparse.Namespace) -> None:
+    '''Main function exporting the catalogue UI.
+
+    Args:
+        args (argparse.Namespace): Carries terminal arguments from argparse().
+    '''
+    logging.getLogger(log)
+
+    output = args.output
+    manifest_path = os.path.join(output, MANIFEST)
+    manifest = {} if args.force or not os.path.exists(manifest_path) else flib.load_json(manifest_path)
+    exported: Dict[str, Dict] = manifest.get("pages", {})
+
+    with ui.app.app_context():
+        version = ui.catalogue_version()
+        pages = list_pages(version)
+        sources = page_sources(pages, version)
+
+    stale = [path for path, _ in pages
+             if exported.get(path, {}).get("source", None) != sources[path]
+             or not os.path.exists(file_path(output, path))]
+
+    logging.info("Exporting %s of %s pages to %s.", len(stale), len(pages), output)
+    shutil.copytree(ui.app.static_folder, os.path.join(output, "static"), dirs_exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=max(args.threads, 1)) as pool:
+        results = dict(zip(stale, pool.map(lambda path: export_page(output, path, args.gzip), stale)))
+
+    for path, sha in results.items():
+        if sha is None:
+            exported.pop(path, None)
+        else:
+            exported[path] = {"source": sources[path], "sha256": sha}
+
+    # Pages of modalities no longer in the catalogue
+    for path in set(exported) - set(sources):
+        exported.pop(path)
+
+        for target in (file_path(output, path), f"{file_path(output, path)}.gz"):
+            if os.path.exists(target):
+                os.remove(target)
+
+    with open(manifest_path, "w", encoding="utf-8") as manifest_file:
+        json.dump({"version": version, "pages": exported}, manifest_file, indent=4)
+
+    failed = [path for path, sha in results.items() if sha is None]
+
+    if failed:
+        logging.warning("Pages %s failed and will be rendered on the next export.", failed)
+
+    logging.info("Exported %s pages, %s unchanged.", len(results) - len(failed),
+                 len(pages) - len(stale))
+
+
+if __name__ == '__main__':
+    commands = argparser()
+    main(commands)
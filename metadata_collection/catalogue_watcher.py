@@ -0,0 +1,588 @@
+'''Catalogue watcher.
+   Long-running process that follows the change streams of the raw series or
+   image collections and applies inserted and deleted documents as deltas to
+   the raw counts of the catalogue, instead of recounting the collections.
+   Updated modality-level attributes:
+   {
+       "totalNoImagesRaw": "<COUNT>",
+       "totalNoSeriesRaw": "<COUNT>",
+       "totalNoStudiesRaw": "<COUNT>",
+       "countsPerMonthRaw": [
+           {"date": "<YYYY/M>",
+            "imageCount": "<COUNT>",
+            "seriesCount": "<COUNT>",
+            "studyCount": "<COUNT>"
+           }
+       ],
+       "tags": [{"tag": "<TAG>"}],
+       "countsDateRaw": "<TIMESTAMP>",
+       "watcherTokens": {"<PACS_DB>:<ON>": "<LAST APPLIED TOKEN>"}
+   }
+   Averages and spreads are left to the periodic mongo_counts.py run.
+'''
+import time
+import signal
+import argparse
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+from datetime import datetime
+import pymongo
+import modules.file_lib as flib
+import modules.view_lib as vlib
+from modules.mongo_lib import MongoLib
+
+# Catalogue collection holding the resume tokens of the watchers
+WATCHER_STATE = "watcher_state"
+
+
+def argparser() -> argparse.Namespace:
+    '''Terminal argument parser function.
+
+    Returns:
+        argparse.Namespace: Terminal arguments.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pacsdb", "-d",
+                        help="Name of PACS database. Default to analytics.",
+                        type=str, required=False, default="analytics")
+    parser.add_argument("--on", "-o",
+                        help=("What collections to follow, as counted by "
+                              "mongo_counts.py. Default to series."), type=str,
+                        required=False, choices=["series", "modality"],
+                        default="series")
+    parser.add_argument("--cataloguedb", "-c",
+                        help="Name of catalogue database. Default to analytics.",
+                        type=str, required=False, default="analytics")
+    parser.add_argument("--batch-size", "-b",
+                        help=("Maximum number of changes applied at once. "
+                              "Default to 1000."), type=int, required=False,
+                        default=1000)
+    parser.add_argument("--interval", "-i",
+                        help=("Maximum number of seconds a change waits before "
+                              "being applied. Default to 5."), type=float,
+                        required=False, default=5.0)
+    parser.add_argument("--views-interval", "-v",
+                        help=("Minimum number of seconds between refreshes of "
+                              "the catalogue UI views. Default to 300."),
+                        type=float, required=False, default=300.0)
+    parser.add_argument("--reset",
+                        help=("Discard the stored resume token and follow "
+                              "changes from now on. Run mongo_counts.py "
+                              "first to bring the counts up to date."),
+                        action="store_true")
+    parser.add_argument("--enable-pre-images",
+                        help=("Record pre-images on the followed collections "
+                              "so that deleted documents can be counted."),
+                        action="store_true")
+    parser.add_argument("--log", "-l",
+                        help=("Log directory path. Default to current"
+                              " directory."),
+                        type=str, required=False, default=".")
+
+    return parser.parse_args()
+
+
+def prepare_pipeline(extract_on: str) -> List[Dict]:
+    '''Prepares the pipeline filtering the change events of the followed
+       collections.
+
+    Args:
+        extract_on (str): series or modality.
+
+    Returns:
+        List[Dict]: Change stream pipeline.
+    '''
+    if extract_on == "series":
+        collections: Dict = {"ns.coll": "series"}
+    else:
+        collections = {"ns.coll": {"$regex": "^image_"}}
+
+    return [
+        {"$match": {
+            "$or": [
+                {"operationType": {"$in": ["insert", "delete", "drop", "rename"]},
+                 **collections},
+                {"operationType": {"$in": ["dropDatabase", "invalidate"]}}
+            ]
+        }}
+    ]
+
+
+def event_document(event: Dict) -> Optional[Dict]:
+    '''Returns the inserted or deleted document of a change event.
+
+    Args:
+        event (Dict): Change event.
+
+    Returns:
+        Optional[Dict]: Document, None for a delete without pre-image.
+    '''
+    return event.get("fullDocument", None) or event.get("fullDocumentBeforeChange", None)
+
+
+def unapplied_events(catalogue: MongoLib, state_id: str,
+                     events: List[Dict]) -> Tuple[List[Dict], Dict[str, str]]:
+    '''Drops the events already applied to the counts of their modality,
+       and returns the last token of the remaining events per modality.
+       Resume tokens sort in the order of the change stream. Deletes
+       without pre-image are kept, as they are only reported.
+
+    Args:
+        catalogue (MongoLib): MongoLib instance using the catalogue database.
+        state_id (str): Watcher identifier.
+        events (List[Dict]): Change events.
+
+    Returns:
+        Tuple[List[Dict], Dict[str, str]]: (<EVENTS>, {<MODALITY>: <TOKEN>})
+    '''
+    docs = [event_document(event) for event in events]
+    modalities = list({doc.get("Modality", None) for doc in docs if doc})
+    applied = {
+        mod.get("modality", None): mod.get("watcherTokens", {}).get(state_id, "")
+        for mod in catalogue.search("modalities", {"modality": {"$in": modalities}},
+                                    {"modality": 1, f"watcherTokens.{state_id}": 1})
+    }
+    pending: List[Dict] = []
+    tokens: Dict[str, str] = {}
+
+    for event, doc in zip(events, docs):
+        if not doc:
+            pending.append(event)
+            continue
+
+        mod = doc.get("Modality", None)
+        token = event["_id"]["_data"]
+
+        if token > applied.get(mod, ""):
+            pending.append(event)
+            tokens[mod] = max(token, tokens.get(mod, ""))
+
+    return pending, tokens
+
+
+def split_events(events: List[Dict]) -> Tuple[Dict, Dict, int]:
+    '''Splits a batch of change events into inserted and deleted documents
+       per collection. Documents inserted and deleted within the batch
+       cancel out.
+
+    Args:
+        events (List[Dict]): Change events.
+
+    Returns:
+        Tuple[Dict, Dict, int]: ({<COLLECTION>: [<INSERTED_DOC>]},
+                                 {<COLLECTION>: [<DELETED_DOC>]},
+                                 <NUMBER OF DELETES WITHOUT PRE-IMAGE>)
+    '''
+    inserted: Dict[Tuple, Dict] = {}
+    deleted: Dict[Tuple, Dict] = {}
+    unknown = 0
+
+    for event in events:
+        collection = event["ns"]["coll"]
+        key = (collection, event["documentKey"]["_id"])
+
+        if event["operationType"] == "insert":
+            inserted[key] = event["fullDocument"]
+        elif event["operationType"] == "delete":
+            if key in inserted:
+                del inserted[key]
+            elif event.get("fullDocumentBeforeChange", None):
+                deleted[key] = event["fullDocumentBeforeChange"]
+            else:
+                unknown += 1
+
+    def _by_collection(docs):
+        grouped: Dict[str, List[Dict]] = {}
+
+        for (collection, _), doc in docs.items():
+            grouped.setdefault(collection, []).append(doc)
+
+        return grouped
+
+    return _by_collection(inserted), _by_collection(deleted), unknown
+
+
+def first_ids(mongo: MongoLib, collection: str, field: str,
+              docs: List[Dict]) -> Dict[Tuple, object]:
+    '''Returns the first _id currently stored for each modality and UID of
+       the given documents.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the PACS database.
+        collection (str): Collection name.
+        field (str): UID field, SeriesInstanceUID or StudyInstanceUID.
+        docs (List[Dict]): Changed documents.
+
+    Returns:
+        Dict[Tuple, object]: {(<MODALITY>, <UID>): <FIRST_ID>}
+    '''
+    # None would match every document missing the UID
+    uids = list({doc[field] for doc in docs if doc.get(field, None) is not None})
+
+    if not uids:
+        return {}
+
+    query = [
+        {"$match": {field: {"$in": uids}}},
+        {"$group": {
+            "_id": {"modality": "$Modality", "uid": f"${field}"},
+            "firstID": {"$min": "$_id"}
+        }}
+    ]
+
+    return {
+        (row["_id"].get("modality", None), row["_id"].get("uid", None)): row["firstID"]
+        for row in mongo.aggregate(collection, query)
+    }
+
+
+def collection_deltas(mongo: MongoLib, collection: str, inserted: List[Dict],
+                      deleted: List[Dict], deltas: Dict) -> None:
+    '''Adds the count deltas of the documents inserted into and deleted from
+       a collection. A series or study is new if its first stored document
+       was inserted in this batch, and removed if no document is left.
+       This relies on _id values growing with insertion time.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the PACS database.
+        collection (str): Collection name.
+        inserted (List[Dict]): Inserted documents.
+        deleted (List[Dict]): Deleted documents.
+        deltas (Dict): {<MODALITY>: {"images": <DELTA>, "series": <DELTA>,
+                                     "studies": <DELTA>,
+                                     "months": {<YYYY/M>: {"imageCount": ...,
+                                                           "seriesCount": ...,
+                                                           "studyCount": ...}}}},
+                       updated in place.
+    '''
+    def _add(doc, images, series, studies):
+        mod = deltas.setdefault(doc.get("Modality", None), {
+            "images": 0, "series": 0, "studies": 0, "months": {}
+        })
+        mod["images"] += images
+        mod["series"] += series
+        mod["studies"] += studies
+
+        month = flib.study_month(doc.get("StudyDate", None))
+
+        if month is not None:
+            counts = mod["months"].setdefault(month, {
+                "imageCount": 0, "seriesCount": 0, "studyCount": 0
+            })
+            counts["imageCount"] += images
+            counts["seriesCount"] += series
+            counts["studyCount"] += studies
+
+    def _images(doc):
+        if collection == "series":
+            return doc.get("header", {}).get("ImagesInSeries", None) or 0
+
+        return 1
+
+    changed = inserted + deleted
+    series_ids = first_ids(mongo, collection, "SeriesInstanceUID", changed)
+    study_ids = first_ids(mongo, collection, "StudyInstanceUID", changed)
+    seen: Set[Tuple] = set()
+
+    for doc in inserted:
+        series = (doc.get("Modality", None), doc.get("SeriesInstanceUID", None))
+        study = (doc.get("Modality", None), doc.get("StudyInstanceUID", None))
+        new_series = series_ids.get(series, None) == doc["_id"]
+        new_study = study_ids.get(study, None) == doc["_id"]
+
+        _add(doc, _images(doc), int(new_series), int(new_study))
+
+    for doc in deleted:
+        series = (doc.get("Modality", None), doc.get("SeriesInstanceUID", None))
+        study = (doc.get("Modality", None), doc.get("StudyInstanceUID", None))
+        removed_series = series not in series_ids and ("series", series) not in seen
+        removed_study = study not in study_ids and ("study", study) not in seen
+        seen.update({("series", series), ("study", study)})
+
+        _add(doc, -_images(doc), -int(removed_series), -int(removed_study))
+
+
+def new_tags(inserted: Dict[str, List[Dict]], known: Dict[str, Set[str]]) -> Dict[str, Set[str]]:
+    '''Returns the fields of inserted documents not yet in the catalogue,
+       and adds them to the known fields.
+
+    Args:
+        inserted (Dict[str, List[Dict]]): Inserted documents per collection.
+        known (Dict[str, Set[str]]): Known tags per modality, updated in place.
+
+    Returns:
+        Dict[str, Set[str]]: {<MODALITY>: {<TAG>}}
+    '''
+    tags: Dict[str, Set[str]] = {}
+
+    for docs in inserted.values():
+        for doc in docs:
+            mod = doc.get("Modality", None)
+            unseen = set(doc.keys()).difference(known.setdefault(mod, set()))
+
+            if unseen:
+                tags.setdefault(mod, set()).update(unseen)
+                known[mod].update(unseen)
+
+    return tags
+
+
+def prepare_updates(deltas: Dict, tags: Dict[str, Set[str]], state_id: str,
+                    tokens: Dict[str, str]) -> Tuple[List, List]:
+    '''Prepares the catalogue writes applying the deltas and new tags.
+       Missing modalities and months are added first, which is idempotent,
+       and the deltas, new tags and last applied token of each modality are
+       then written in a single update, so that a replayed batch is either
+       fully applied or skipped. Months are matched as padded and unpadded
+       dates.
+
+    Args:
+        deltas (Dict): Output of collection_deltas().
+        tags (Dict[str, Set[str]]): Output of new_tags().
+        state_id (str): Watcher identifier.
+        tokens (Dict[str, str]): Last token of the batch per modality.
+
+    Returns:
+        Tuple[List, List]: (<MODALITIES WRITES>, <TAGS WRITES>)
+    '''
+    date = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+    mod_updates: List = []
+    tag_updates: List = []
+
+    for mod in set(deltas).union(tags):
+        delta = deltas.get(mod, {"images": 0, "series": 0, "studies": 0, "months": {}})
+        inc = {"totalNoImagesRaw": delta["images"],
+               "totalNoSeriesRaw": delta["series"],
+               "totalNoStudiesRaw": delta["studies"]}
+        array_filters = []
+
+        mod_updates.append(pymongo.UpdateOne(
+            {"modality": mod}, {"$setOnInsert": {"modality": mod}}, upsert=True
+        ))
+
+        for index, (month, counts) in enumerate(sorted(delta["months"].items())):
+            year, month_no = month.split("/")
+            dates = [month, f"{year}/{int(month_no):02d}"]
+
+            mod_updates.append(pymongo.UpdateOne(
+                {"modality": mod, "countsPerMonthRaw.date": {"$nin": dates}},
+                {"$push": {"countsPerMonthRaw": {
+                    "date": month, "imageCount": 0, "seriesCount": 0,
+                    "studyCount": 0
+                }}}
+            ))
+            inc.update({f"countsPerMonthRaw.$[month{index}].{key}": value
+                        for key, value in counts.items()})
+            array_filters.append({f"month{index}.date": {"$in": dates}})
+
+        update = {"$inc": inc,
+                  "$set": {"countsDateRaw": date,
+                           f"watcherTokens.{state_id}": tokens[mod]}}
+
+        if tags.get(mod, None):
+            update["$push"] = {"tags": {"$each": [{"tag": tag} for tag in sorted(tags[mod])]}}
+
+        mod_updates.append(pymongo.UpdateOne(
+            {"modality": mod}, update, array_filters=array_filters or None
+        ))
+
+    for mod, mod_tags in tags.items():
+        for tag in mod_tags:
+            tag_updates.append(pymongo.UpdateOne(
+                {"tag": tag}, {"$addToSet": {"modalities": mod}}, upsert=True
+            ))
+
+    return mod_updates, tag_updates
+
+
+def apply_batch(pacs: MongoLib, catalogue: MongoLib, events: List[Dict],
+                known: Dict[str, Set[str]], state_id: str) -> Set[str]:
+    '''Applies a batch of change events to the catalogue, skipping the
+       events already applied to their modality by an earlier run.
+
+    Args:
+        pacs (MongoLib): MongoLib instance using the PACS database.
+        catalogue (MongoLib): MongoLib instance using the catalogue database.
+        events (List[Dict]): Change events.
+        known (Dict[str, Set[str]]): Known tags per modality.
+        state_id (str): Watcher identifier.
+
+    Returns:
+        Set[str]: Modalities changed.
+    '''
+    pending, tokens = unapplied_events(catalogue, state_id, events)
+
+    if len(pending) < len(events):
+        logging.info("Skipped %s changes already applied.", len(events) - len(pending))
+
+    inserted, deleted, unknown = split_events(pending)
+
+    if unknown:
+        logging.warning(("%s deleted documents had no pre-image and were not "
+                         "counted. Run with --enable-pre-images and recount "
+                         "with mongo_counts.py."), unknown)
+
+    deltas: Dict = {}
+
+    for collection in set(inserted).union(deleted):
+        collection_deltas(pacs, collection, inserted.get(collection, []),
+                          deleted.get(collection, []), deltas)
+
+    # Modalities whose changes cancelled out only advance their token
+    deltas.update({mod: {"images": 0, "series": 0, "studies": 0, "months": {}}
+                   for mod in tokens if mod not in deltas})
+    mod_updates, tag_updates = prepare_updates(deltas, new_tags(inserted, known),
+                                               state_id, tokens)
+    catalogue.bulk_update("modalities", mod_updates)
+    catalogue.bulk_update("tags", tag_updates, ordered=False)
+
+    logging.info("Applied %s changes to %s modalities.", len(pending), len(deltas))
+
+    return {mod for mod in deltas if mod}
+
+
+def load_known_tags(catalogue: MongoLib) -> Dict[str, Set[str]]:
+    '''Returns the tags already in the catalogue per modality.
+
+    Args:
+        catalogue (MongoLib): MongoLib instance using the catalogue database.
+
+    Returns:
+        Dict[str, Set[str]]: {<MODALITY>: {<TAG>}}
+    '''
+    return {
+        mod["modality"]: {tag["tag"] for tag in mod.get("tags", [])}
+        for mod in catalogue.search("modalities", {}, {"modality": 1, "tags.tag": 1})
+    }
+
+
+def load_token(catalogue: MongoLib, state_id: str) -> Optional[Dict]:
+    '''Returns the resume token stored for a watcher.
+
+    Args:
+        catalogue (MongoLib): MongoLib instance using the catalogue database.
+        state_id (str): Watcher identifier.
+
+    Returns:
+        Optional[Dict]: Resume token, None if there is none.
+    '''
+    for state in catalogue.search(WATCHER_STATE, {"_id": state_id}):
+        return state.get("resumeToken", None)
+
+    return None
+
+
+def save_token(catalogue: MongoLib, state_id: str, token: Optional[Dict]) -> None:
+    '''Stores the resume token of a watcher.
+
+    Args:
+        catalogue (MongoLib): MongoLib instance using the catalogue database.
+        state_id (str): Watcher identifier.
+        token (Optional[Dict]): Resume token.
+    '''
+    if token is None:
+        return
+
+    catalogue.upsert_obj(
+        {}, WATCHER_STATE, {"_id": state_id},
+        {"$set": {"resumeToken": token,
+                  "tokenDate": datetime.today().strftime("%Y-%m-%d %H:%M:%S")}}
+    )
+
+
+def main(args: argparse.Namespace) -> None:
+    '''Main function following the raw collections. Changes are gathered
+       until batch_size changes or interval seconds are reached, applied to
+       the catalogue, and only then is the resume token stored. A crash
+       between the two writes replays the last batch on restart, whose
+       changes are skipped for the modalities that already applied them.
+
+    Args:
+        args (argparse.Namespace): Carries terminal arguments from argparse().
+    '''
+    pacsdb = args.pacsdb
+    extract_on = args.on
+    cataloguedb = args.cataloguedb
+    log_path = args.log
+
+    log = flib.setup_logging(log_path, "catalogue_watcher", "debug")
+    logging.getLogger(log)
+
+    pacs = MongoLib(log)
+    pacs.switch_db(pacsdb)
+    catalogue = MongoLib(log)
+    catalogue.switch_db(cataloguedb)
+
+    if args.enable_pre_images:
+        for collection in pacs.list_collections():
+            if extract_on == "series":
+                followed = collection == "series"
+            else:
+                followed = "image_" in collection
+
+            if followed:
+                pacs.enable_pre_images(collection)
+
+    state_id = f"{pacsdb}:{extract_on}"
+    token = None if args.reset else load_token(catalogue, state_id)
+    known = load_known_tags(catalogue)
+    stop = []
+
+    # Stop between batches rather than in the middle of catalogue writes
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop.append(signum))
+
+    stream = pacs.watch(prepare_pipeline(extract_on), resume_after=token,
+                        batch_size=args.batch_size,
+                        full_document_before_change="whenAvailable")
+    events: List[Dict] = []
+    started = 0.0
+    changed: Set[str] = set()
+    refreshed = time.monotonic()
+
+    logging.info("Following %s in %s from %s.", extract_on, pacsdb,
+                 "stored token" if token else "now")
+
+    with stream:
+        while not stop and stream.alive:
+            event = stream.try_next()
+
+            if event is not None:
+                if event["operationType"] in ("insert", "delete"):
+                    if not events:
+                        started = time.monotonic()
+
+                    events.append(event)
+                else:
+                    logging.warning(("%s of %s: counts are stale, rerun "
+                                     "mongo_counts.py."),
+                                    event["operationType"],
+                                    event.get("ns", {}).get("coll", pacsdb))
+
+            if events and (stop or len(events) >= args.batch_size or
+                           time.monotonic() - started >= args.interval):
+                changed |= apply_batch(pacs, catalogue, events, known, state_id)
+                events = []
+                catalogue.flush_version()
+
+            if changed and (stop or time.monotonic() - refreshed >= args.views_interval):
+                # Views that failed to refresh are retried at the next interval
+                if vlib.refresh_views(catalogue, changed):
+                    changed = set()
+
+                catalogue.flush_version()
+                refreshed = time.monotonic()
+
+            if not events and stream.resume_token != token:
+                token = stream.resume_token
+                save_token(catalogue, state_id, token)
+
+    logging.info("Stopped following %s in %s.", extract_on, pacsdb)
+
+    pacs.disconnect()
+    catalogue.disconnect()
+
+
+if __name__ == '__main__':
+    commands = argparser()
+    main(commands)
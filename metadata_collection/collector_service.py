@@ -0,0 +1,276 @@
+'''Collector service.
+   Runs the metadata collection scripts as steps of a long-running process,
+   each on its own interval, keeping the imports, logging and database
+   connections of the scripts warm between runs. A local control socket
+   reports the status of the steps and triggers them on demand.
+   Configuration file:
+   {
+       "socket": <CONTROL SOCKET PATH>,
+       "mysqlPoolSize": <CONNECTIONS>,
+       "steps": {
+           <STEP>: {"script": <SCRIPT NAME, DEFAULT TO STEP>,
+                    "args": [<TERMINAL ARGUMENT>],
+                    "interval": <SECONDS>,
+                    "jitter": <FRACTION OF INTERVAL>,
+                    "startup": <RUN ON START>}
+       }
+   }
+'''
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import argparse
+import importlib
+import logging
+import multiprocessing
+import threading
+import traceback
+import socketserver
+from typing import Dict, List
+from datetime import datetime
+import modules.file_lib as flib
+from modules.mongo_lib import MongoLib
+from modules.mysql_lib import MySQLib
+
+
+def argparser() -> argparse.Namespace:
+    '''Terminal argument parser function.
+
+    Returns:
+        argparse.Namespace: Terminal arguments.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", "-f",
+                        help=("Path of the JSON configuration file. Default "
+                              "to collector_service.json."), type=str,
+                        required=False, default="collector_service.json")
+    parser.add_argument("--status", "-s",
+                        help="Print the status of a running service.",
+                        action="store_true")
+    parser.add_argument("--run", "-r",
+                        help="Trigger a step of a running service.",
+                        type=str, required=False, default=None)
+    parser.add_argument("--log", "-l",
+                        help=("Log directory path. Default to current"
+                              " directory."),
+                        type=str, required=False, default=".")
+
+    return parser.parse_args()
+
+
+class Step:
+    '''Collection script run on an interval, never twice at the same time.
+    '''
+    def __init__(self, name: str, config: Dict):
+        self.name = name
+        self.script = config.get("script", name)
+        self.module = importlib.import_module(self.script)
+        self.args = self.parse_args(config.get("args", []))
+        self.interval = float(config["interval"])
+        self.jitter = float(config.get("jitter", 0.1))
+        self.lock = threading.Lock()
+        self.trigger = threading.Event()
+        self.next_run = time.time() if config.get("startup", False) else self.schedule()
+        self.status: Dict = {"runs": 0, "failures": 0, "lastStart": None,
+                             "lastEnd": None, "lastDuration": None, "lastError": None}
+
+    def parse_args(self, args: List[str]) -> argparse.Namespace:
+        '''Parses the terminal arguments of the step with the argparser()
+           of its script, once, at start up.
+
+        Args:
+            args (List[str]): Terminal arguments.
+
+        Returns:
+            argparse.Namespace: Arguments passed to the main() of the script.
+        '''
+        argv = sys.argv
+
+        try:
+            sys.argv = [f"{self.script}.py", *args]
+            return self.module.argparser()
+        finally:
+            sys.argv = argv
+
+    def schedule(self) -> float:
+        '''Returns the time of the next run, one interval from now, moved
+           by a random jitter so that steps sharing an interval spread out.
+
+        Returns:
+            float: Timestamp.
+        '''
+        return time.time() + self.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def run(self) -> bool:
+        '''Runs the script of the step unless it is already running.
+
+        Returns:
+            bool: Whether the step ran.
+        '''
+        if not self.lock.acquire(blocking=False):
+            logging.warning("Step %s is already running, skipped.", self.name)
+            return False
+
+        try:
+            start = time.time()
+            self.status["lastStart"] = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+            logging.info("Running step %s.", self.name)
+
+            try:
+                self.module.main(self.args)
+                self.status["lastError"] = None
+            except (Exception, SystemExit) as error:
+                self.status["failures"] += 1
+                self.status["lastError"] = repr(error)
+                logging.error("Step %s failed: %s\n%s", self.name, error,
+                              traceback.format_exc())
+
+            self.status["runs"] += 1
+            self.status["lastEnd"] = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+            self.status["lastDuration"] = round(time.time() - start, 1)
+            logging.info("Step %s finished in %ss.", self.name, self.status["lastDuration"])
+        finally:
+            self.lock.release()
+
+        return True
+
+    def loop(self, stop: threading.Event) -> None:
+        '''Runs the step on its interval, or when triggered, until stopped.
+
+        Args:
+            stop (threading.Event): Set to stop the service.
+        '''
+        while not stop.is_set():
+            self.trigger.wait(max(self.next_run - time.time(), 0))
+
+            if stop.is_set():
+                break
+
+            self.trigger.clear()
+            self.run()
+            self.next_run = self.schedule()
+
+    def describe(self) -> Dict:
+        '''Returns the status of the step.
+
+        Returns:
+            Dict: Step status.
+        '''
+        return {
+            "script": self.script,
+            "running": self.lock.locked(),
+            "interval": self.interval,
+            "nextRun": datetime.fromtimestamp(self.next_run).strftime("%Y-%m-%d %H:%M:%S"),
+            **self.status
+        }
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    '''Handles a command of the control socket, one JSON line in reply.
+       Commands: "status" and "run <STEP>".
+    '''
+    def handle(self):
+        steps: Dict[str, Step] = self.server.steps
+        command = self.rfile.readline().decode("utf-8").split()
+
+        if command == ["status"]:
+            reply = {step.name: step.describe() for step in steps.values()}
+        elif len(command) == 2 and command[0] == "run" and command[1] in steps:
+            step = steps[command[1]]
+            reply = {"triggered": command[1], "running": step.lock.locked()}
+            step.trigger.set()
+        else:
+            reply = {"error": f"Unknown command {' '.join(command)}. Use 'status' "
+                              f"or 'run <STEP>' with a step of {sorted(steps)}."}
+
+        self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+
+
+def send_command(path: str, command: str) -> Dict:
+    '''Sends a command to the control socket of a running service.
+
+    Args:
+        path (str): Control socket path.
+        command (str): Command, e.g. status.
+
+    Returns:
+        Dict: Reply.
+    '''
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(command.encode("utf-8") + b"\n")
+
+        with client.makefile("rb") as reply:
+            return json.loads(reply.readline())
+
+
+def main(args: argparse.Namespace) -> None:
+    '''Main function running the collector service, or sending a command to
+       a running service.
+
+    Args:
+        args (argparse.Namespace): Carries terminal arguments from argparse().
+    '''
+    config = flib.load_json(args.config)
+    path = config.get("socket", "collector_service.sock")
+
+    if args.status or args.run:
+        print(json.dumps(send_command(path, "status" if args.status else f"run {args.run}"),
+                         indent=4))
+        return
+
+    log = flib.setup_logging(args.log, "collector_service", "debug")
+    logging.getLogger(log)
+
+    # Steps start process pools from a multithreaded process, where forking
+    # can copy locks held by other threads, e.g. those of the Mongo client
+    multiprocessing.set_start_method("spawn", force=True)
+    MongoLib.share_client()
+    MySQLib.share_connections(config.get("mysqlPoolSize", 5))
+
+    steps = {name: Step(name, step) for name, step in config["steps"].items()}
+    stop = threading.Event()
+
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop.set())
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = socketserver.ThreadingUnixStreamServer(path, ControlHandler)
+    server.daemon_threads = True
+    server.steps = steps
+    os.chmod(path, 0o600)
+
+    threads = [threading.Thread(target=server.serve_forever, daemon=True)]
+    threads += [threading.Thread(target=step.loop, args=[stop], name=name)
+                for name, step in steps.items()]
+
+    for thread in threads:
+        thread.start()
+
+    logging.info("Collector service running %s, control socket %s.",
+                 sorted(steps), path)
+    while not stop.wait(1):
+        pass
+
+    # Running steps finish before the service stops
+    logging.info("Stopping collector service.")
+    server.shutdown()
+    server.server_close()
+    os.remove(path)
+
+    for step in steps.values():
+        step.trigger.set()
+
+    for thread in threads[1:]:
+        thread.join()
+
+
+if __name__ == '__main__':
+    commands = argparser()
+    main(commands)
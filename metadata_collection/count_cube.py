@@ -0,0 +1,479 @@
+'''Count cube.
+   Builds image, series and study counts per modality, study day and every
+   subset of a configurable list of categorical tags in a single pass over
+   a raw collection, and stores them in columnar chunks of the count_cube
+   collection. Counts by week, month or year and by any subset of the
+   tags are then rolled up from the cube without reading raw data.
+   Chunk document, one cuboid (tag subset) per document:
+   {
+       "_id": {"collection": <COLLECTION>, "build": <BUILD ID>,
+               "modality": <MODALITY>, "dimensions": [<TAG>],
+               "year": <YYYY>, "part": <NUMBER>},
+       "dimensions": [<TAG>],
+       "day": [<YYYYMMDD>],
+       "values": {<TAG>: [<VALUE CODE>]},
+       "dictionary": {<TAG>: [<VALUE>]},
+       "imageCount": [<COUNT>],
+       "seriesCount": [<COUNT>],
+       "studyCount": [<COUNT>],
+       "cubeDate": <TIMESTAMP>
+   }
+   Current build of each collection, in the count_cube_builds collection:
+   {"_id": <COLLECTION>, "build": <BUILD ID>, "cubeDate": <TIMESTAMP>}
+'''
+import argparse
+import logging
+from itertools import groupby
+from typing import Dict, Iterable, List, Tuple
+from datetime import datetime
+import bson
+from bson import ObjectId
+import modules.file_lib as flib
+from modules.mongo_lib import MongoLib
+
+# Catalogue collection holding the cube chunks
+CUBE = "count_cube"
+# Catalogue collection holding the current build of each collection
+CUBE_BUILDS = "count_cube_builds"
+# Maximum number of cells per chunk document
+CHUNK_SIZE = 50000
+# Maximum encoded size of a chunk document, well below the 16MB BSON limit
+CHUNK_BYTES = 8 * 1024 * 1024
+
+
+def argparser() -> argparse.Namespace:
+    '''Terminal argument parser function.
+
+    Returns:
+        argparse.Namespace: Terminal arguments.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pacsdb", "-d",
+                        help="Name of PACS database. Default to analytics.",
+                        type=str, required=False, default="analytics")
+    parser.add_argument("--on", "-o",
+                        help=("What collections to build or roll up the cube "
+                              "from. Default to series."), type=str,
+                        required=False, choices=["series", "modality"],
+                        default="series")
+    parser.add_argument("--dimensions", "-t",
+                        help=("Categorical tags of the cube, each added tag "
+                              "doubling its size. Default to "
+                              "Manufacturer and BodyPartExamined."), type=str,
+                        required=False, nargs="+",
+                        default=["Manufacturer", "BodyPartExamined"])
+    parser.add_argument("--cataloguedb", "-c",
+                        help="Name of catalogue database. Default to analytics.",
+                        type=str, required=False, default="analytics")
+    parser.add_argument("--rollup", "-r",
+                        help=("Roll the stored cube up instead of building it."),
+                        action="store_true")
+    parser.add_argument("--granularity", "-g",
+                        help="Time granularity of the roll-up. Default to month.",
+                        type=str, required=False,
+                        choices=["day", "week", "month", "year"], default="month")
+    parser.add_argument("--by", "-b",
+                        help=("Tags kept by the roll-up. Default to none, "
+                              "counts per modality and date only."), type=str,
+                        required=False, nargs="*", default=[])
+    parser.add_argument("--modality", "-m",
+                        help="Modality to roll up. Default to all.",
+                        type=str, required=False, default="all")
+    parser.add_argument("--output", "-f",
+                        help=("Path of the roll-up JSON output. "
+                              "Default to count_cube.json."), type=str,
+                        required=False, default="count_cube.json")
+    parser.add_argument("--log", "-l",
+                        help=("Log directory path. Default to current"
+                              " directory."),
+                        type=str, required=False, default=".")
+
+    return parser.parse_args()
+
+
+def prepare_cube(collection: str, dimensions: List[str]) -> List[Dict]:
+    '''Prepares the pipeline grouping a collection into one row per cube
+       cell and series, sorted by study.
+
+    Args:
+        collection (str): Collection name.
+        dimensions (List[str]): Categorical tags.
+
+    Returns:
+        List[Dict]: Aggregation pipeline.
+    '''
+    if collection == "series":
+        image_count = "$header.ImagesInSeries"
+    else:
+        image_count = 1
+
+    return [
+        {"$group": {
+            "_id": {"modality": "$Modality", "day": "$StudyDate",
+                    **{f"dim{i}": f"${dim}" for i, dim in enumerate(dimensions)},
+                    "studyID": "$StudyInstanceUID",
+                    "seriesID": "$SeriesInstanceUID"},
+            "imageCount": {"$sum": image_count}
+        }},
+        {"$sort": {"_id.studyID": 1}}
+    ]
+
+
+def dimension_value(value) -> str:
+    '''Returns the cube value of a tag, joining multi-valued tags such as
+       ImageType with backslashes as in DICOM.
+
+    Args:
+        value: Tag value.
+
+    Returns:
+        str: Value, empty if missing.
+    '''
+    if value is None:
+        return ""
+
+    if isinstance(value, list):
+        return "\\".join(str(item) for item in value)
+
+    return str(value)
+
+
+def cuboids(dimensions: List[str]) -> List[Tuple[int, ...]]:
+    '''Returns the positions of the tags kept by every cuboid of the cube.
+
+    Args:
+        dimensions (List[str]): Categorical tags.
+
+    Returns:
+        List[Tuple[int, ...]]: One tuple of tag positions per tag subset.
+    '''
+    return [tuple(i for i in range(len(dimensions)) if mask >> i & 1)
+            for mask in range(1 << len(dimensions))]
+
+
+def build_cells(rows: Iterable[Dict], dimensions: List[str]) -> Dict[Tuple, Dict[Tuple, List[int]]]:
+    '''Counts images, series and studies per cell of every cuboid. Rows of
+       a study are consecutive, so a series or study spanning several tag
+       values is counted once in each cuboid cell holding it, and only the
+       current study is held in memory.
+
+    Args:
+        rows (Iterable[Dict]): Output of the prepare_cube() pipeline.
+        dimensions (List[str]): Categorical tags.
+
+    Returns:
+        Dict[Tuple, Dict[Tuple, List[int]]]: {<KEPT TAG POSITIONS>: {
+            (<MODALITY>, <YYYYMMDD>, <VALUE>...): [<IMAGES>, <SERIES>, <STUDIES>]}}
+    '''
+    subsets = cuboids(dimensions)
+    cells: Dict[Tuple, Dict[Tuple, List[int]]] = {subset: {} for subset in subsets}
+
+    def _add_study(study_rows):
+        for subset in subsets:
+            subset_cells = cells[subset]
+            series = set()
+            studies = set()
+
+            for cell, series_id, images in study_rows:
+                key = (cell[0], cell[1], *(cell[2 + i] for i in subset))
+                counts = subset_cells.setdefault(key, [0, 0, 0])
+                counts[0] += images
+
+                if (key, series_id) not in series:
+                    series.add((key, series_id))
+                    counts[1] += 1
+
+                if key not in studies:
+                    studies.add(key)
+                    counts[2] += 1
+
+    for _, study_rows in groupby(rows, key=lambda row: row["_id"].get("studyID", None)):
+        parsed = []
+
+        for row in study_rows:
+            key = row["_id"]
+            day = str(key.get("day", None) or "")
+            cell = (key.get("modality", None) or "",
+                    int(day) if day.isdigit() and len(day) == 8 else 0,
+                    *(dimension_value(key.get(f"dim{i}", None)) for i in range(len(dimensions))))
+            parsed.append((cell, key.get("seriesID", None), row.get("imageCount", None) or 0))
+
+        _add_study(parsed)
+
+    return cells
+
+
+def chunk_document(collection: str, build: ObjectId, kept: List[str],
+                   mod: str, year: int, part: int, part_cells: List[Tuple],
+                   subset_cells: Dict[Tuple, List[int]], date: str) -> Dict:
+    '''Formats cells of a cuboid, modality and year as a columnar chunk
+       document, dictionary-encoding their tag values.
+
+    Args:
+        collection (str): Collection name.
+        build (ObjectId): Build ID.
+        kept (List[str]): Tags of the cuboid.
+        mod (str): Modality.
+        year (int): Study year.
+        part (int): Chunk number within the modality and year.
+        part_cells (List[Tuple]): Cells of the chunk.
+        subset_cells (Dict[Tuple, List[int]]): Counts of the cuboid cells.
+        date (str): Build timestamp.
+
+    Returns:
+        Dict: Chunk document.
+    '''
+    dictionary: Dict[str, Dict[str, int]] = {dim: {} for dim in kept}
+    values: Dict[str, List[int]] = {dim: [] for dim in kept}
+
+    for cell in part_cells:
+        for i, dim in enumerate(kept):
+            values[dim].append(dictionary[dim].setdefault(cell[2 + i], len(dictionary[dim])))
+
+    return {
+        "_id": {"collection": collection, "build": build, "modality": mod,
+                "dimensions": kept, "year": year, "part": part},
+        "dimensions": kept,
+        "day": [cell[1] for cell in part_cells],
+        "values": values,
+        "dictionary": {dim: list(codes) for dim, codes in dictionary.items()},
+        "imageCount": [subset_cells[cell][0] for cell in part_cells],
+        "seriesCount": [subset_cells[cell][1] for cell in part_cells],
+        "studyCount": [subset_cells[cell][2] for cell in part_cells],
+        "cubeDate": date
+    }
+
+
+def format_chunks(collection: str, dimensions: List[str],
+                  cells: Dict[Tuple, Dict[Tuple, List[int]]],
+                  build: ObjectId) -> List[Dict]:
+    '''Splits the cells of every cuboid into columnar chunk documents per
+       modality and year, of at most CHUNK_SIZE cells and CHUNK_BYTES
+       encoded. Chunks whose distinct tag values exceed CHUNK_BYTES are
+       halved until they fit.
+
+    Args:
+        collection (str): Collection name.
+        dimensions (List[str]): Categorical tags.
+        cells (Dict[Tuple, Dict[Tuple, List[int]]]): Output of build_cells().
+        build (ObjectId): Build ID.
+
+    Returns:
+        List[Dict]: Chunk documents.
+    '''
+    date = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+    chunks = []
+
+    for subset, subset_cells in cells.items():
+        kept = [dimensions[i] for i in subset]
+        groups: Dict[Tuple, List] = {}
+
+        for cell in sorted(subset_cells):
+            groups.setdefault((cell[0], cell[1] // 10000), []).append(cell)
+
+        for (mod, year), group in groups.items():
+            pending = [group[start:start + CHUNK_SIZE]
+                       for start in range(0, len(group), CHUNK_SIZE)]
+            part = 0
+
+            while pending:
+                part_cells = pending.pop(0)
+                chunk = chunk_document(collection, build, kept, mod, year, part,
+                                       part_cells, subset_cells, date)
+
+                if len(part_cells) > 1 and len(bson.encode(chunk)) > CHUNK_BYTES:
+                    half = len(part_cells) // 2
+                    pending[:0] = [part_cells[:half], part_cells[half:]]
+                    continue
+
+                chunks.append(chunk)
+                part += 1
+
+    return chunks
+
+
+def period(day: int, granularity: str) -> str:
+    '''Returns the period of a day at a given granularity. Months are
+       formatted as the monthly counts.
+
+    Args:
+        day (int): YYYYMMDD, 0 if unknown.
+        granularity (str): day, week, month or year.
+
+    Returns:
+        str: YYYY/M/D, YYYY-Www (ISO week), YYYY/M or YYYY, empty if unknown
+             or not a valid date, e.g. 20200230.
+    '''
+    if not day:
+        return ""
+
+    try:
+        date = datetime(day // 10000, day // 100 % 100, day % 100)
+    except ValueError:
+        return ""
+
+    if granularity == "year":
+        return str(date.year)
+
+    if granularity == "month":
+        return f"{date.year}/{date.month}"
+
+    if granularity == "week":
+        iso = date.isocalendar()
+        return f"{iso[0]}-W{iso[1]:02d}"
+
+    return f"{date.year}/{date.month}/{date.day}"
+
+
+def rollup_cube(chunks: Iterable[Dict], granularity: str, by: List[str]) -> List[Dict]:
+    '''Rolls the cuboid of the given tags up to a time granularity. All
+       counts are exact, a study having a single study date.
+
+    Args:
+        chunks (Iterable[Dict]): Stored chunk documents of the cuboid.
+        granularity (str): day, week, month or year.
+        by (List[str]): Tags of the cuboid.
+
+    Returns:
+        List[Dict]: [{"modality": <MODALITY>, "date": <PERIOD>,
+                      <TAG>: <VALUE>, "imageCount": <COUNT>,
+                      "seriesCount": <COUNT>, "studyCount": <COUNT>}]
+    '''
+    totals: Dict[Tuple, List[int]] = {}
+    periods: Dict[int, str] = {}
+
+    for chunk in chunks:
+        columns = [[chunk["dictionary"][dim][code] for code in chunk["values"][dim]]
+                   for dim in by]
+        mod = chunk["_id"]["modality"]
+
+        for i, day in enumerate(chunk["day"]):
+            if day not in periods:
+                periods[day] = period(day, granularity)
+
+            key = (mod, periods[day], *(column[i] for column in columns))
+            counts = totals.setdefault(key, [0, 0, 0])
+            counts[0] += chunk["imageCount"][i]
+            counts[1] += chunk["seriesCount"][i]
+            counts[2] += chunk["studyCount"][i]
+
+    return [
+        {"modality": key[0], "date": key[1], **dict(zip(by, key[2:])),
+         "imageCount": counts[0], "seriesCount": counts[1], "studyCount": counts[2]}
+        for key, counts in sorted(totals.items())
+    ]
+
+
+def cuboid_condition(on: str, by: List[str], builds: List[ObjectId],
+                     modality: str = "all") -> Dict:
+    '''Returns the condition selecting the chunks of the cuboid of the
+       given tags, in any order, from the current builds.
+
+    Args:
+        on (str): series or modality, the collections the cube was built from.
+        by (List[str]): Tags of the cuboid.
+        builds (List[ObjectId]): Current builds. Chunks stored before builds
+                                 were recorded have none.
+        modality (str, optional): Modality name. Defaults to all.
+
+    Returns:
+        Dict: Search condition.
+    '''
+    condition: Dict = {"dimensions": {"$size": len(by)},
+                       "_id.build": {"$in": [*builds, None]}}
+
+    if on == "series":
+        condition["_id.collection"] = "series"
+    else:
+        condition["_id.collection"] = {"$regex": "^image_"}
+
+    if by:
+        condition["dimensions"]["$all"] = by
+
+    if modality != "all":
+        condition["_id.modality"] = modality
+
+    return condition
+
+
+def build_wrapper(mongo: MongoLib, pacsdb: str, cataloguedb: str,
+                  collection: str, dimensions: List[str]) -> None:
+    '''Builds the cube of a collection and replaces its stored chunks.
+       The new chunks are inserted under a new build, which becomes current
+       once they are all stored, before the chunks of earlier builds are
+       removed. A failed build leaves the current one in place.
+
+    Args:
+        mongo (MongoLib): MongoLib instance.
+        pacsdb (str): PACS database name.
+        cataloguedb (str): Catalogue database name.
+        collection (str): Collection name.
+        dimensions (List[str]): Categorical tags.
+    '''
+    mongo.switch_db(pacsdb)
+    rows = mongo.aggregate(collection, prepare_cube(collection, dimensions),
+                           batch_size=10000)
+    cells = build_cells(rows, dimensions)
+    build = ObjectId()
+    chunks = format_chunks(collection, dimensions, cells, build)
+
+    mongo.switch_db(cataloguedb)
+
+    try:
+        if chunks:
+            mongo.insert_many(CUBE, chunks)
+    except Exception:
+        mongo.delete_many(CUBE, {"_id.collection": collection, "_id.build": build})
+        raise
+
+    mongo.upsert_obj({}, CUBE_BUILDS, {"_id": collection}, {"$set": {
+        "build": build, "cubeDate": datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+    }})
+    mongo.delete_many(CUBE, {"_id.collection": collection, "_id.build": {"$ne": build}})
+
+    logging.info("Stored %s cube cells of %s in %s chunks.",
+                 sum(len(subset_cells) for subset_cells in cells.values()),
+                 collection, len(chunks))
+
+
+def main(args: argparse.Namespace) -> None:
+    '''Main function building or rolling up the count cube.
+
+    Args:
+        args (argparse.Namespace): Carries terminal arguments from argparse().
+    '''
+    log = flib.setup_logging(args.log, "count_cube", "debug")
+    logging.getLogger(log)
+
+    mongo = MongoLib(log)
+
+    if args.rollup:
+        mongo.switch_db(args.cataloguedb)
+        builds = [state["build"] for state in mongo.search(CUBE_BUILDS, {})]
+        condition = cuboid_condition(args.on, args.by, builds, args.modality)
+        counts = rollup_cube(mongo.search(CUBE, condition), args.granularity, args.by)
+
+        if not counts:
+            logging.warning("No cube chunks for %s, build the cube with these "
+                            "dimensions first.", args.by)
+
+        flib.json_dump(counts, args.output)
+        logging.info("Saved %s rolled up counts to %s", len(counts), args.output)
+    else:
+        mongo.switch_db(args.pacsdb)
+
+        if args.on == "series":
+            collections = ["series"]
+        else:
+            collections = [col for col in mongo.list_collections() if "image_" in col]
+
+        for collection in collections:
+            build_wrapper(mongo, args.pacsdb, args.cataloguedb, collection,
+                          args.dimensions)
+
+    mongo.disconnect()
+
+
+if __name__ == '__main__':
+    commands = argparser()
+    main(commands)
@@ -2,6 +2,7 @@
 import argparse
 import logging
 import modules.file_lib as flib
+import modules.view_lib as vlib
 from modules.mongo_lib import MongoLib
 
 
@@ -93,6 +94,7 @@ def main(args: argparse.Namespace) -> None:
         mongo.create_index("modality_blocklist", "modality", uniq=True)
         mongo.upsert_modalities(modalities, "modality_blocklist")
 
+    vlib.refresh_views(mongo)
     mongo.disconnect()
 
 
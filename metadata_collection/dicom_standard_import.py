@@ -1,12 +1,18 @@
 '''Import DICOM standard metadata from
    https://github.com/innolitics/dicom-standard.
 '''
+import os
 import re
+import json
+import sqlite3
+import hashlib
 import argparse
 import logging
 from datetime import datetime
-from typing import Dict
+from typing import Dict, Iterator
 import modules.file_lib as flib
+import modules.standard_lib as slib
+import modules.view_lib as vlib
 from modules.mongo_lib import MongoLib
 
 
@@ -23,6 +29,15 @@ def argparser() -> argparse.Namespace:
     parser.add_argument("--cataloguedb", "-c",
                         help="Name of catalogue database. Default to analytics.",
                         type=str, required=False, default="analytics")
+    parser.add_argument("--artifact", "-a",
+                        help=("Path of the compiled standard lookup. Default "
+                              "to dicom_standard.sqlite in the files "
+                              "directory."), type=str, required=False,
+                        default=None)
+    parser.add_argument("--force",
+                        help=("Re-import even if neither the standard files "
+                              "nor the catalogue changed."),
+                        action="store_true")
     parser.add_argument("--log", "-l",
                         help=("Log directory path. Default to current "
                               "directory."), type=str, required=False,
@@ -31,6 +46,30 @@ def argparser() -> argparse.Namespace:
     return parser.parse_args()
 
 
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+
+# Standard metadata attributes excluded from the comparison with the catalogue
+IGNORED_ATTRS = ("_id", "tag", "standardDate")
+
+STANDARD_FILES = ("modalities.json", "tags.json", "tag_confidentiality.json",
+                  "modality_levels.json", "modality_tags.json")
+
+STAGING_SCHEMA = '''
+CREATE TABLE conf (tag TEXT PRIMARY KEY, meta TEXT) WITHOUT ROWID;
+CREATE TABLE descr (
+    tag TEXT PRIMARY KEY,
+    type TEXT,
+    description TEXT,
+    linkToStandard TEXT
+) WITHOUT ROWID;
+CREATE TABLE levels (
+    tag TEXT,
+    informationEntity TEXT,
+    PRIMARY KEY (tag, informationEntity)
+) WITHOUT ROWID;
+'''
+
+
 def remove_tags(text: str) -> str:
     '''Removes HTML tags from given string.
 
@@ -40,62 +79,122 @@ def remove_tags(text: str) -> str:
     Returns:
         str: Text with no HTML tags.
     '''
-    text_re = re.compile(r'<[^>]+>')
-    return text_re.sub('', text)
+    return HTML_TAG_RE.sub('', text)
 
 
-def import_modality_meta(database: str, log: str, filepath: str) -> None:
-    '''Get modality description, link to standard, and ciodID.
+def has_changed(current: Dict, new: Dict) -> bool:
+    '''Checks whether any standard metadata attribute differs between a
+       catalogue document and newly extracted metadata.
 
     Args:
-        filepath (str): Path to modalities DICOM standard metadata file.
-        mods (List[Dict]): Modalities metadata from catalogue.
+        current (Dict): Catalogue document.
+        new (Dict): Standard metadata.
 
     Returns:
-        List[Dict]: Modalities metadata + description and ID.
+        bool: True if at least one attribute is new or different.
+    '''
+    return any(
+        current.get(key) != value
+        for key, value in new.items() if key not in IGNORED_ATTRS
+    )
+
+
+def get_modality_std(filepath: str) -> Iterator[Dict]:
+    '''Extracts modality description, link to standard, and ciodID.
+
+    Args:
+        filepath (str): Path to modalities DICOM standard metadata file.
+
+    Yields:
+        Dict: {"name": <STANDARD_NAME>, "dicomID": <CIOD_ID>,
+               "description": <DESCRIPTION>, "linkToStandard": <LINK>}
+    '''
+    for mod_std in flib.iter_json(filepath):
+        yield {
+            "name": mod_std["name"],
+            "dicomID": mod_std["id"],
+            "description": remove_tags(mod_std["description"]),
+            "linkToStandard": mod_std["linkToStandard"]
+        }
+
+
+def import_modality_meta(database: str, log: str,
+                         lookup: slib.StandardLookup) -> None:
+    '''Get modality description, link to standard, and ciodID. Only
+       modalities whose standard metadata changed are written back.
+
+    Args:
+        database (str): Name of database to upsert modality metadata to.
+        log (str): Log name.
+        lookup (StandardLookup): Compiled standard lookup.
     '''
     mongo = MongoLib(log)
     mongo.switch_db(database)
-    mods = list(mongo.search("modalities", {}, {"modality": 1}))
-    mods_std = flib.load_json(filepath)
+    mods = list(mongo.search(
+        "modalities", {},
+        {"modality": 1, "dicomID": 1, "description": 1, "linkToStandard": 1}
+    ))
+    updated = []
 
     for mod in mods:
-        for mod_std in mods_std:
-            if f"{mod['modality']} Image" == mod_std["name"]:
-                logging.info("Extracting modality %s details...",
-                             mod['modality'])
+        mod_std = lookup.modality_meta(f"{mod['modality']} Image")
+
+        if mod_std is None:
+            continue
+
+        logging.info("Extracting modality %s details...", mod["modality"])
 
-                mod["dicomID"] = mod_std["id"]
-                mod["description"] = remove_tags(mod_std["description"])
-                mod["linkToStandard"] = mod_std["linkToStandard"]
-                mod["standardDate"] = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+        mod_meta = {key: value for key, value in mod_std.items() if key != "name"}
+        mod_meta["modality"] = mod["modality"]
 
-    mongo.upsert_modalities(mods, "modalities")
+        if has_changed(mod, mod_meta):
+            mod_meta["standardDate"] = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+            updated.append(mod_meta)
+
+    logging.info("%s modalities with new standard metadata.", len(updated))
+    mongo.bulk_upsert(updated, "modalities", "modality")
     mongo.disconnect()
 
 
-def get_tags_conf(tags_file: str, conf_file: str) -> Dict:
-    '''Merges tag and tag confidentiality metadata.
+def get_catalogue_tags(database: str, log: str) -> Dict[str, Dict]:
+    '''Returns the catalogue tags that can receive standard metadata,
+       i.e. tags that are not blocked.
 
     Args:
-        tags_file (str): Tag metadata filename.
-        conf_file (str): Tag confidentiality filename.
+        database (str): Name of catalogue database.
+        log (str): Log name.
 
     Returns:
-        Dict: Tag metadata.
+        Dict[str, Dict]: {<TAG_NAME>: <TAG_DOCUMENT>}
     '''
-    logging.info("Getting tags confidentiality information...")
-    tags = flib.load_json(tags_file)
-    tags_conf = flib.load_json(conf_file)
-
-    for tag in tags:
-        for tag_conf in tags_conf:
-            if tag["tag"] == tag_conf["tag"]:
-                tag.update(tag_conf)
+    mongo = MongoLib(log)
+    mongo.switch_db(database)
+    tags = {
+        tag["tag"]: tag for tag in mongo.search("tags", {}, {"modalities": 0})
+        if tag.get("promotionStatus", None) != "blocked"
+    }
+    mongo.disconnect()
 
     return tags
 
 
+def stage_tags_conf(staging: sqlite3.Connection, conf_file: str) -> None:
+    '''Stages tag confidentiality metadata by tag ID.
+
+    Args:
+        staging (sqlite3.Connection): Staging database.
+        conf_file (str): Tag confidentiality filename.
+    '''
+    logging.info("Getting tags confidentiality information...")
+
+    for tag_conf in flib.iter_json(conf_file):
+        row = staging.execute("SELECT meta FROM conf WHERE tag = ?", (tag_conf["tag"],)).fetchone()
+        meta = json.loads(row[0]) if row else {}
+        meta.update(tag_conf)
+        staging.execute("INSERT OR REPLACE INTO conf VALUES (?, ?)",
+                        (tag_conf["tag"], json.dumps(meta)))
+
+
 def get_modules(mod_levels_file: str) -> Dict:
     '''Extracts modules and associated information entity from given file.
 
@@ -106,86 +205,246 @@ def get_modules(mod_levels_file: str) -> Dict:
         Dict: Modules and associated information entity.
     '''
     logging.info("Getting modules and their information entity...")
-    mod_levels = flib.load_json(mod_levels_file)
     modules: Dict = {}
 
-    for module in mod_levels:
-        if module["moduleId"] in modules:
-            modules[module["moduleId"]].append(module["informationEntity"])
-        else:
-            modules[module["moduleId"]] = [module["informationEntity"]]
+    for module in flib.iter_json(mod_levels_file):
+        modules.setdefault(module["moduleId"], set()).add(module["informationEntity"])
 
     return modules
 
 
-def get_tags_descr(tags: Dict, modules: Dict, mod_tags_file: str) -> Dict:
-    '''Adds tag descriptions to a given tag dictionary.
+def stage_tags_descr(staging: sqlite3.Connection, modules: Dict, mod_tags_file: str) -> None:
+    '''Stages tag descriptions and the information entities of the modules
+       of each tag by tag ID. The last description of a tag is kept, and the
+       last type other than "None".
 
     Args:
-        tags (Dict): Dictionary of tags.
+        staging (sqlite3.Connection): Staging database.
         modules (Dict): Dictionary of modules.
         mod_tags_file (str): Modules and tags filename.
-
-    Returns:
-        Dict: Tag metadata.
     '''
     logging.info("Getting tags description...")
-    mod_tags = flib.load_json(mod_tags_file)
 
-    for tag in tags:
-        levels = []
+    for mod_tag in flib.iter_json(mod_tags_file):
+        staging.execute(
+            "INSERT INTO descr VALUES (?, ?, ?, ?) ON CONFLICT (tag) DO UPDATE SET "
+            "type = COALESCE(excluded.type, type), description = excluded.description, "
+            "linkToStandard = excluded.linkToStandard",
+            (mod_tag["tag"], None if mod_tag["type"] == "None" else mod_tag["type"],
+             mod_tag["description"], mod_tag["linkToStandard"])
+        )
+        staging.executemany(
+            "INSERT OR IGNORE INTO levels VALUES (?, ?)",
+            ((mod_tag["tag"], level) for level in modules.get(mod_tag["moduleId"], ()))
+        )
+
+
+def get_tags_meta(staging: sqlite3.Connection, tags_file: str) -> Iterator[Dict]:
+    '''Merges each tag of the standard with its staged confidentiality
+       metadata, description and information entity.
+
+    Args:
+        staging (sqlite3.Connection): Staging database.
+        tags_file (str): Tag metadata filename.
+
+    Yields:
+        Dict: Tag metadata in catalogue format.
+    '''
+    for tag in flib.iter_json(tags_file):
+        conf = staging.execute("SELECT meta FROM conf WHERE tag = ?", (tag["tag"],)).fetchone()
+
+        if conf:
+            tag.update(json.loads(conf[0]))
 
-        for mod_tag in mod_tags:
-            if tag["tag"] == mod_tag["tag"]:
-                if mod_tag["type"] != "None":
-                    tag["type"] = mod_tag["type"]
+        descr = staging.execute(
+            "SELECT type, description, linkToStandard FROM descr WHERE tag = ?", (tag["tag"],)
+        ).fetchone()
 
-                tag["description"] = remove_tags(mod_tag["description"])
-                tag["linkToStandard"] = mod_tag["linkToStandard"]
+        if descr:
+            if descr[0] is not None:
+                tag["type"] = descr[0]
 
-                if mod_tag["moduleId"] in modules:
-                    levels += modules[mod_tag["moduleId"]]
+            tag["description"] = descr[1]
+            tag["linkToStandard"] = descr[2]
 
-        levels = list(set(levels))
+        if "description" in tag:
+            tag["description"] = remove_tags(tag["description"])
 
-        if levels:
-            if "Study" in levels:
+        tag_levels = {level for level, in staging.execute(
+            "SELECT informationEntity FROM levels WHERE tag = ?", (tag["tag"],)
+        )}
+
+        if tag_levels:
+            if "Study" in tag_levels:
                 tag["informationEntity"] = "Study"
-            elif "Series" in levels:
+            elif "Series" in tag_levels:
                 tag["informationEntity"] = "Series"
-            elif "Image" in levels:
+            elif "Image" in tag_levels:
                 tag["informationEntity"] = "Image"
             else:
-                tag["informationEntity"] = ', '.join(levels)
+                tag["informationEntity"] = ', '.join(sorted(tag_levels))
 
-    return tags
+        yield format_tag_meta(tag)
+
+
+def format_tag_meta(tag_meta: Dict) -> Dict:
+    '''Converts standard tag metadata to the catalogue tag format.
 
+    Args:
+        tag_meta (Dict): Standard tag metadata.
+
+    Returns:
+        Dict: Tag metadata with the DICOM tag as dicomID and keyword as tag.
+    '''
+    formatted = {
+        key: value for key, value in tag_meta.items()
+        if key not in ("tag", "keyword", "id")
+    }
+    formatted["tag"] = tag_meta["keyword"]
+    formatted["dicomID"] = tag_meta["tag"]
+
+    return formatted
 
-def import_tags_meta(database: str, log: str, tags_meta: Dict) -> None:
-    '''Upserts tag metadata.
+
+def import_tags_meta(database: str, log: str, lookup: slib.StandardLookup,
+                     catalogue_tags: Dict[str, Dict]) -> None:
+    '''Upserts tag metadata of the tags whose standard metadata changed.
 
     Args:
         database (str): Name of database to upsert tag metadata to.
         log (str): Log name.
-        tags_meta (Dict): Tag metadata.
+        lookup (StandardLookup): Compiled standard lookup.
+        catalogue_tags (Dict[str, Dict]): Catalogue tags by tag name.
+    '''
+    updated = []
+
+    for name, catalogue_tag in catalogue_tags.items():
+        tag = lookup.tag_meta(name)
+
+        if tag is not None and has_changed(catalogue_tag, tag):
+            tag["standardDate"] = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+            updated.append(tag)
+
+    logging.info("%s tags with new standard metadata.", len(updated))
+
+    mongo = MongoLib(log)
+    mongo.switch_db(database)
+    mongo.bulk_upsert(updated, "tags", "tag")
+    mongo.disconnect()
+
+
+def compile_standard(filenames: Dict[str, str], artifact: str,
+                     file_fingerprint: str) -> None:
+    '''Parses the standard files and compiles them into the lookup artifact.
+       The artifact holds every tag of the standard, so the files are joined
+       through a staging database on disk rather than in memory.
+
+    Args:
+        filenames (Dict[str, str]): Standard file paths by filename.
+        artifact (str): Artifact path.
+        file_fingerprint (str): Fingerprint of the standard files.
+    '''
+    staging_path = f"{artifact}.{os.getpid()}.staging"
+
+    if os.path.exists(staging_path):
+        os.remove(staging_path)
+
+    staging = sqlite3.connect(staging_path)
+
+    try:
+        staging.executescript(STAGING_SCHEMA)
+        stage_tags_conf(staging, filenames.get("tag_confidentiality.json", None))
+        modules = get_modules(filenames.get("modality_levels.json", None))
+        stage_tags_descr(staging, modules, filenames.get("modality_tags.json", None))
+
+        slib.compile_lookup(
+            artifact, file_fingerprint,
+            get_tags_meta(staging, filenames.get("tags.json", None)),
+            get_modality_std(filenames.get("modalities.json", None))
+        )
+    finally:
+        staging.close()
+        os.remove(staging_path)
+
+
+def get_import_state(database: str, log: str) -> Dict:
+    '''Returns the state of the last standard import.
+
+    Args:
+        database (str): Name of catalogue database.
+        log (str): Log name.
+
+    Returns:
+        Dict: {"_id": "dicom_standard", "fingerprint": <FINGERPRINT>,
+               "standardDate": <DATE_OF_STANDARD_IMPORT>}
     '''
     mongo = MongoLib(log)
     mongo.switch_db(database)
-    tags = list(mongo.search("tags", {}, {"tag": 1, "promotionStatus": 1}))
-
-    for tag in tags:
-        if tag["promotionStatus"] != "blocked":
-            for tag_meta in tags_meta:
-                if tag["tag"] == tag_meta["keyword"]:
-                    tag["dicomID"] = tag_meta.pop("tag")
-                    tag.update(tag_meta)
-                    del tag["keyword"]
-                    del tag["id"]
-                    tag["standardDate"] = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
-
-    mongo.upsert_tags(tags, "tags")
+    state = list(mongo.search("standard_import", {"_id": "dicom_standard"}))
     mongo.disconnect()
 
+    return state[0] if state else {}
+
+
+def set_import_state(database: str, log: str, import_fingerprint: str) -> None:
+    '''Records the fingerprint of a completed standard import.
+
+    Args:
+        database (str): Name of catalogue database.
+        log (str): Log name.
+        import_fingerprint (str): Fingerprint of standard files and catalogue.
+    '''
+    mongo = MongoLib(log)
+    mongo.switch_db(database)
+    mongo.upsert_obj(
+        {}, "standard_import", {"_id": "dicom_standard"},
+        {"$set": {
+            "fingerprint": import_fingerprint,
+            "standardDate": datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+        }}
+    )
+    mongo.disconnect()
+
+
+def refresh_views(database: str, log: str) -> None:
+    '''Rebuilds the catalogue UI views after an import.
+
+    Args:
+        database (str): Name of catalogue database.
+        log (str): Log name.
+    '''
+    mongo = MongoLib(log)
+    mongo.switch_db(database)
+    vlib.refresh_views(mongo)
+    mongo.disconnect()
+
+
+def get_catalogue_fingerprint(database: str, log: str,
+                              catalogue_tags: Dict[str, Dict]) -> str:
+    '''Returns a fingerprint of the catalogue modalities and tags that can
+       receive standard metadata.
+
+    Args:
+        database (str): Name of catalogue database.
+        log (str): Log name.
+        catalogue_tags (Dict[str, Dict]): Catalogue tags by tag name.
+
+    Returns:
+        str: SHA-256 hex digest.
+    '''
+    mongo = MongoLib(log)
+    mongo.switch_db(database)
+    mods = [mod["modality"] for mod in mongo.search("modalities", {}, {"modality": 1})]
+    mongo.disconnect()
+
+    digest = hashlib.sha256()
+
+    for name in sorted(mods) + sorted(catalogue_tags):
+        digest.update(name.encode("utf-8"))
+        digest.update(b"\0")
+
+    return digest.hexdigest()
+
 
 def main(args: argparse.Namespace) -> None:
     '''Main function for extracting a modality's metadata to JSON file.
@@ -203,20 +462,40 @@ def main(args: argparse.Namespace) -> None:
     filepaths = flib.ls_dir(file_path, "json")
     filenames = {
         flib.split_path(filepath)[1]: filepath for filepath in filepaths
+        if flib.split_path(filepath)[1] in STANDARD_FILES
     }
+    artifact = args.artifact or f"{file_path}/dicom_standard.sqlite"
 
-    import_modality_meta(cataloguedb, log, filenames.get("modalities.json", None))
-    tags = get_tags_conf(
-        filenames.get("tags.json", None),
-        filenames.get("tag_confidentiality.json", None)
-    )
-    modules = get_modules(filenames.get("modality_levels.json", None))
-    tags = get_tags_descr(
-        tags, modules,
-        filenames.get("modality_tags.json", None)
+    file_fingerprint = slib.fingerprint(list(filenames.values()))
+    lookup = slib.open_lookup(artifact)
+
+    if lookup is None or lookup.fingerprint != file_fingerprint:
+        logging.info("Standard files changed, compiling %s...", artifact)
+
+        if lookup is not None:
+            lookup.close()
+
+        compile_standard(filenames, artifact, file_fingerprint)
+        lookup = slib.StandardLookup(artifact)
+    else:
+        logging.info("Standard files unchanged, using %s.", artifact)
+
+    catalogue_tags = get_catalogue_tags(cataloguedb, log)
+    import_fingerprint = (
+        f"{file_fingerprint}:"
+        f"{get_catalogue_fingerprint(cataloguedb, log, catalogue_tags)}"
     )
 
-    import_tags_meta(cataloguedb, log, tags)
+    if not args.force and \
+            get_import_state(cataloguedb, log).get("fingerprint", None) == import_fingerprint:
+        logging.info("Standard files and catalogue unchanged, skipping import.")
+    else:
+        import_modality_meta(cataloguedb, log, lookup)
+        import_tags_meta(cataloguedb, log, lookup, catalogue_tags)
+        set_import_state(cataloguedb, log, import_fingerprint)
+        refresh_views(cataloguedb, log)
+
+    lookup.close()
 
 
 if __name__ == '__main__':
@@ -15,13 +15,35 @@
        ]
    }
 '''
+import sys
+import math
+import statistics
 import argparse
 import logging
-from typing import Dict, List
-import multiprocessing
+from array import array
+from typing import Dict, List, Optional, Tuple, Iterable
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
 import modules.file_lib as flib
+import modules.view_lib as vlib
 from datetime import datetime
+from bson import ObjectId, Binary
 from modules.mongo_lib import MongoLib
+from modules.sketch_lib import HyperLogLog, QuantileSketch
+
+# Catalogue collections holding the incremental raw counts rollup
+ROLLUP_SERIES = "raw_series_rollup"
+ROLLUP_MONTHLY = "raw_monthly_rollup"
+ROLLUP_STATE = "raw_rollup_state"
+
+# Catalogue collection holding serialised sketches
+SKETCHES = "sketches"
+# Date of the sketches covering all months of a modality
+ALL_MONTHS = "all"
+# Relative accuracy of the quantile sketches and reported quantiles
+QUANTILE_ACCURACY = 0.01
+QUANTILES = (50, 90, 99)
 
 
 def argparser() -> argparse.Namespace:
@@ -45,6 +67,53 @@ def argparser() -> argparse.Namespace:
     parser.add_argument("--cataloguedb", "-c",
                         help="Name of catalogue database. Default to analytics.",
                         type=str, required=False, default="analytics")
+    # Approximate counts do not use any counting method
+    counting = parser.add_mutually_exclusive_group()
+    counting.add_argument("--method",
+                          help=("Counting method. 'facet' recounts the whole "
+                                "collection, 'stream' recounts it from a single "
+                                "per-series grouping streamed to the client, "
+                                "'rollup' only merges documents added since "
+                                "the last rollup run, 'hll' estimates distinct "
+                                "series and studies with HyperLogLog sketches. "
+                                "Default to facet."),
+                          type=str, required=False,
+                          choices=["facet", "stream", "rollup", "hll"],
+                          default="facet")
+    counting.add_argument("--approximate",
+                          help=("Estimate the counts from a sample of each "
+                                "collection and write them to approxCountsRaw, "
+                                "next to the exact counts."), action="store_true")
+    parser.add_argument("--rebuild",
+                        help=("Discard the rollup or sketches of the counted "
+                              "collections and rebuild them from scratch, "
+                              "e.g. after deletions."), action="store_true")
+    parser.add_argument("--error", "-e",
+                        help=("Relative standard error of the 'hll' method. "
+                              "Default to 0.01."), type=float,
+                        required=False, default=0.01)
+    parser.add_argument("--samples", "-n",
+                        help=("Sample size per collection of the approximate "
+                              "counts. Default to 2000."), type=int,
+                        required=False, default=2000)
+    parser.add_argument("--confidence",
+                        help=("Confidence level of the approximate count "
+                              "intervals. Default to 0.95."), type=float,
+                        required=False, default=0.95)
+    parser.add_argument("--create-indexes",
+                        help=("Create the UID indexes through which the "
+                              "approximate counts look up series and study "
+                              "sizes, if missing. Building them on large "
+                              "collections takes as long as a full count."),
+                        action="store_true")
+    parser.add_argument("--run-id",
+                        help=("ID of the run, recorded with each completed "
+                              "collection. Default to the start time."),
+                        type=str, required=False, default=None)
+    parser.add_argument("--resume",
+                        help=("Skip the collections completed by the run given "
+                              "with --run-id, or by the last unfinished run."),
+                        action="store_true")
     parser.add_argument("--log", "-l",
                         help=("Log directory path. Default to current"
                               " directory."),
@@ -234,7 +303,7 @@ def format_counts(counts: List[Dict]) -> List[Dict]:
     def _float(number):
         return "{:.2f}".format(number)
 
-    formatted = []
+    formatted: Dict = {}
 
     image_counts = counts[0]["imageCount"]
     series_counts = counts[0]["seriesCount"]
@@ -242,40 +311,673 @@ def format_counts(counts: List[Dict]) -> List[Dict]:
     monthly_counts = counts[0]["monthCount"]
 
     for count in image_counts:
-        modality = {
+        formatted[count["_id"]["modality"]] = {
             "modality": count["_id"]["modality"],
             "totalNoImagesRaw": count["imageCount"],
         }
 
-        formatted.append(modality)
-
     for count in series_counts:
-        for modality in formatted:
-            if count["_id"]["modality"] == modality["modality"]:
-                modality["avgNoImagesPerSeriesRaw"] = _float(count["avgNoImagesPerSeries"])
-                modality["minNoImagesPerSeriesRaw"] = _float(count["minNoImagesPerSeries"])
-                modality["maxNoImagesPerSeriesRaw"] = _float(count["maxNoImagesPerSeries"])
-                modality["stdDevImagesPerSeriesRaw"] = _float(count["stdDevImagesPerSeries"])
-                modality["totalNoSeriesRaw"] = count["seriesCount"]
+        modality = formatted.get(count["_id"]["modality"], None)
+
+        if modality is not None:
+            modality["avgNoImagesPerSeriesRaw"] = _float(count["avgNoImagesPerSeries"])
+            modality["minNoImagesPerSeriesRaw"] = _float(count["minNoImagesPerSeries"])
+            modality["maxNoImagesPerSeriesRaw"] = _float(count["maxNoImagesPerSeries"])
+            modality["stdDevImagesPerSeriesRaw"] = _float(count["stdDevImagesPerSeries"])
+            modality["totalNoSeriesRaw"] = count["seriesCount"]
 
     for count in study_counts:
-        for modality in formatted:
-            if count["_id"]["modality"] == modality["modality"]:
-                modality["avgNoSeriesPerStudyRaw"] = _float(count["avgNoSeriesPerStudy"])
-                modality["minNoSeriesPerStudyRaw"] = _float(count["minNoSeriesPerStudy"])
-                modality["maxNoSeriesPerStudyRaw"] = _float(count["maxNoSeriesPerStudy"])
-                modality["stdDevSeriesPerStudyRaw"] = _float(count["stdDevSeriesPerStudy"])
-                modality["totalNoStudiesRaw"] = count["studyCount"]
+        modality = formatted.get(count["_id"]["modality"], None)
+
+        if modality is not None:
+            modality["avgNoSeriesPerStudyRaw"] = _float(count["avgNoSeriesPerStudy"])
+            modality["minNoSeriesPerStudyRaw"] = _float(count["minNoSeriesPerStudy"])
+            modality["maxNoSeriesPerStudyRaw"] = _float(count["maxNoSeriesPerStudy"])
+            modality["stdDevSeriesPerStudyRaw"] = _float(count["stdDevSeriesPerStudy"])
+            modality["totalNoStudiesRaw"] = count["studyCount"]
 
     for count in monthly_counts:
-        for modality in formatted:
-            if count["modality"] == modality["modality"]:
-                modality["countsPerMonthRaw"] = flib.fill_blanks(count["countsPerMonthRaw"])
-                modality["countsDateRaw"] = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+        modality = formatted.get(count["modality"], None)
+
+        if modality is not None:
+            modality["countsPerMonthRaw"] = flib.fill_blanks(count["countsPerMonthRaw"])
+            modality["countsDateRaw"] = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+
+    return list(formatted.values())
+
+
+def prepare_intermediate(collection: str) -> List[Dict]:
+    '''Prepares the single grouping that all stream counts are computed
+       from: one document per modality, study, series and study month.
+
+    Args:
+        collection (str): Collection name.
+
+    Returns:
+        List[Dict]: Aggregation pipeline.
+    '''
+    if collection == "series":
+        image_count = "$header.ImagesInSeries"
+    else:
+        image_count = 1
+
+    return [
+        {"$group": {
+            "_id": {
+                "modality": "$Modality",
+                "studyID": "$StudyInstanceUID",
+                "seriesID": "$SeriesInstanceUID",
+                **study_month()
+            },
+            "imageCount": {"$sum": image_count}
+        }}
+    ]
+
+
+def load_intermediate(rows: Iterable[Dict]) -> Tuple[Dict[str, np.ndarray], List, List]:
+    '''Streams the intermediate grouping into compact columns, replacing
+       modality, study, series and month values by integer codes.
+
+    Args:
+        rows (Iterable[Dict]): Output of the prepare_intermediate() pipeline.
+
+    Returns:
+        Tuple[Dict[str, np.ndarray], List, List]: Columns "modality",
+            "study", "series", "month" and "images", the modality names
+            and the month dates by code.
+    '''
+    codes: Dict[str, Dict] = {"modality": {}, "study": {}, "series": {}, "month": {}}
+    columns = {name: array("q") for name in codes}
+    images = array("d")
+
+    for row in rows:
+        key = row["_id"]
+        year = key.get("studyYear", None)
+        month = key.get("studyMonth", None)
+        values = {
+            "modality": key.get("modality", None),
+            "study": key.get("studyID", None),
+            "series": key.get("seriesID", None),
+            "month": f"{year}/{month}" if year and month else None
+        }
+
+        for name, value in values.items():
+            columns[name].append(codes[name].setdefault(value, len(codes[name])))
+
+        images.append(row["imageCount"] or 0)
+
+    arrays = {name: np.frombuffer(column, dtype=np.int64) for name, column in columns.items()}
+    arrays["images"] = np.frombuffer(images, dtype=np.float64)
+
+    return arrays, list(codes["modality"]), list(codes["month"])
+
+
+def group_stats(groups: np.ndarray, values: np.ndarray, size: int) -> Dict[str, np.ndarray]:
+    '''Computes count, sum, average, minimum, maximum and population
+       standard deviation of values by group.
+
+    Args:
+        groups (np.ndarray): Group code of each value.
+        values (np.ndarray): Values.
+        size (int): Number of groups.
+
+    Returns:
+        Dict[str, np.ndarray]: Statistics by group code.
+    '''
+    count = np.bincount(groups, minlength=size)
+    total = np.bincount(groups, weights=values, minlength=size)
+    sum_sq = np.bincount(groups, weights=values * values, minlength=size)
+    minimum = np.full(size, np.inf)
+    maximum = np.full(size, -np.inf)
+    np.minimum.at(minimum, groups, values)
+    np.maximum.at(maximum, groups, values)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        avg = total / count
+        std = np.sqrt(np.maximum(sum_sq / count - avg * avg, 0))
+
+    return {"count": count, "sum": total, "avg": avg, "min": minimum,
+            "max": maximum, "std": std}
+
+
+def unique_rows(*columns: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    '''Groups rows by the given key columns.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: Distinct keys, and the index of each
+                                       row's key.
+    '''
+    keys, inverse = np.unique(np.stack(columns, axis=1), axis=0,
+                              return_inverse=True)
+
+    return keys, inverse.ravel()
+
+
+def stream_counts(rows: Iterable[Dict], sketches: Dict = None) -> List[Dict]:
+    '''Computes modality counts from the streamed intermediate grouping,
+       using array operations rather than one server-side grouping per
+       statistic.
+
+    Args:
+        rows (Iterable[Dict]): Output of the prepare_intermediate() pipeline.
+        sketches (Dict, optional): If given, filled with quantile sketches
+                                   of the images per series and series per
+                                   study: {(<MODALITY>, <FIELD>): QuantileSketch}.
+
+    Returns:
+        List[Dict]: Same format as format_counts().
+    '''
+    def _float(number):
+        return "{:.2f}".format(number)
+
+    cols, mod_names, month_dates = load_intermediate(rows)
+    n_mods = len(mod_names)
+
+    if not n_mods:
+        return []
+
+    image_totals = np.bincount(cols["modality"], weights=cols["images"], minlength=n_mods)
+
+    # Images per series, series being identified by modality and series UID
+    series, series_idx = unique_rows(cols["modality"], cols["series"])
+    images_per_series = np.bincount(series_idx, weights=cols["images"])
+    series_stats = group_stats(series[:, 0], images_per_series, n_mods)
+
+    # Series per study, over distinct modality, study and series
+    study_series = np.unique(
+        np.stack([cols["modality"], cols["study"], cols["series"]], axis=1), axis=0
+    )
+    studies, study_idx = unique_rows(study_series[:, 0], study_series[:, 1])
+    series_per_study = np.bincount(study_idx).astype(np.float64)
+    study_stats = group_stats(studies[:, 0], series_per_study, n_mods)
+
+    # Monthly counts, studies being counted once per month
+    month_studies, month_study_idx = unique_rows(cols["modality"], cols["month"], cols["study"])
+    month_study_images = np.bincount(month_study_idx, weights=cols["images"])
+    month_study_series = np.bincount(month_study_idx)
+    months, month_idx = unique_rows(month_studies[:, 0], month_studies[:, 1])
+    month_images = np.bincount(month_idx, weights=month_study_images)
+    month_series = np.bincount(month_idx, weights=month_study_series)
+    month_study_counts = np.bincount(month_idx)
+
+    counts_per_month: Dict[int, List] = {code: [] for code in range(n_mods)}
+
+    for i, (mod, month) in enumerate(months):
+        counts_per_month[mod].append({
+            "date": month_dates[month],
+            "imageCount": int(month_images[i]),
+            "seriesCount": int(month_series[i]),
+            "studyCount": int(month_study_counts[i])
+        })
+
+    if sketches is not None:
+        for code, mod_name in enumerate(mod_names):
+            for field, groups, values in (
+                    ("ImagesPerSeries", series[:, 0], images_per_series),
+                    ("SeriesPerStudy", studies[:, 0], series_per_study)):
+                sketch = sketches[(mod_name, field)] = QuantileSketch(QUANTILE_ACCURACY)
+                sketch.add_many(values[groups == code])
+
+    formatted = []
+
+    for code, mod_name in enumerate(mod_names):
+        formatted.append({
+            "modality": mod_name,
+            "totalNoImagesRaw": int(image_totals[code]),
+            "avgNoImagesPerSeriesRaw": _float(series_stats["avg"][code]),
+            "minNoImagesPerSeriesRaw": _float(series_stats["min"][code]),
+            "maxNoImagesPerSeriesRaw": _float(series_stats["max"][code]),
+            "stdDevImagesPerSeriesRaw": _float(series_stats["std"][code]),
+            "totalNoSeriesRaw": int(series_stats["count"][code]),
+            "avgNoSeriesPerStudyRaw": _float(study_stats["avg"][code]),
+            "minNoSeriesPerStudyRaw": _float(study_stats["min"][code]),
+            "maxNoSeriesPerStudyRaw": _float(study_stats["max"][code]),
+            "stdDevSeriesPerStudyRaw": _float(study_stats["std"][code]),
+            "totalNoStudiesRaw": int(study_stats["count"][code]),
+            "countsPerMonthRaw": flib.fill_blanks(counts_per_month[code]),
+            "countsDateRaw": datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+        })
 
     return formatted
 
 
+def source_family(collection: str) -> Dict:
+    '''Returns the condition matching the stored sketches of the partitions
+       counted together with the collection: the series collection, or the
+       image_* collections. Both hold the same series and images, so their
+       sketches must never be merged.
+
+    Args:
+        collection (str): Collection (partition) name.
+
+    Returns:
+        Dict: Match condition on the stored sketch documents.
+    '''
+    if collection == "series":
+        return {"_id.collection": "series"}
+
+    return {"_id.collection": {"$regex": "^image_"}}
+
+
+def save_quantile_sketches(mongo: MongoLib, collection: str,
+                           sketches: Dict[Tuple, QuantileSketch]) -> None:
+    '''Stores the quantile sketches of a collection, replacing those of
+       its previous run.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+        collection (str): Collection (partition) name.
+        sketches (Dict[Tuple, QuantileSketch]): Sketches filled by
+                                                stream_counts().
+    '''
+    mongo.delete_many(SKETCHES, {"_id.type": "quantile", "_id.collection": collection})
+
+    date = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+    docs = [
+        {"_id": {"type": "quantile", "collection": collection, "modality": mod,
+                 "field": field},
+         "sketch": Binary(sketch.to_bytes()),
+         "sketchDate": date}
+        for (mod, field), sketch in sketches.items()
+    ]
+
+    mongo.bulk_upsert(docs, SKETCHES, "_id")
+
+
+def format_quantiles(stored: Iterable[Dict]) -> Dict[str, Dict]:
+    '''Merges the stored quantile sketches of all partitions of each
+       modality and derives quantiles and histograms.
+
+    Args:
+        stored (Iterable[Dict]): Stored quantile sketch documents.
+
+    Returns:
+        Dict[str, Dict]: {<MODALITY>: {"p50NoImagesPerSeriesRaw": <VALUE>,
+                                       "p90NoImagesPerSeriesRaw": <VALUE>,
+                                       "p99NoImagesPerSeriesRaw": <VALUE>,
+                                       "imagesPerSeriesHistRaw": [{
+                                           "low": <BOUND>, "high": <BOUND>,
+                                           "count": <COUNT>}],
+                                       ... and the same for SeriesPerStudy}}
+    '''
+    merged: Dict[Tuple, QuantileSketch] = {}
+
+    for doc in stored:
+        key = (doc["_id"]["modality"], doc["_id"]["field"])
+        sketch = QuantileSketch.from_bytes(doc["sketch"])
+
+        if key not in merged:
+            merged[key] = sketch
+        elif merged[key].accuracy == sketch.accuracy:
+            merged[key].merge(sketch)
+        else:
+            logging.warning("Skipping quantile sketch of %s with accuracy %s.",
+                            doc["_id"]["collection"], sketch.accuracy)
+
+    formatted: Dict[str, Dict] = {}
+
+    for (mod, field), sketch in merged.items():
+        modality = formatted.setdefault(mod, {})
+
+        for quantile in QUANTILES:
+            modality[f"p{quantile}No{field}Raw"] = "{:.2f}".format(sketch.quantile(quantile / 100))
+
+        modality[f"{field[0].lower()}{field[1:]}HistRaw"] = sketch.histogram()
+
+    return formatted
+
+
+def study_month() -> Dict:
+    '''Returns the study year and month expressions shared by the monthly
+       counts.
+
+    Returns:
+        Dict: {"studyYear": <EXPRESSION>, "studyMonth": <EXPRESSION>}
+    '''
+    return {
+        "studyYear": {"$toString": {"$year": {"$toDate": "$StudyDate"}}},
+        "studyMonth": {"$toString": {"$month": {"$toDate": "$StudyDate"}}}
+    }
+
+
+def id_range(watermark: Optional[ObjectId], upper: ObjectId) -> Dict:
+    '''Returns the condition matching documents added after the watermark
+       and up to the upper bound.
+
+    Args:
+        watermark (Optional[ObjectId]): Last _id already in the rollup.
+        upper (ObjectId): Last _id to include in this run.
+
+    Returns:
+        Dict: Match condition.
+    '''
+    condition = {"$lte": upper}
+
+    if watermark is not None:
+        condition["$gt"] = watermark
+
+    return {"_id": condition}
+
+
+def prepare_rollup_delta(collection: str, cataloguedb: str, condition: Dict,
+                         batch: ObjectId) -> List[Dict]:
+    '''Prepares the pipeline merging new documents into the series rollup.
+       The series rollup keeps the image count of every series, which is the
+       bookkeeping needed to merge new images into existing series exactly.
+       Each series records the last batch merged into it, so that a batch
+       rerun after an interruption is not added twice.
+
+    Args:
+        collection (str): Collection name.
+        cataloguedb (str): Catalogue database name.
+        condition (Dict): Match condition of the new documents.
+        batch (ObjectId): Upper _id of the batch.
+
+    Returns:
+        List[Dict]: Aggregation pipeline.
+    '''
+    if collection == "series":
+        image_count = "$header.ImagesInSeries"
+    else:
+        image_count = 1
+
+    month = study_month()
+
+    return [
+        {"$match": condition},
+        {"$group": {
+            "_id": {
+                "collection": collection,
+                "modality": "$Modality",
+                "seriesID": "$SeriesInstanceUID"
+            },
+            "studyID": {"$first": "$StudyInstanceUID"},
+            "studyYear": {"$first": month["studyYear"]},
+            "studyMonth": {"$first": month["studyMonth"]},
+            "imageCount": {"$sum": image_count}
+        }},
+        {"$set": {"batch": batch}},
+        {"$merge": {
+            "into": {"db": cataloguedb, "coll": ROLLUP_SERIES},
+            "on": "_id",
+            "whenMatched": [
+                {"$set": {
+                    "imageCount": {"$cond": [
+                        {"$eq": ["$batch", "$$new.batch"]},
+                        "$imageCount",
+                        {"$add": ["$imageCount", "$$new.imageCount"]}
+                    ]},
+                    "batch": "$$new.batch"
+                }}
+            ],
+            "whenNotMatched": "insert"
+        }}
+    ]
+
+
+def prepare_touched_months(collection: str, condition: Dict) -> List[Dict]:
+    '''Prepares the pipeline listing the months that new documents belong to.
+
+    Args:
+        collection (str): Collection name.
+        condition (Dict): Match condition of the new documents.
+
+    Returns:
+        List[Dict]: Aggregation pipeline.
+    '''
+    month = study_month()
+
+    return [
+        {"$match": condition},
+        {"$group": {
+            "_id": {
+                "modality": "$Modality",
+                "studyYear": month["studyYear"],
+                "studyMonth": month["studyMonth"]
+            }
+        }}
+    ]
+
+
+def prepare_rollup_months(collection: str, months: List[Dict]) -> List[Dict]:
+    '''Prepares the pipeline recomputing the given months of the monthly
+       rollup from the series rollup.
+
+    Args:
+        collection (str): Collection name.
+        months (List[Dict]): [{"modality": <MODALITY>,
+                               "studyYear": <YEAR>,
+                               "studyMonth": <MONTH>}]
+
+    Returns:
+        List[Dict]: Aggregation pipeline.
+    '''
+    return [
+        {"$match": {
+            "_id.collection": collection,
+            "$or": [
+                {"_id.modality": month["modality"],
+                 "studyYear": month["studyYear"],
+                 "studyMonth": month["studyMonth"]}
+                for month in months
+            ]
+        }},
+        {"$group": {
+            "_id": {
+                "modality": "$_id.modality",
+                "studyYear": "$studyYear",
+                "studyMonth": "$studyMonth",
+                "studyID": "$studyID"
+            },
+            "imageCount": {"$sum": "$imageCount"},
+            "seriesCount": {"$sum": 1},
+            "sumSqImagesPerSeries": {
+                "$sum": {"$multiply": ["$imageCount", "$imageCount"]}
+            },
+            "minNoImagesPerSeries": {"$min": "$imageCount"},
+            "maxNoImagesPerSeries": {"$max": "$imageCount"}
+        }},
+        {"$group": {
+            "_id": {
+                "collection": collection,
+                "modality": "$_id.modality",
+                "studyYear": "$_id.studyYear",
+                "studyMonth": "$_id.studyMonth"
+            },
+            "imageCount": {"$sum": "$imageCount"},
+            "seriesCount": {"$sum": "$seriesCount"},
+            "studyCount": {"$sum": 1},
+            "sumSqImagesPerSeries": {"$sum": "$sumSqImagesPerSeries"},
+            "minNoImagesPerSeries": {"$min": "$minNoImagesPerSeries"},
+            "maxNoImagesPerSeries": {"$max": "$maxNoImagesPerSeries"},
+            "sumSqSeriesPerStudy": {
+                "$sum": {"$multiply": ["$seriesCount", "$seriesCount"]}
+            },
+            "minNoSeriesPerStudy": {"$min": "$seriesCount"},
+            "maxNoSeriesPerStudy": {"$max": "$seriesCount"}
+        }},
+        {"$merge": {
+            "into": ROLLUP_MONTHLY,
+            "on": "_id",
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ]
+
+
+def format_rollup(months: List[Dict]) -> List[Dict]:
+    '''Derives modality counts from the monthly rollup. Studies are counted
+       once per month, as all series of a study share its StudyDate.
+
+    Args:
+        months (List[Dict]): Monthly rollup documents of a collection.
+
+    Returns:
+        List[Dict]: Same format as format_counts().
+    '''
+    def _float(number):
+        return "{:.2f}".format(number)
+
+    def _std(sum_sq, total, count):
+        mean = total / count
+        return math.sqrt(max(sum_sq / count - mean * mean, 0))
+
+    modalities: Dict = {}
+
+    for month in months:
+        mod_name = month["_id"]["modality"]
+        mod = modalities.setdefault(mod_name, {
+            "images": 0, "series": 0, "studies": 0,
+            "sumSqImages": 0, "sumSqSeries": 0,
+            "minImages": math.inf, "maxImages": -math.inf,
+            "minSeries": math.inf, "maxSeries": -math.inf,
+            "countsPerMonth": []
+        })
+
+        mod["images"] += month["imageCount"]
+        mod["series"] += month["seriesCount"]
+        mod["studies"] += month["studyCount"]
+        mod["sumSqImages"] += month["sumSqImagesPerSeries"]
+        mod["sumSqSeries"] += month["sumSqSeriesPerStudy"]
+        mod["minImages"] = min(mod["minImages"], month["minNoImagesPerSeries"])
+        mod["maxImages"] = max(mod["maxImages"], month["maxNoImagesPerSeries"])
+        mod["minSeries"] = min(mod["minSeries"], month["minNoSeriesPerStudy"])
+        mod["maxSeries"] = max(mod["maxSeries"], month["maxNoSeriesPerStudy"])
+
+        year = month["_id"]["studyYear"]
+        month_no = month["_id"]["studyMonth"]
+
+        mod["countsPerMonth"].append({
+            "date": f"{year}/{month_no}" if year and month_no else None,
+            "imageCount": month["imageCount"],
+            "seriesCount": month["seriesCount"],
+            "studyCount": month["studyCount"]
+        })
+
+    formatted = []
+
+    for mod_name, mod in modalities.items():
+        formatted.append({
+            "modality": mod_name,
+            "totalNoImagesRaw": mod["images"],
+            "avgNoImagesPerSeriesRaw": _float(mod["images"] / mod["series"]),
+            "minNoImagesPerSeriesRaw": _float(mod["minImages"]),
+            "maxNoImagesPerSeriesRaw": _float(mod["maxImages"]),
+            "stdDevImagesPerSeriesRaw": _float(
+                _std(mod["sumSqImages"], mod["images"], mod["series"])
+            ),
+            "totalNoSeriesRaw": mod["series"],
+            "avgNoSeriesPerStudyRaw": _float(mod["series"] / mod["studies"]),
+            "minNoSeriesPerStudyRaw": _float(mod["minSeries"]),
+            "maxNoSeriesPerStudyRaw": _float(mod["maxSeries"]),
+            "stdDevSeriesPerStudyRaw": _float(
+                _std(mod["sumSqSeries"], mod["series"], mod["studies"])
+            ),
+            "totalNoStudiesRaw": mod["studies"],
+            "countsPerMonthRaw": flib.fill_blanks(mod["countsPerMonth"]),
+            "countsDateRaw": datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+        })
+
+    return formatted
+
+
+def update_rollup(mongo: MongoLib, pacsdb: str, cataloguedb: str,
+                  collection: str, rebuild: bool = False) -> None:
+    '''Merges the documents added to a collection since the last run into
+       the series rollup, and recomputes the affected months of the monthly
+       rollup. Documents are only picked up once, based on an _id watermark,
+       so documents inserted with an _id below the watermark are missed
+       until the rollup is rebuilt. The upper _id of a batch is recorded
+       before merging it, so that a run interrupted before advancing the
+       watermark reruns the same batch.
+
+    Args:
+        mongo (MongoLib): MongoLib instance.
+        pacsdb (str): Target database name.
+        cataloguedb (str): Catalogue database name.
+        collection (str): Collection name.
+        rebuild (bool, optional): Discard the collection's rollup first.
+                                  Defaults to False.
+    '''
+    mongo.switch_db(cataloguedb)
+    mongo.create_index(ROLLUP_SERIES, ["_id.collection", "_id.modality",
+                                       "studyYear", "studyMonth"])
+
+    if rebuild:
+        logging.info("Rebuilding rollup of %s...", collection)
+        mongo.delete_many(ROLLUP_SERIES, {"_id.collection": collection})
+        mongo.delete_many(ROLLUP_MONTHLY, {"_id.collection": collection})
+        mongo.delete_many(ROLLUP_STATE, {"_id": collection})
+
+    state = list(mongo.search(ROLLUP_STATE, {"_id": collection}))
+    watermark = state[0].get("watermark", None) if state else None
+    pending = state[0].get("pending", None) if state else None
+
+    mongo.switch_db(pacsdb)
+    upper = pending or mongo.get_last_id(collection)
+
+    if pending is not None:
+        logging.info("Resuming interrupted rollup batch of %s.", collection)
+
+    if upper is None or upper == watermark:
+        logging.info("No new documents in %s since the last rollup.", collection)
+        return
+
+    condition = id_range(watermark, upper)
+    months = [
+        month["_id"] for month in
+        mongo.aggregate(collection, prepare_touched_months(collection, condition))
+    ]
+
+    if not months:
+        logging.info("No new documents in %s since the last rollup.", collection)
+        return
+
+    logging.info("Merging new documents of %s into %s months of the rollup...",
+                 collection, len(months))
+    mongo.switch_db(cataloguedb)
+    mongo.upsert_obj({}, ROLLUP_STATE, {"_id": collection}, {"$set": {"pending": upper}})
+
+    mongo.switch_db(pacsdb)
+    list(mongo.aggregate(
+        collection, prepare_rollup_delta(collection, cataloguedb, condition, upper)
+    ))
+
+    mongo.switch_db(cataloguedb)
+    list(mongo.aggregate(ROLLUP_SERIES, prepare_rollup_months(collection, months)))
+    mongo.upsert_obj(
+        {}, ROLLUP_STATE, {"_id": collection},
+        {"$set": {
+            "watermark": upper,
+            "rollupDate": datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+        },
+         "$unset": {"pending": ""}}
+    )
+
+
+def get_rollup_counts_wrapper(pacsdb: str, cataloguedb: str, log: str,
+                              collection: str, rebuild: bool = False) -> None:
+    '''Wrapper for multiprocessing pool. Updates the rollup of a collection
+       and derives the modality counts from it.
+
+    Args:
+       pacsdb (str): Target database name.
+       cataloguedb (str): Catalogue database name.
+       log (str): Log location.
+       collection (str): Collection name.
+       rebuild (bool, optional): Rebuild the rollup. Defaults to False.
+    '''
+    mongo = MongoLib(log)
+    update_rollup(mongo, pacsdb, cataloguedb, collection, rebuild)
+
+    mongo.switch_db(cataloguedb)
+    months = list(mongo.search(ROLLUP_MONTHLY, {"_id.collection": collection}))
+    counts = format_rollup(months)
+
+    mongo.upsert_modalities(counts, "modalities")
+    mongo.disconnect()
+
+
 def get_counts_wrapper(pacsdb: str, cataloguedb: str, log: str, collection: str) -> None:
     '''Wrapper for multiprocessing pool.
 
@@ -295,6 +997,509 @@ def get_counts_wrapper(pacsdb: str, cataloguedb: str, log: str, collection: str)
     mongo.disconnect()
 
 
+def get_stream_counts_wrapper(pacsdb: str, cataloguedb: str, log: str, collection: str) -> None:
+    '''Wrapper for multiprocessing pool. Counts a collection from a single
+       streamed per-series grouping, and adds quantiles of the images per
+       series and series per study.
+
+    Args:
+       pacsdb (str): Target database name.
+       cataloguedb (str): Catalogue database name.
+       log (str): Log location.
+       collection (str): Collection name.
+    '''
+    mongo = MongoLib(log)
+    mongo.switch_db(pacsdb)
+    rows = mongo.aggregate(collection, prepare_intermediate(collection),
+                           batch_size=10000)
+    sketches: Dict[Tuple, QuantileSketch] = {}
+    counts = stream_counts(rows, sketches)
+
+    mongo.switch_db(cataloguedb)
+    save_quantile_sketches(mongo, collection, sketches)
+
+    # Partitions of the same modality and source family combine through their sketches
+    stored = mongo.search(SKETCHES, {"_id.type": "quantile",
+                                     "_id.modality": {"$in": [mod["modality"] for mod in counts]},
+                                     **source_family(collection)})
+    quantiles = format_quantiles(stored)
+
+    for mod in counts:
+        mod.update(quantiles.get(mod["modality"], {}))
+
+    mongo.upsert_modalities(counts, "modalities")
+    mongo.disconnect()
+
+
+def prepare_uid_stream(collection: str) -> List[Dict]:
+    '''Prepares the pipeline streaming the UIDs, image count and study month
+       of every document, without any server-side grouping.
+
+    Args:
+        collection (str): Collection name.
+
+    Returns:
+        List[Dict]: Aggregation pipeline.
+    '''
+    if collection == "series":
+        image_count = "$header.ImagesInSeries"
+    else:
+        image_count = {"$literal": 1}
+
+    return [
+        {"$project": {
+            "_id": 0,
+            "modality": "$Modality",
+            "studyID": "$StudyInstanceUID",
+            "seriesID": "$SeriesInstanceUID",
+            "imageCount": image_count,
+            **study_month()
+        }}
+    ]
+
+
+def hll_sketches(rows: Iterable[Dict], error: float) -> Dict[Tuple, Dict]:
+    '''Builds series and study HyperLogLog sketches and image counts per
+       modality and study month, and per modality (month ALL_MONTHS).
+
+    Args:
+        rows (Iterable[Dict]): Output of the prepare_uid_stream() pipeline.
+        error (float): Relative standard error of the sketches.
+
+    Returns:
+        Dict[Tuple, Dict]: {(<MODALITY>, <YYYY/MM|None|ALL_MONTHS>): {
+                                "series": HyperLogLog,
+                                "study": HyperLogLog,
+                                "imageCount": <COUNT>}}
+    '''
+    sketches: Dict[Tuple, Dict] = {}
+    last_series: Dict[Tuple, str] = {}
+
+    def _new():
+        return {"series": HyperLogLog(error), "study": HyperLogLog(error),
+                "imageCount": 0}
+
+    for row in rows:
+        year = row.get("studyYear", None)
+        month = row.get("studyMonth", None)
+        key = (row.get("modality", None), f"{year}/{month}" if year and month else None)
+        sketch = sketches.get(key, None)
+
+        if sketch is None:
+            sketch = sketches[key] = _new()
+
+        sketch["imageCount"] += row.get("imageCount", None) or 0
+
+        # Images of a series are mostly stored together, skip repeated UIDs
+        if last_series.get(key, None) != row.get("seriesID", None):
+            last_series[key] = row.get("seriesID", None)
+            sketch["series"].add(row.get("seriesID", None))
+            sketch["study"].add(row.get("studyID", None))
+
+    for (mod, _), sketch in list(sketches.items()):
+        total = sketches.get((mod, ALL_MONTHS), None)
+
+        if total is None:
+            total = sketches[(mod, ALL_MONTHS)] = _new()
+
+        total["series"].merge(sketch["series"])
+        total["study"].merge(sketch["study"])
+        total["imageCount"] += sketch["imageCount"]
+
+    return sketches
+
+
+def save_hll_sketches(mongo: MongoLib, collection: str,
+                      sketches: Dict[Tuple, Dict], rebuild: bool = False) -> None:
+    '''Merges sketches into those stored for the collection, unless
+       rebuilding, and stores the result. Image counts are replaced.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+        collection (str): Collection (partition) name.
+        sketches (Dict[Tuple, Dict]): Output of hll_sketches().
+        rebuild (bool, optional): Discard stored sketches. Defaults to False.
+    '''
+    if rebuild:
+        mongo.delete_many(SKETCHES, {"_id.type": "hll", "_id.collection": collection})
+    else:
+        for stored in mongo.search(SKETCHES, {"_id.type": "hll",
+                                              "_id.collection": collection}):
+            key = (stored["_id"]["modality"], stored["_id"]["date"])
+            field = stored["_id"]["field"]
+            old = HyperLogLog.from_bytes(stored["sketch"])
+
+            if key in sketches and old.precision == sketches[key][field].precision:
+                sketches[key][field].merge(old)
+
+    docs = []
+    date = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+
+    for (mod, month), sketch in sketches.items():
+        for field in ("series", "study"):
+            docs.append({
+                "_id": {"type": "hll", "collection": collection,
+                        "modality": mod, "date": month, "field": field},
+                "sketch": Binary(sketch[field].to_bytes()),
+                "imageCount": sketch["imageCount"],
+                "sketchDate": date
+            })
+
+    mongo.bulk_upsert(docs, SKETCHES, "_id")
+
+
+def format_hll(stored: Iterable[Dict]) -> List[Dict]:
+    '''Merges the stored sketches of all partitions of each modality and
+       derives estimated counts. The sketches must come from a single source
+       family, see source_family().
+
+    Args:
+        stored (Iterable[Dict]): Stored HyperLogLog sketch documents.
+
+    Returns:
+        List[Dict]: [{"modality": <MODALITY>,
+                      "totalNoImagesRaw": <COUNT>,
+                      "totalNoSeriesRaw": <ESTIMATE>,
+                      "totalNoStudiesRaw": <ESTIMATE>,
+                      "avgNoImagesPerSeriesRaw": <ESTIMATE>,
+                      "avgNoSeriesPerStudyRaw": <ESTIMATE>,
+                      "countsPerMonthRaw": [...],
+                      "countsMethodRaw": "hll",
+                      "countsRelErrorRaw": <ERROR>,
+                      "countsDateRaw": <DATE>}]
+    '''
+    merged: Dict[Tuple, Dict] = {}
+
+    for doc in stored:
+        key = (doc["_id"]["modality"], doc["_id"]["date"])
+        field = doc["_id"]["field"]
+        sketch = HyperLogLog.from_bytes(doc["sketch"])
+        entry = merged.setdefault(key, {"imageCount": 0})
+
+        if field == "series":
+            entry["imageCount"] += doc.get("imageCount", 0)
+
+        if field not in entry:
+            entry[field] = sketch
+        elif entry[field].precision == sketch.precision:
+            entry[field].merge(sketch)
+        else:
+            logging.warning("Skipping %s sketch of %s with precision %s.",
+                            field, doc["_id"]["collection"], sketch.precision)
+
+    formatted: Dict = {}
+
+    for (mod, month), entry in merged.items():
+        if "series" not in entry or "study" not in entry:
+            continue
+
+        series = entry["series"].count()
+        studies = entry["study"].count()
+        modality = formatted.setdefault(mod, {"modality": mod, "countsPerMonthRaw": []})
+
+        if month == ALL_MONTHS:
+            modality.update({
+                "totalNoImagesRaw": entry["imageCount"],
+                "totalNoSeriesRaw": series,
+                "totalNoStudiesRaw": studies,
+                "avgNoImagesPerSeriesRaw": "{:.2f}".format(entry["imageCount"] / max(series, 1)),
+                "avgNoSeriesPerStudyRaw": "{:.2f}".format(series / max(studies, 1)),
+                "countsMethodRaw": "hll",
+                "countsRelErrorRaw": "{:.4f}".format(entry["series"].error),
+                "countsDateRaw": datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+            })
+        else:
+            modality["countsPerMonthRaw"].append({
+                "date": month,
+                "imageCount": entry["imageCount"],
+                "seriesCount": series,
+                "studyCount": studies
+            })
+
+    for modality in formatted.values():
+        modality["countsPerMonthRaw"] = flib.fill_blanks(modality["countsPerMonthRaw"])
+
+    return list(formatted.values())
+
+
+def get_hll_counts_wrapper(pacsdb: str, cataloguedb: str, log: str,
+                           collection: str, rebuild: bool = False,
+                           error: float = 0.01) -> None:
+    '''Wrapper for multiprocessing pool. Streams the UIDs of a collection
+       into HyperLogLog sketches, stores them and derives estimated counts
+       from the sketches of all partitions of the counted modalities in the
+       same source family.
+
+    Args:
+       pacsdb (str): Target database name.
+       cataloguedb (str): Catalogue database name.
+       log (str): Log location.
+       collection (str): Collection name.
+       rebuild (bool, optional): Discard stored sketches. Defaults to False.
+       error (float, optional): Relative standard error. Defaults to 0.01.
+    '''
+    mongo = MongoLib(log)
+    mongo.switch_db(pacsdb)
+    rows = mongo.aggregate(collection, prepare_uid_stream(collection),
+                           batch_size=10000)
+    sketches = hll_sketches(rows, error)
+
+    mongo.switch_db(cataloguedb)
+    save_hll_sketches(mongo, collection, sketches, rebuild)
+
+    modalities = list({mod for mod, _ in sketches})
+    stored = mongo.search(SKETCHES, {"_id.type": "hll",
+                                     "_id.modality": {"$in": modalities},
+                                     **source_family(collection)})
+    counts = format_hll(stored)
+
+    mongo.upsert_modalities(counts, "modalities")
+    mongo.disconnect()
+
+
+def unit_sizes(mongo: MongoLib, collection: str, field: str,
+               rows: List[Dict]) -> Dict[Tuple, int]:
+    '''Returns the number of documents of each modality and UID of the
+       sampled rows. Requires an index on the UID field, see
+       get_approx_counts_wrapper(). Rows without the UID are left out, as
+       they would match every document missing it.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the PACS database.
+        collection (str): Collection name.
+        field (str): UID field, SeriesInstanceUID or StudyInstanceUID.
+        rows (List[Dict]): Sampled rows.
+
+    Returns:
+        Dict[Tuple, int]: {(<MODALITY>, <UID>): <NUMBER OF DOCUMENTS>}
+    '''
+    key = "seriesID" if field == "SeriesInstanceUID" else "studyID"
+    uids = list({row[key] for row in rows if row.get(key, None) is not None})
+
+    if not uids:
+        return {}
+
+    query = [
+        {"$match": {field: {"$in": uids}}},
+        {"$group": {
+            "_id": {"modality": "$Modality", "uid": f"${field}"},
+            "count": {"$sum": 1}
+        }}
+    ]
+
+    return {
+        (row["_id"].get("modality", None), row["_id"].get("uid", None)): row["count"]
+        for row in mongo.aggregate(collection, query)
+    }
+
+
+def estimate_total(values: np.ndarray, population: int, z: float) -> Dict:
+    '''Estimates a population total from a simple random sample.
+
+    Args:
+        values (np.ndarray): Sampled values.
+        population (int): Number of documents the sample was drawn from.
+        z (float): Standard normal quantile of the confidence level.
+
+    Returns:
+        Dict: {"value": <ESTIMATE>, "low": <BOUND>, "high": <BOUND>}
+    '''
+    size = len(values)
+    total = population * float(values.mean())
+    fpc = max(1 - size / population, 0)
+    half = z * population * math.sqrt(fpc * float(values.var(ddof=1)) / size) if size > 1 else 0
+
+    return {"value": int(round(total)), "low": int(max(round(total - half), 0)),
+            "high": int(round(total + half))}
+
+
+def estimate_ratio(numerator: np.ndarray, denominator: np.ndarray,
+                   population: int, z: float) -> Dict:
+    '''Estimates a ratio of two population totals from a simple random
+       sample, with a linearised interval.
+
+    Args:
+        numerator (np.ndarray): Sampled numerator values.
+        denominator (np.ndarray): Sampled denominator values.
+        population (int): Number of documents the sample was drawn from.
+        z (float): Standard normal quantile of the confidence level.
+
+    Returns:
+        Dict: {"value": <ESTIMATE>, "low": <BOUND>, "high": <BOUND>}
+    '''
+    size = len(numerator)
+    mean = float(denominator.mean())
+
+    if not mean:
+        return {"value": "0.00", "low": "0.00", "high": "0.00"}
+
+    ratio = float(numerator.sum()) / float(denominator.sum())
+    fpc = max(1 - size / population, 0)
+    residuals = numerator - ratio * denominator
+    half = z * math.sqrt(fpc * float(residuals.var(ddof=1)) / size) / mean if size > 1 else 0
+
+    return {"value": "{:.2f}".format(ratio), "low": "{:.2f}".format(max(ratio - half, 0)),
+            "high": "{:.2f}".format(ratio + half)}
+
+
+def approximate_counts(rows: List[Dict], series_sizes: Dict[Tuple, int],
+                       study_sizes: Dict[Tuple, int], population: int,
+                       confidence: float) -> List[Dict]:
+    '''Estimates the counts of each modality from a uniform sample of a
+       collection, post-stratified by modality and study month. A series
+       or study is counted through each of its sampled documents, weighted
+       by the inverse of its number of documents in the collection.
+
+    Args:
+        rows (List[Dict]): Sampled rows, as projected by prepare_uid_stream().
+        series_sizes (Dict[Tuple, int]): Documents per modality and series.
+        study_sizes (Dict[Tuple, int]): Documents per modality and study.
+        population (int): Number of documents in the collection.
+        confidence (float): Confidence level of the intervals.
+
+    Returns:
+        List[Dict]: [{"modality": <MODALITY>,
+                      "approxCountsRaw": {
+                          "estimated": True,
+                          "totalNoImagesRaw": <INTERVAL>,
+                          "totalNoSeriesRaw": <INTERVAL>,
+                          "totalNoStudiesRaw": <INTERVAL>,
+                          "avgNoImagesPerSeriesRaw": <INTERVAL>,
+                          "avgNoSeriesPerStudyRaw": <INTERVAL>,
+                          "countsPerMonthRaw": [{"date": <DATE>,
+                                                 "imageCount": <INTERVAL>,
+                                                 "seriesCount": <INTERVAL>,
+                                                 "studyCount": <INTERVAL>}],
+                          ...}}]
+    '''
+    if not rows:
+        return []
+
+    z = statistics.NormalDist().inv_cdf((1 + confidence) / 2)
+    modalities = np.array([row.get("modality", None) or "" for row in rows], dtype=object)
+    months = np.array([f"{row['studyYear']}/{row['studyMonth']}"
+                       if row.get("studyYear", None) and row.get("studyMonth", None)
+                       else "" for row in rows], dtype=object)
+    images = np.array([row.get("imageCount", None) or 0 for row in rows], dtype=np.float64)
+    series = np.array([1 / series_sizes.get((row.get("modality", None), row.get("seriesID", None)), 1)
+                       for row in rows], dtype=np.float64)
+    studies = np.array([1 / study_sizes.get((row.get("modality", None), row.get("studyID", None)), 1)
+                        for row in rows], dtype=np.float64)
+    date = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+    formatted = []
+
+    for mod in sorted(set(modalities)):
+        in_mod = (modalities == mod).astype(np.float64)
+        counts_per_month = []
+
+        for month in sorted(set(months[modalities == mod]) - {""}):
+            in_month = in_mod * (months == month)
+            counts_per_month.append({
+                "date": month,
+                "imageCount": estimate_total(images * in_month, population, z),
+                "seriesCount": estimate_total(series * in_month, population, z),
+                "studyCount": estimate_total(studies * in_month, population, z)
+            })
+
+        formatted.append({
+            "modality": mod or None,
+            "approxCountsRaw": {
+                "estimated": True,
+                "totalNoImagesRaw": estimate_total(images * in_mod, population, z),
+                "totalNoSeriesRaw": estimate_total(series * in_mod, population, z),
+                "totalNoStudiesRaw": estimate_total(studies * in_mod, population, z),
+                "avgNoImagesPerSeriesRaw": estimate_ratio(images * in_mod, series * in_mod,
+                                                          population, z),
+                "avgNoSeriesPerStudyRaw": estimate_ratio(series * in_mod, studies * in_mod,
+                                                         population, z),
+                "countsPerMonthRaw": counts_per_month,
+                "sampleSize": len(rows),
+                "populationSize": population,
+                "confidence": confidence,
+                "countsDateRaw": date
+            }
+        })
+
+    return formatted
+
+
+def get_approx_counts_wrapper(pacsdb: str, cataloguedb: str, log: str,
+                              collection: str, samples: int = 2000,
+                              confidence: float = 0.95,
+                              create_indexes: bool = False) -> None:
+    '''Wrapper for multiprocessing pool. Estimates the counts of a
+       collection from its metadata document count and a random sample.
+       Series and study sizes are only looked up through existing UID
+       indexes, unless create_indexes is set.
+
+    Args:
+       pacsdb (str): Target database name.
+       cataloguedb (str): Catalogue database name.
+       log (str): Log location.
+       collection (str): Collection name.
+       samples (int, optional): Sample size. Defaults to 2000.
+       confidence (float, optional): Confidence level. Defaults to 0.95.
+       create_indexes (bool, optional): Whether to create missing UID
+                                        indexes. Defaults to False.
+    '''
+    mongo = MongoLib(log)
+    mongo.switch_db(pacsdb)
+    population = mongo.estimated_count(collection)
+    rows = mongo.sample(collection, samples,
+                        prepare_uid_stream(collection)[0]["$project"])
+    population = max(population, len(rows))
+
+    # Every series document is a series of its own
+    fields = ["StudyInstanceUID"] if collection == "series" else \
+        ["SeriesInstanceUID", "StudyInstanceUID"]
+    sizes: Dict[str, Dict[Tuple, int]] = {"SeriesInstanceUID": {}, "StudyInstanceUID": {}}
+
+    for field in fields:
+        if not mongo.has_index(collection, field):
+            if not create_indexes:
+                # Without sizes, each sampled document counts as a unit
+                logging.warning("%s has no %s index, its approximate %s counts "
+                                "are upper bounds. Use --create-indexes to build it.",
+                                collection, field,
+                                "series" if field == "SeriesInstanceUID" else "study")
+                continue
+
+            mongo.create_index(collection, field)
+
+        sizes[field] = unit_sizes(mongo, collection, field, rows)
+
+    series_sizes = sizes["SeriesInstanceUID"]
+    study_sizes = sizes["StudyInstanceUID"]
+    counts = approximate_counts(rows, series_sizes, study_sizes, population,
+                                confidence)
+
+    mongo.switch_db(cataloguedb)
+    mongo.upsert_modalities(counts, "modalities")
+    mongo.disconnect()
+
+
+def checkpoint_wrapper(wrapper, run_id: str, pacsdb: str, cataloguedb: str,
+                       log: str, collection: str, *extra_args) -> None:
+    '''Wrapper for multiprocessing pool. Runs a counts wrapper on a
+       collection and checkpoints the collection once its counts are saved.
+
+    Args:
+       wrapper (Callable): Counts wrapper, e.g. get_counts_wrapper.
+       run_id (str): Run ID.
+       pacsdb (str): Target database name.
+       cataloguedb (str): Catalogue database name.
+       log (str): Log location.
+       collection (str): Collection name.
+       extra_args: Further arguments of the counts wrapper.
+    '''
+    wrapper(pacsdb, cataloguedb, log, collection, *extra_args)
+
+    mongo = MongoLib(log)
+    mongo.switch_db(cataloguedb)
+    mongo.save_checkpoint(run_id, "mongo_counts", collection)
+    mongo.disconnect()
+
+
 def main(args: argparse.Namespace) -> None:
     '''Main function for updating modality-level counts.
 
@@ -310,32 +1515,79 @@ def main(args: argparse.Namespace) -> None:
     log = flib.setup_logging(log_path, "mongo_counts", "debug")
     logging.getLogger(log)
 
+    if args.approximate:
+        wrapper = get_approx_counts_wrapper
+        extra_args = [args.samples, args.confidence, args.create_indexes]
+    elif args.method == "rollup":
+        wrapper = get_rollup_counts_wrapper
+        extra_args = [args.rebuild]
+    elif args.method == "stream":
+        wrapper = get_stream_counts_wrapper
+        extra_args = []
+    elif args.method == "hll":
+        wrapper = get_hll_counts_wrapper
+        extra_args = [args.rebuild, args.error]
+    else:
+        wrapper = get_counts_wrapper
+        extra_args = []
+
+    mongo = MongoLib(log)
+    mongo.switch_db(cataloguedb)
+    run_id, completed = mongo.start_run("mongo_counts", args.run_id, args.resume)
+
     if extract_on == "series":
-        get_counts_wrapper(pacsdb, cataloguedb, log, "series")
+        collections = ["series"]
     else:
-        mongo = MongoLib(log)
         mongo.switch_db(pacsdb)
         collections = [col for col in mongo.list_collections() if "image_" in col]
-        mongo.disconnect()
-
-        if modality == "all":
-            with multiprocessing.Pool(processes=len(collections)) as pool:
-                for collection in collections:
-                    try:
-                        pool.apply_async(
-                            get_counts_wrapper,
-                            [pacsdb, cataloguedb, log, collection]
-                        )
-                    except Exception as error:
-                        logging.info("Process for collection %s failed: %s",
-                                     collection, error)
-
-                pool.close()
-                pool.join()
-        else:
-            for collection in collections:
-                if modality in collection:
-                    get_counts_wrapper(pacsdb, cataloguedb, log, collection)
+
+        if modality != "all":
+            collections = [col for col in collections if modality in col]
+
+    mongo.disconnect()
+
+    pending = [col for col in collections if col not in completed]
+
+    if extract_on == "series" or modality != "all":
+        for collection in pending:
+            checkpoint_wrapper(wrapper, run_id, pacsdb, cataloguedb, log,
+                               collection, *extra_args)
+    elif pending:
+        # Unlike a multiprocessing pool, a killed worker, e.g. out of memory,
+        # fails its tasks with BrokenProcessPool instead of hanging the run
+        with ProcessPoolExecutor(max_workers=len(pending),
+                                 initializer=flib.setup_worker_logging,
+                                 initargs=[log]) as pool:
+            futures = {
+                pool.submit(checkpoint_wrapper, wrapper, run_id, pacsdb,
+                            cataloguedb, log, collection, *extra_args): collection
+                for collection in pending
+            }
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except BrokenProcessPool as error:
+                    logging.error("Process for collection %s was killed: %s",
+                                  futures[future], error)
+                except Exception as error:
+                    logging.info("Process for collection %s failed: %s",
+                                 futures[future], error)
+
+    mongo = MongoLib(log)
+    mongo.switch_db(cataloguedb)
+    missing = set(collections) - mongo.load_checkpoints(run_id, "mongo_counts")
+
+    if not missing:
+        mongo.finish_run(run_id, "mongo_counts")
+
+    vlib.refresh_views(mongo)
+    mongo.disconnect()
+
+    if missing:
+        logging.warning("Collections %s were not completed. Resume with "
+                        "--resume --run-id %s", sorted(missing), run_id)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -14,12 +14,15 @@
         ]
     }
 '''
+import sys
 import argparse
 import logging
-import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Dict
 from datetime import datetime
 import modules.file_lib as flib
+import modules.view_lib as vlib
 from modules.mysql_lib import MySQLib
 from modules.mongo_lib import MongoLib
 
@@ -32,15 +35,19 @@ def argparser() -> argparse.Namespace:
     '''
     parser = argparse.ArgumentParser()
     parser.add_argument("--rdb", "-d",
-                        help=("Name of relational database. "
-                              "Default to data_load2."), type=str,
+                        help=("Names of relational databases, counted in a "
+                              "single run. Default to data_load2."), type=str,
                         required=False, choices=["data_load2", "smi", "metacat_test"],
                         nargs="+", default=["data_load2"])
     parser.add_argument("--status", "-s",
-                        help=("Status associated with database. "
-                              "Default to 'Staging'."), type=str,
+                        help=("Status associated with each database, in the "
+                              "same order. Default to 'Staging'."), type=str,
                         required=False, choices=["Live", "Staging"],
                         nargs="+", default=["Staging"])
+    parser.add_argument("--processes", "-p",
+                        help=("Maximum number of modality and database counts "
+                              "run in parallel. Default to 8."), type=int,
+                        required=False, default=8)
     parser.add_argument("--cataloguedb", "-c",
                         help="Name of catalogue database. Default to analytics.",
                         type=str, required=False, default="analytics")
@@ -49,7 +56,15 @@ def argparser() -> argparse.Namespace:
                               "Default to current directory."),
                         type=str, required=False, default=".")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if len(args.rdb) != len(args.status):
+        parser.error("--rdb and --status need the same number of values.")
+
+    if len(set(args.status)) != len(args.status):
+        parser.error("Each --status can only be given once.")
+
+    return args
 
 
 def get_modalities(database: MySQLib) -> Dict:
@@ -139,20 +154,19 @@ def month_counts(log: str, database: str, modality: Dict, status: str) -> Dict:
         else:
             image_counts = mysql.count_images_per_month(modality["modality"])
 
-    for study_count in study_counts:
-        month_count = {
-            "date": study_count[0]
-        }
+    image_months = {month: int(count) for month, count in image_counts}
+    series_months = {month: int(count) for month, count in series_counts}
 
-        for image_count in image_counts:
-            if image_count[0] == month_count["date"]:
-                month_count["imageCount"] = int(image_count[1])
+    for month, study_count in study_counts:
+        month_count = {"date": month}
 
-        for series_count in series_counts:
-            if series_count[0] == month_count["date"]:
-                month_count["seriesCount"] = int(series_count[1])
+        if month in image_months:
+            month_count["imageCount"] = image_months[month]
 
-        month_count["studyCount"] = int(study_count[1])
+        if month in series_months:
+            month_count["seriesCount"] = series_months[month]
+
+        month_count["studyCount"] = int(study_count)
 
         modality[f"countsPerMonth{status}"].append(month_count)
 
@@ -169,61 +183,86 @@ def month_counts(log: str, database: str, modality: Dict, status: str) -> Dict:
     return modality
 
 
-def get_counts_wrapper(log: str, rdb: str, cataloguedb: str, status: str,
-                       modality: Dict) -> None:
+def get_counts_wrapper(log: str, rdb: str, status: str, modality: Dict) -> Dict:
     '''Wrapper for multiprocessing pool.
 
     Args:
        log (str): Log location.
        rdb (str): Name of relational DB to connect to.
-       cataloguedb (str): Name of MongoDB catalogue database.
        status (str): Status associated with rdb (Staging|Live).
        modality (Dict): Modality dictionary containing modality name
                         and list of tables.
+
+    Returns:
+        Dict: Modality counts of the given status.
     '''
     modality = total_counts(log, rdb, modality, status)
     modality = month_counts(log, rdb, modality, status)
 
-    mongo = MongoLib(log)
-    mongo.switch_db(cataloguedb)
-    mongo.upsert_modalities([modality], "modalities")
-    mongo.disconnect()
+    return modality
 
 
 def main(args: argparse.Namespace) -> None:
-    '''Main function for updating modality-level counts.
+    '''Main function for updating modality-level counts of one or more
+       relational databases. The counts of every modality and database are
+       run in one bounded pool, and each modality is written once with the
+       counts of all statuses.
 
     Args:
         args (argparse.Namespace): Carries terminal arguments from argparse().
     '''
-    rdb = args.rdb[0]
-    status = args.status[0]
     cataloguedb = args.cataloguedb
     log_path = args.log
 
-    log = flib.setup_logging(log_path, f"mysql_counts_{rdb}", "debug")
+    log = flib.setup_logging(log_path, f"mysql_counts_{'_'.join(args.rdb)}", "debug")
     logging.getLogger(log)
 
-    mysql = MySQLib(log)
-    mysql.use_db(rdb)
+    tasks = []
 
-    modalities = get_modalities(mysql)
+    for rdb, status in zip(args.rdb, args.status):
+        mysql = MySQLib(log)
+        mysql.use_db(rdb)
 
-    mysql.disconnect()
+        modalities = get_modalities(mysql)
+
+        mysql.disconnect()
+
+        logging.info("Found %s modalities in %s (%s)", len(modalities), rdb, status)
+        tasks += [(rdb, status, modality) for modality in modalities.values()]
 
-    with multiprocessing.Pool(processes=len(modalities)) as pool:
-        for _, modality in modalities.items():
+    results: Dict[str, Dict] = {}
+
+    failed = []
+
+    with ProcessPoolExecutor(max_workers=max(min(args.processes, len(tasks)), 1),
+                             initializer=flib.setup_worker_logging, initargs=[log]) as pool:
+        pending = [
+            (rdb, status, modality["modality"],
+             pool.submit(get_counts_wrapper, log, rdb, status, modality))
+            for rdb, status, modality in tasks
+        ]
+
+        for rdb, status, mod_name, future in pending:
             try:
-                pool.apply_async(
-                    get_counts_wrapper,
-                    [log, rdb, cataloguedb, status, modality]
-                )
+                results.setdefault(mod_name, {"modality": mod_name}).update(future.result())
+            except BrokenProcessPool as error:
+                logging.error("Process for modality %s in %s was killed: %s",
+                              mod_name, rdb, error)
+                failed.append(f"{mod_name} in {rdb}")
             except Exception as error:
-                logging.info("Process for modality %s failed: %s",
-                             modality['modality'], error)
+                logging.info("Process for modality %s in %s failed: %s",
+                             mod_name, rdb, error)
+                failed.append(f"{mod_name} in {rdb}")
+
+    mongo = MongoLib(log)
+    mongo.switch_db(cataloguedb)
+    mongo.bulk_upsert(list(results.values()), "modalities", "modality")
+    vlib.refresh_views(mongo)
+    mongo.disconnect()
 
-        pool.close()
-        pool.join()
+    if failed:
+        logging.warning("Modalities %s were not counted, rerun mysql_counts.py.", failed)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -5,10 +5,16 @@
 import argparse
 import logging
 import multiprocessing
-from typing import Tuple, List, Dict
+from typing import Tuple, List, Dict, Optional
 import modules.file_lib as flib
+import modules.standard_lib as slib
+import modules.view_lib as vlib
 from modules.mongo_lib import MongoLib
 
+# Tag indexes serving the filters and orderings of the UI tag tables
+TAG_INDEXES = [["modalities", "tag"], "dicomID", "public", "promotionStatus",
+               "basicProfile", "informationEntity", "valueRepresentation"]
+
 
 def argparser() -> argparse.Namespace:
     '''Terminal argument parser function.
@@ -29,6 +35,11 @@ def argparser() -> argparse.Namespace:
                         help=("Name of catalogue database. "
                               "Default to analytics."), type=str,
                         required=False, default="analytics")
+    parser.add_argument("--standard", "-s",
+                        help=("Path of the DICOM standard lookup compiled by "
+                              "dicom_standard_import.py, to fill the standard "
+                              "metadata of new tags. Default to None."),
+                        type=str, required=False, default=None)
     parser.add_argument("--init", "-i",
                         help=("Catalogue initialise or update. "
                               "Default to False, update."), action="store_true")
@@ -136,6 +147,27 @@ def format_metadata(modalities_list: List[Dict]) -> Tuple:
     return mod_collection, tag_collection
 
 
+def add_standard_meta(tags: List[Dict], lookup: Optional[slib.StandardLookup]) -> List[Dict]:
+    '''Adds the compact DICOM standard metadata of each tag found in the
+       standard lookup.
+
+    Args:
+       tags (List[Dict]): Tags metadata.
+       lookup (Optional[StandardLookup]): Standard lookup, None to skip.
+
+    Returns:
+       List[Dict]
+    '''
+    if lookup is None:
+        return tags
+
+    for tag in tags:
+        tag.update({attr: value for attr, value in (lookup.get(tag["tag"]) or {}).items()
+                    if value is not None})
+
+    return tags
+
+
 def merge_mods(old_mods: List[Dict], new_mods: List[Dict]) -> List[Dict]:
     '''Updates old modalities metadata with new modalities metadata.
 
@@ -221,7 +253,9 @@ def main(args: argparse.Namespace) -> None:
                        if "image_" in col or col == "series"]
         col_mods_and_tags = []
 
-        with multiprocessing.Pool(processes=len(collections)) as pool:
+        with multiprocessing.Pool(processes=len(collections),
+                                  initializer=flib.setup_worker_logging,
+                                  initargs=[log]) as pool:
             async_results = [
                 pool.apply_async(list_fields_wrapper, [pacs_db, log, collection])
                 for collection in collections
@@ -238,6 +272,19 @@ def main(args: argparse.Namespace) -> None:
 
     mod_collection, tag_collection = format_metadata(col_mods_and_tags)
 
+    # Only new tags are added to the catalogue, so only their standard
+    # metadata is filled here, the rest comes from dicom_standard_import.py
+    lookup = slib.open_lookup(args.standard) if args.standard else None
+
+    if args.standard and lookup is None:
+        logging.warning("DICOM standard lookup %s unavailable, new tags "
+                        "have no standard metadata.", args.standard)
+
+    tag_collection = add_standard_meta(tag_collection, lookup)
+
+    if lookup is not None:
+        lookup.close()
+
     mongo.switch_db(catalogue_db)
 
     if init:
@@ -261,6 +308,10 @@ def main(args: argparse.Namespace) -> None:
         mongo.upsert_modalities(updated_mods, "modalities")
         mongo.upsert_tags(updated_tags, "tags")
 
+    for index in TAG_INDEXES:
+        mongo.create_index("tags", index)
+
+    vlib.refresh_views(mongo)
     mongo.disconnect()
 
 
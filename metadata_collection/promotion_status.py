@@ -5,6 +5,19 @@
         "promotionStatusDate": "<TIMESTAMP>"
    }
 
+   With --coverage, the share of raw series found in the database:
+   {
+        "percentPromoted<Staging|Live>": "<PERCENT>",
+        "percentPromotedPerMonth<Staging|Live>": [
+            {"date": "<YYYY/M>",
+             "seriesCount": <COUNT>,
+             "promotedCount": <COUNT>,
+             "percentPromoted": "<PERCENT>"}
+        ],
+        "percentPromotedError<Staging|Live>": <MEASURED FALSE POSITIVE RATE>,
+        "percentPromotedDate<Staging|Live>": "<TIMESTAMP>"
+   }
+
    Tag-level attributes:
    {
         "promotionStatus": "<blocked|unavailable|processing|available>",
@@ -13,8 +26,12 @@
 '''
 import argparse
 import logging
+from typing import Dict, List
 import modules.file_lib as flib
+import modules.view_lib as vlib
 from datetime import datetime
+from bson import Binary
+from modules.sketch_lib import BloomFilter
 from modules.mysql_lib import MySQLib
 from modules.mongo_lib import MongoLib
 
@@ -39,6 +56,22 @@ def argparser() -> argparse.Namespace:
     parser.add_argument("--cataloguedb", "-c",
                         help="Metadata database name. Default to analytics.",
                         type=str, required=False, default="analytics")
+    parser.add_argument("--coverage",
+                        help=("With processing or available, also measure the "
+                              "share of raw series promoted to the database."),
+                        action="store_true")
+    parser.add_argument("--pacsdb", "-p",
+                        help=("Name of PACS database of the raw series. "
+                              "Default to analytics."),
+                        type=str, required=False, default="analytics")
+    parser.add_argument("--error", "-e",
+                        help=("False positive rate of the coverage Bloom "
+                              "filters. Default to 0.001."), type=float,
+                        required=False, default=0.001)
+    parser.add_argument("--reuse-filters",
+                        help=("With --coverage, probe with the filters stored "
+                              "by a previous run instead of reading the "
+                              "relational series again."), action="store_true")
     parser.add_argument("--log", "-l",
                         help=("Log directory path. Default to current "
                               "directory."), type=str, required=False,
@@ -70,6 +103,136 @@ def check_data(modality, status):
     return data
 
 
+def build_filters(mysql: MySQLib, modalities: List[str],
+                  error: float) -> Dict[str, BloomFilter]:
+    '''Builds a Bloom filter of the SeriesInstanceUIDs of each modality,
+       streamed from the current relational database.
+
+    Args:
+        mysql (MySQLib): MySQLib instance.
+        modalities (List[str]): Modalities with a SeriesTable.
+        error (float): False positive rate.
+
+    Returns:
+        Dict[str, BloomFilter]: {<MODALITY>: BloomFilter}
+    '''
+    filters = {}
+
+    for mod in modalities:
+        bloom = BloomFilter(mysql.count_table(f"{mod}_SeriesTable"), error)
+
+        for (uid,) in mysql.stream_query(f"SELECT SeriesInstanceUID FROM {mod}_SeriesTable;"):
+            bloom.add(uid)
+
+        filters[mod] = bloom
+
+    return filters
+
+
+def save_filters(mongo: MongoLib, database: str, filters: Dict[str, BloomFilter],
+                 chunk_size: int = 8 << 20) -> None:
+    '''Stores the filters in the catalogue sketches collection, split into
+       chunks below the document size limit.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+        database (str): Relational database name.
+        filters (Dict[str, BloomFilter]): Output of build_filters().
+        chunk_size (int, optional): Bytes per chunk. Defaults to 8MB.
+    '''
+    date = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+
+    for mod, bloom in filters.items():
+        data = bloom.to_bytes()
+        mongo.delete_many("sketches", {"_id.type": "bloom", "_id.database": database,
+                                       "_id.modality": mod})
+        mongo.bulk_upsert([
+            {"_id": {"type": "bloom", "database": database, "modality": mod,
+                     "field": "SeriesInstanceUID", "chunk": number},
+             "sketch": Binary(data[start:start + chunk_size]),
+             "sketchDate": date}
+            for number, start in enumerate(range(0, len(data), chunk_size))
+        ], "sketches", "_id")
+
+
+def load_filters(mongo: MongoLib, database: str, modalities: List[str]) -> Dict[str, BloomFilter]:
+    '''Loads the filters stored by save_filters().
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+        database (str): Relational database name.
+        modalities (List[str]): Modalities to load.
+
+    Returns:
+        Dict[str, BloomFilter]: {<MODALITY>: BloomFilter}, without the
+                                modalities that have no stored filter.
+    '''
+    chunks: Dict[str, List] = {}
+
+    for doc in mongo.search("sketches", {"_id.type": "bloom", "_id.database": database,
+                                         "_id.modality": {"$in": modalities}}):
+        chunks.setdefault(doc["_id"]["modality"], []).append((doc["_id"]["chunk"], doc["sketch"]))
+
+    return {mod: BloomFilter.from_bytes(b"".join(bytes(data) for _, data in sorted(parts)))
+            for mod, parts in chunks.items()}
+
+
+def promotion_coverage(mongo: MongoLib, filters: Dict[str, BloomFilter],
+                       stage: str) -> List[Dict]:
+    '''Probes every raw series against the filter of its modality in a
+       single pass over the series collection.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the PACS database.
+        filters (Dict[str, BloomFilter]): Output of build_filters().
+        stage (str): Staging or Live.
+
+    Returns:
+        List[Dict]: [{"modality": <MODALITY>,
+                      "percentPromoted<STAGE>": <PERCENT>, ...}]
+    '''
+    counts: Dict[str, Dict] = {}
+    selection = {"_id": 0, "Modality": 1, "SeriesInstanceUID": 1, "StudyDate": 1}
+
+    for series in mongo.search("series", {"Modality": {"$in": list(filters)}}, selection):
+        mod = series.get("Modality", None)
+        month = flib.study_month(series.get("StudyDate", None))
+        promoted = series.get("SeriesInstanceUID", None) in filters[mod]
+
+        for key in ("all", month):
+            if key is None:
+                continue
+
+            count = counts.setdefault(mod, {}).setdefault(key, [0, 0])
+            count[0] += 1
+            count[1] += promoted
+
+    def _percent(total, promoted):
+        return "{:.2f}".format(100 * promoted / total) if total else "0.00"
+
+    date = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+    coverage = []
+
+    for mod, months in counts.items():
+        total, promoted = months.pop("all")
+        coverage.append({
+            "modality": mod,
+            f"percentPromoted{stage}": _percent(total, promoted),
+            f"percentPromotedPerMonth{stage}": [
+                {"date": month, "seriesCount": month_total,
+                 "promotedCount": month_promoted,
+                 "percentPromoted": _percent(month_total, month_promoted)}
+                for month, (month_total, month_promoted) in sorted(
+                    months.items(), key=lambda item: datetime.strptime(item[0], "%Y/%m")
+                )
+            ],
+            f"percentPromotedError{stage}": filters[mod].error,
+            f"percentPromotedDate{stage}": date
+        })
+
+    return coverage
+
+
 def main(args: argparse.Namespace) -> None:
     '''Main function for extracting a modality's metadata to JSON file.
 
@@ -92,6 +255,7 @@ def main(args: argparse.Namespace) -> None:
 
     mod_upsert = []
     tag_upsert = []
+    coverage = []
 
     if status == "blocked":
         mod_blocklist = [mod["modality"] for mod in mongo.search("modality_blocklist")]
@@ -133,6 +297,23 @@ def main(args: argparse.Namespace) -> None:
             for col in mysql.list_table_columns(table[0]):
                 columns.append(col[0])
 
+        if args.coverage:
+            series_mods = sorted({table[0].split("_", 1)[0] for table in tables
+                                  if table[0].endswith("_SeriesTable")})
+            filters = load_filters(mongo, database, series_mods) if args.reuse_filters else {}
+            missing = [mod for mod in series_mods if mod not in filters]
+
+            if missing:
+                built = build_filters(mysql, missing, args.error)
+                save_filters(mongo, database, built)
+                filters.update(built)
+
+            mongo.switch_db(args.pacsdb)
+            coverage = promotion_coverage(
+                mongo, filters, "Staging" if status == "processing" else "Live"
+            )
+            mongo.switch_db(cataloguedb)
+
         mysql.disconnect()
 
         for mod in mod_meta:
@@ -166,6 +347,11 @@ def main(args: argparse.Namespace) -> None:
         tag_upsert = add_timestamp(tag_upsert)
         mongo.upsert_tags(tag_upsert, "tags")
 
+    # After the status, whose upserts write back whole modality documents
+    if coverage:
+        mongo.upsert_modalities(coverage, "modalities")
+
+    vlib.refresh_views(mongo)
     mongo.disconnect()
 
 
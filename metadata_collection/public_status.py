@@ -8,6 +8,7 @@ import re
 import logging
 import argparse
 import modules.file_lib as flib
+import modules.view_lib as vlib
 from modules.mongo_lib import MongoLib
 
 
@@ -58,6 +59,7 @@ def main(args: argparse.Namespace) -> None:
 
     # Update tags in database
     mongo.upsert_tags(tags, "tags")
+    vlib.refresh_views(mongo)
 
     mongo.disconnect()
 
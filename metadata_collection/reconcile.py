@@ -0,0 +1,318 @@
+'''Reconciliation of raw and relational series.
+   Streams the SeriesInstanceUIDs of each modality in sorted order from the
+   raw database and from a relational database, merge-joins them without
+   holding either side in memory and reports the series missing from, or
+   extra to, the relational database.
+   Modality-level attributes:
+   {
+       "reconciliation<Staging|Live>": {
+           "matchedSeries": <COUNT>,
+           "missingSeries": <COUNT>,
+           "extraSeries": <COUNT>,
+           "perMonth": [
+               {"date": <YYYY/M>,
+                "matchedSeries": <COUNT>,
+                "missingSeries": <COUNT>,
+                "extraSeries": <COUNT>
+               }
+           ],
+           "reconciliationDate": <TIMESTAMP>
+       }
+   }
+'''
+import csv
+import argparse
+import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from datetime import datetime
+import modules.file_lib as flib
+from modules.mysql_lib import MySQLib
+from modules.mongo_lib import MongoLib
+
+
+def argparser() -> argparse.Namespace:
+    '''Terminal argument parser function.
+
+    Returns:
+        argparse.Namespace: Terminal arguments.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pacsdb", "-d",
+                        help="Name of PACS database. Default to analytics.",
+                        type=str, required=False, default="analytics")
+    parser.add_argument("--on", "-o",
+                        help=("Whether to read raw series from the series "
+                              "collection or the image_<MODALITY> "
+                              "collections. Default to series."), type=str,
+                        required=False, choices=["series", "modality"],
+                        default="series")
+    parser.add_argument("--rdb", "-r",
+                        help=("Name of relational database. "
+                              "Default to data_load2."), type=str,
+                        required=False, default="data_load2")
+    parser.add_argument("--status", "-s",
+                        help=("Status associated with the relational database. "
+                              "Default to 'Staging'."), type=str,
+                        required=False, choices=["Live", "Staging"],
+                        default="Staging")
+    parser.add_argument("--modality", "-m",
+                        help="Modality to reconcile. Default to all.",
+                        type=str, required=False, default="all")
+    parser.add_argument("--cataloguedb", "-c",
+                        help="Name of catalogue database. Default to analytics.",
+                        type=str, required=False, default="analytics")
+    parser.add_argument("--output", "-f",
+                        help=("Path of a CSV file listing every missing and "
+                              "extra series. Default to none."), type=str,
+                        required=False, default=None)
+    parser.add_argument("--create-indexes",
+                        help=("Create the (Modality, SeriesInstanceUID) "
+                              "indexes that stream raw series in order, if "
+                              "missing. Building them on large collections "
+                              "takes as long as a full count."),
+                        action="store_true")
+    parser.add_argument("--log", "-l",
+                        help=("Log directory path. Default to current"
+                              " directory."),
+                        type=str, required=False, default=".")
+
+    return parser.parse_args()
+
+
+def check_index(mongo: MongoLib, collection: str, create: bool = False) -> None:
+    '''Checks the (Modality, SeriesInstanceUID) index through which raw
+       series are streamed in order, creating it if asked. Without it, the
+       server sorts every document of each modality before the first one
+       is returned.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the PACS database.
+        collection (str): Collection name.
+        create (bool, optional): Whether to create a missing index.
+                                 Defaults to False.
+    '''
+    index = ["Modality", "SeriesInstanceUID"]
+
+    if mongo.has_index(collection, index):
+        return
+
+    if create:
+        mongo.create_index(collection, index)
+    else:
+        logging.warning("%s has no (Modality, SeriesInstanceUID) index, its "
+                        "series are sorted in full on the server. Use "
+                        "--create-indexes to build it.", collection)
+
+
+def raw_series(mongo: MongoLib, collection: str, modality: str) -> Iterator[Tuple[str, Optional[str]]]:
+    '''Streams the sorted series of a modality from the raw database, in
+       the order of the index checked by check_index().
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the PACS database.
+        collection (str): Collection name.
+        modality (str): Modality name.
+
+    Yields:
+        Tuple[str, Optional[str]]: (<SeriesInstanceUID>, <YYYY/M>)
+    '''
+    docs = mongo.search_sorted(
+        collection, {"Modality": modality},
+        {"_id": 0, "SeriesInstanceUID": 1, "StudyDate": 1},
+        "SeriesInstanceUID"
+    )
+
+    for doc in docs:
+        yield doc.get("SeriesInstanceUID", None), flib.study_month(doc.get("StudyDate", None))
+
+
+def relational_series(database: MySQLib, modality: str) -> Iterator[Tuple[str, Optional[str]]]:
+    '''Streams the sorted series of a modality from the relational database.
+
+    Args:
+        database (MySQLib): MySQLib instance.
+        modality (str): Modality name.
+
+    Yields:
+        Tuple[str, Optional[str]]: (<SeriesInstanceUID>, <YYYY/M>)
+    '''
+    query = ("SELECT Se.SeriesInstanceUID, "
+             "CONCAT(YEAR(St.StudyDate), '/', MONTH(St.StudyDate)) "
+             f"FROM {modality}_SeriesTable Se "
+             f"LEFT JOIN {modality}_StudyTable St "
+             "ON Se.StudyInstanceUID = St.StudyInstanceUID "
+             "ORDER BY Se.SeriesInstanceUID;")
+
+    yield from database.stream_query(query)
+
+
+def distinct_sorted(rows: Iterable[Tuple], side: str) -> Iterator[Tuple]:
+    '''Skips repeated UIDs of a sorted stream, e.g. the images of a series,
+       and checks that the stream is sorted.
+
+    Args:
+        rows (Iterable[Tuple]): (<UID>, <MONTH>) sorted by UID.
+        side (str): Name of the stream, for errors.
+
+    Raises:
+        ValueError: If the stream is not sorted.
+
+    Yields:
+        Tuple: (<UID>, <MONTH>)
+    '''
+    last = None
+
+    for uid, month in rows:
+        if uid is None or uid == last:
+            continue
+
+        if last is not None and uid < last:
+            raise ValueError(f"{side} series are not sorted: {uid} after {last}. "
+                             "Check that the collations compare UIDs bytewise.")
+
+        last = uid
+        yield uid, month
+
+
+def merge_join(raw: Iterable[Tuple], relational: Iterable[Tuple]) -> Iterator[Tuple]:
+    '''Merge-joins two sorted series streams.
+
+    Args:
+        raw (Iterable[Tuple]): Sorted raw (<UID>, <MONTH>).
+        relational (Iterable[Tuple]): Sorted relational (<UID>, <MONTH>).
+
+    Yields:
+        Tuple: (<RAW (UID, MONTH)|None>, <RELATIONAL (UID, MONTH)|None>),
+               None marking a series absent from that side.
+    '''
+    raw = distinct_sorted(raw, "Raw")
+    relational = distinct_sorted(relational, "Relational")
+    left = next(raw, None)
+    right = next(relational, None)
+
+    while left is not None or right is not None:
+        if right is None or (left is not None and left[0] < right[0]):
+            yield left, None
+            left = next(raw, None)
+        elif left is None or right[0] < left[0]:
+            yield None, right
+            right = next(relational, None)
+        else:
+            yield left, right
+            left = next(raw, None)
+            right = next(relational, None)
+
+
+def reconcile(joined: Iterable[Tuple], writer=None, modality: str = None) -> Dict:
+    '''Counts matched, missing and extra series overall and per month.
+       Matched and missing series count in their raw month, extra series
+       in their relational month.
+
+    Args:
+        joined (Iterable[Tuple]): Output of merge_join().
+        writer (csv.writer, optional): Writer receiving every missing and
+                                       extra series. Defaults to None.
+        modality (str, optional): Modality name written to the CSV.
+
+    Returns:
+        Dict: Reconciliation attribute of the modality.
+    '''
+    totals = {"matchedSeries": 0, "missingSeries": 0, "extraSeries": 0}
+    months: Dict[Optional[str], Dict] = {}
+
+    for raw, relational in joined:
+        if relational is None:
+            key, (uid, month) = "missingSeries", raw
+        elif raw is None:
+            key, (uid, month) = "extraSeries", relational
+        else:
+            key, (uid, month) = "matchedSeries", raw
+
+        totals[key] += 1
+        counts = months.setdefault(month, {"matchedSeries": 0, "missingSeries": 0,
+                                           "extraSeries": 0})
+        counts[key] += 1
+
+        if writer is not None and key != "matchedSeries":
+            writer.writerow([modality, uid, month, key])
+
+    per_month = [{"date": month, **counts} for month, counts in months.items()
+                 if month is not None]
+
+    return {
+        **totals,
+        "perMonth": sorted(per_month, key=lambda count: datetime.strptime(count["date"], "%Y/%m")),
+        "reconciliationDate": datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+    }
+
+
+def main(args: argparse.Namespace) -> None:
+    '''Main function reconciling raw and relational series per modality.
+
+    Args:
+        args (argparse.Namespace): Carries terminal arguments from argparse().
+    '''
+    log = flib.setup_logging(args.log, "reconcile", "debug")
+    logging.getLogger(log)
+
+    mongo = MongoLib(log)
+    mongo.switch_db(args.pacsdb)
+    mysql = MySQLib(log)
+    mysql.use_db(args.rdb)
+
+    relational_mods = {table[0].split("_", 1)[0] for table in mysql.list_tables()
+                       if table[0].endswith("_SeriesTable")}
+
+    if args.on == "series":
+        raw_mods = {mod: "series" for mod in mongo.get_field_values("series", "Modality")
+                    if mod}
+    else:
+        raw_mods = {col.split("_", 1)[1]: col for col in mongo.list_collections()
+                    if col.startswith("image_")}
+
+    # A modality on one side only is entirely missing or extra
+    modalities = sorted(raw_mods.keys() | relational_mods)
+
+    if args.modality != "all":
+        modalities = [mod for mod in modalities if mod == args.modality]
+
+    output = open(args.output, "w", encoding="utf-8", newline="") if args.output else None
+    writer = csv.writer(output) if output else None
+    results: List[Dict] = []
+
+    if writer is not None:
+        writer.writerow(["modality", "SeriesInstanceUID", "date", "status"])
+
+    for collection in sorted({raw_mods[mod] for mod in modalities if mod in raw_mods}):
+        check_index(mongo, collection, args.create_indexes)
+
+    try:
+        for mod in modalities:
+            if mod not in relational_mods:
+                logging.warning("%s has no series table in %s.", mod, args.rdb)
+            elif mod not in raw_mods:
+                logging.warning("%s has no raw series in %s.", mod, args.pacsdb)
+
+            raw = raw_series(mongo, raw_mods[mod], mod) if mod in raw_mods else iter(())
+            relational = relational_series(mysql, mod) if mod in relational_mods else iter(())
+            joined = merge_join(raw, relational)
+            result = reconcile(joined, writer, mod)
+            results.append({"modality": mod, f"reconciliation{args.status}": result})
+
+            logging.info("%s: %s matched, %s missing and %s extra series in %s.",
+                         mod, result["matchedSeries"], result["missingSeries"],
+                         result["extraSeries"], args.rdb)
+    finally:
+        if output is not None:
+            output.close()
+
+    mysql.disconnect()
+
+    mongo.switch_db(args.cataloguedb)
+    mongo.upsert_modalities(results, "modalities")
+    mongo.disconnect()
+
+
+if __name__ == '__main__':
+    commands = argparser()
+    main(commands)
@@ -9,12 +9,15 @@
        ]
    }
 '''
+import sys
 import argparse
 import logging
-import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from typing import List
 from datetime import datetime
 import modules.file_lib as flib
+import modules.view_lib as vlib
 from modules.mongo_lib import MongoLib
 
 
@@ -39,6 +42,14 @@ def argparser() -> argparse.Namespace:
                         help=("Database where catalogue lives. Default to "
                               "analytics."), type=str, required=False,
                         default="analytics")
+    parser.add_argument("--run-id",
+                        help=("ID of the run, recorded with each completed "
+                              "tag. Default to the start time."),
+                        type=str, required=False, default=None)
+    parser.add_argument("--resume",
+                        help=("Skip the tags completed by the run given with "
+                              "--run-id, or by the last unfinished run."),
+                        action="store_true")
     parser.add_argument("--log", "-l",
                         help=("Log directory path. Default to current"
                               " directory."),
@@ -52,7 +63,7 @@ def custom_error_callback(error):
 
 
 def tag_quality_wrapper(database: str, cataloguedb: str, log: str,
-                        tag: str, modalities: List) -> None:
+                        tag: str, modalities: List, run_id: str = None) -> None:
     '''Wrapper for Mongo multiprocessing pool.
        Creates and runs a query for a tag.
        Saves facet output to catalogue.
@@ -63,6 +74,8 @@ def tag_quality_wrapper(database: str, cataloguedb: str, log: str,
         log (str): Log path start a new database connection.
         tag (str): Tag name.
         modalities (List): Dictionary of modalities.
+        run_id (str, optional): Run ID checkpointing the tag once saved.
+                                Defaults to None.
     '''
     logging.info("Processing tag %s", tag)
     mongo = MongoLib(log)
@@ -92,6 +105,9 @@ def tag_quality_wrapper(database: str, cataloguedb: str, log: str,
                             modality["modality"], tag_meta, "modalities"
                         )
 
+    if run_id is not None:
+        mongo.save_checkpoint(run_id, "tag_quality", tag)
+
     mongo.disconnect()
 
 
@@ -135,13 +151,41 @@ def main(args: argparse.Namespace) -> None:
 
     logging.info("Extracted %s tags of priority %s from catalogue", len(tags_meta), priority)
 
-    starmap = [(database, cataloguedb, log, tag["tag"], mod_meta) for tag in tags_meta]
+    run_id, completed = mongo.start_run("tag_quality", args.run_id, args.resume)
+    mongo.disconnect()
+
+    starmap = [(database, cataloguedb, log, tag["tag"], mod_meta, run_id)
+               for tag in tags_meta if tag["tag"] not in completed]
+
+    # A killed worker breaks the pool, leaving the remaining tags to --resume
+    with ProcessPoolExecutor(50, initializer=flib.setup_worker_logging,
+                             initargs=[log]) as pool:
+        futures = [pool.submit(tag_quality_wrapper, *task) for task in starmap]
+
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except BrokenProcessPool as error:
+                logging.error("A tag process was killed, remaining tags are "
+                              "not completed: %s", error)
+                break
+            except Exception as error:
+                custom_error_callback(error)
 
-    with multiprocessing.Pool(50) as pool:
-        pool.starmap_async(tag_quality_wrapper, starmap, chunksize=50, error_callback=custom_error_callback)
+    mongo = MongoLib(log)
+    mongo.switch_db(cataloguedb)
+    missing = len({tag["tag"] for tag in tags_meta} - mongo.load_checkpoints(run_id, "tag_quality"))
+
+    if not missing:
+        mongo.finish_run(run_id, "tag_quality")
+
+    vlib.refresh_views(mongo)
+    mongo.disconnect()
 
-        pool.close()
-        pool.join()
+    if missing:
+        logging.warning("%s tags were not completed. Resume with --resume --run-id %s",
+                        missing, run_id)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,251 @@
+'''UID integrity of the raw collections.
+   Detects images sharing a SOPInstanceUID and images whose
+   SeriesInstanceUID has no series document, by sorting the UIDs of the
+   image_* and series collections on local disk and merging them.
+   Modality-level attributes:
+   {
+       "duplicateImagesRaw": <NUMBER OF IMAGES REPEATING A SOPInstanceUID>,
+       "duplicateUIDsRaw": <NUMBER OF REPEATED SOPInstanceUIDs>,
+       "orphanImagesRaw": <NUMBER OF IMAGES WITHOUT SERIES DOCUMENT>,
+       "orphanSeriesRaw": <NUMBER OF SERIES WITHOUT SERIES DOCUMENT>,
+       "integrityDateRaw": <TIMESTAMP>
+   }
+'''
+import csv
+import random
+import argparse
+import logging
+from contextlib import ExitStack
+from itertools import groupby
+from typing import Dict, Iterable, Iterator, List, Tuple
+from datetime import datetime
+import modules.file_lib as flib
+from modules.mongo_lib import MongoLib
+
+COUNTS = ("duplicateImagesRaw", "duplicateUIDsRaw", "orphanImagesRaw",
+          "orphanSeriesRaw")
+
+
+def argparser() -> argparse.Namespace:
+    '''Terminal argument parser function.
+
+    Returns:
+        argparse.Namespace: Terminal arguments.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pacsdb", "-d",
+                        help="Name of PACS database. Default to analytics.",
+                        type=str, required=False, default="analytics")
+    parser.add_argument("--cataloguedb", "-c",
+                        help="Name of catalogue database. Default to analytics.",
+                        type=str, required=False, default="analytics")
+    parser.add_argument("--tmp", "-t",
+                        help=("Directory of the sorted runs. Default to the "
+                              "system temporary directory."), type=str,
+                        required=False, default=None)
+    parser.add_argument("--run-size", "-r",
+                        help=("Number of UIDs sorted in memory at a time. "
+                              "Default to 1000000."), type=int,
+                        required=False, default=1000000)
+    parser.add_argument("--samples", "-n",
+                        help=("Number of offending UIDs sampled per modality "
+                              "and problem. Default to 100."), type=int,
+                        required=False, default=100)
+    parser.add_argument("--output", "-f",
+                        help=("Path of the CSV file of sampled offending UIDs. "
+                              "Default to uid_integrity_samples.csv."),
+                        type=str, required=False,
+                        default="uid_integrity_samples.csv")
+    parser.add_argument("--log", "-l",
+                        help=("Log directory path. Default to current"
+                              " directory."),
+                        type=str, required=False, default=".")
+
+    return parser.parse_args()
+
+
+class Reservoir:
+    '''Uniform random sample of a stream of offending UIDs.
+    '''
+    def __init__(self, size: int, seed: int = 0):
+        self.size = size
+        self.seen = 0
+        self.rows: List[Tuple] = []
+        self.random = random.Random(seed)
+
+    def add(self, row: Tuple) -> None:
+        '''Offers a row to the sample.
+
+        Args:
+            row (Tuple): Row.
+        '''
+        self.seen += 1
+
+        if len(self.rows) < self.size:
+            self.rows.append(row)
+        else:
+            position = self.random.randrange(self.seen)
+
+            if position < self.size:
+                self.rows[position] = row
+
+
+def sort_uids(mongo: MongoLib, sorts: ExitStack, tmp_dir: str, run_size: int) -> Tuple:
+    '''Streams the UIDs of the image_* and series collections into external
+       sorts, reading every collection once. Series documents without a
+       SeriesInstanceUID are left out, as no image can belong to them.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the PACS database.
+        sorts (ExitStack): Removes the sorted runs on exit.
+        tmp_dir (str): Directory of the sorted runs.
+        run_size (int): Rows sorted in memory at a time.
+
+    Returns:
+        Tuple: (<IMAGES BY (MODALITY, SOPInstanceUID, COLLECTION)>,
+                <IMAGES BY (SeriesInstanceUID, MODALITY, SOPInstanceUID)>,
+                <SERIES BY (SeriesInstanceUID,)>,
+                {<MODALITY>})
+    '''
+    by_sop = sorts.enter_context(flib.ExternalSort(tmp_dir, run_size))
+    by_series = sorts.enter_context(flib.ExternalSort(tmp_dir, run_size))
+    series = sorts.enter_context(flib.ExternalSort(tmp_dir, run_size))
+    selection = {"_id": 0, "Modality": 1, "SOPInstanceUID": 1, "SeriesInstanceUID": 1}
+    modalities = set()
+
+    for collection in mongo.list_collections():
+        if collection == "series":
+            for doc in mongo.search(collection, {}, {"_id": 0, "SeriesInstanceUID": 1}):
+                if doc.get("SeriesInstanceUID", None) is not None:
+                    series.add((doc["SeriesInstanceUID"],))
+        elif collection.startswith("image_"):
+            for doc in mongo.search(collection, {}, selection):
+                mod = doc.get("Modality", None) or ""
+                modalities.add(mod)
+                by_sop.add((mod, doc.get("SOPInstanceUID", None), collection))
+                by_series.add((doc.get("SeriesInstanceUID", None), mod,
+                               doc.get("SOPInstanceUID", None)))
+
+        logging.info("Sorted UIDs of %s.", collection)
+
+    return by_sop, by_series, series, modalities
+
+
+def find_duplicates(by_sop: Iterable[Tuple], counts: Dict, samples: Dict,
+                    sample_size: int) -> None:
+    '''Counts the images repeating a SOPInstanceUID within a modality.
+
+    Args:
+        by_sop (Iterable[Tuple]): Images sorted by (modality, SOPInstanceUID).
+        counts (Dict): {<MODALITY>: {<COUNT>: <NUMBER>}}, updated in place.
+        samples (Dict): {(<MODALITY>, <PROBLEM>): Reservoir}, updated in place.
+        sample_size (int): Reservoir size.
+    '''
+    for (mod, sop), images in groupby(by_sop, key=lambda row: row[:2]):
+        if not sop or sop == flib.MISSING:
+            continue
+
+        collections = [row[2] for row in images]
+
+        if len(collections) > 1:
+            mod_counts = counts.setdefault(mod, dict.fromkeys(COUNTS, 0))
+            mod_counts["duplicateImagesRaw"] += len(collections) - 1
+            mod_counts["duplicateUIDsRaw"] += 1
+            samples.setdefault((mod, "duplicate"), Reservoir(sample_size)).add(
+                (sop, len(collections), ";".join(sorted(set(collections))))
+            )
+
+
+def find_orphans(by_series: Iterable[Tuple], series: Iterable[Tuple], counts: Dict,
+                 samples: Dict, sample_size: int) -> None:
+    '''Counts the images and series without a series document, by merging
+       the images sorted by series with the sorted series documents. Images
+       without a SeriesInstanceUID are orphans.
+
+    Args:
+        by_series (Iterable[Tuple]): Images sorted by SeriesInstanceUID.
+        series (Iterable[Tuple]): Series documents sorted by SeriesInstanceUID.
+        counts (Dict): {<MODALITY>: {<COUNT>: <NUMBER>}}, updated in place.
+        samples (Dict): {(<MODALITY>, <PROBLEM>): Reservoir}, updated in place.
+        sample_size (int): Reservoir size.
+    '''
+    documented: Iterator[Tuple] = iter(series)
+    current = next(documented, None)
+
+    for (series_uid, mod), images in groupby(by_series, key=lambda row: row[:2]):
+        while current is not None and current[0] < series_uid:
+            current = next(documented, None)
+
+        if current is not None and current[0] == series_uid != flib.MISSING:
+            continue
+
+        number = sum(1 for _ in images)
+        mod_counts = counts.setdefault(mod, dict.fromkeys(COUNTS, 0))
+        mod_counts["orphanImagesRaw"] += number
+        mod_counts["orphanSeriesRaw"] += 1
+        samples.setdefault((mod, "orphan"), Reservoir(sample_size)).add(
+            ("" if series_uid == flib.MISSING else series_uid, number, "")
+        )
+
+    # Drain the series sort so that its runs are removed
+    for _ in documented:
+        pass
+
+
+def write_samples(samples: Dict, output: str) -> None:
+    '''Writes the sampled offending UIDs to a CSV file.
+
+    Args:
+        samples (Dict): {(<MODALITY>, <PROBLEM>): Reservoir}
+        output (str): CSV file path.
+    '''
+    with open(output, "w", encoding="utf-8", newline="") as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(["modality", "problem", "uid", "images", "collections"])
+
+        for (mod, problem), reservoir in sorted(samples.items()):
+            for row in reservoir.rows:
+                writer.writerow([mod, problem, *row])
+
+    logging.info("Saved sampled offending UIDs to %s", output)
+
+
+def main(args: argparse.Namespace) -> None:
+    '''Main function detecting duplicate and orphan images.
+
+    Args:
+        args (argparse.Namespace): Carries terminal arguments from argparse().
+    '''
+    log = flib.setup_logging(args.log, "uid_integrity", "debug")
+    logging.getLogger(log)
+
+    mongo = MongoLib(log)
+    mongo.switch_db(args.pacsdb)
+
+    counts: Dict[str, Dict] = {}
+    samples: Dict[Tuple, Reservoir] = {}
+
+    # The sorted runs are removed even if reading or merging fails
+    with ExitStack() as sorts:
+        by_sop, by_series, series, modalities = sort_uids(mongo, sorts, args.tmp,
+                                                          args.run_size)
+        find_duplicates(by_sop, counts, samples, args.samples)
+        find_orphans(by_series, series, counts, samples, args.samples)
+
+    write_samples(samples, args.output)
+
+    date = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+    results = [
+        {"modality": mod or None, **counts.get(mod, dict.fromkeys(COUNTS, 0)),
+         "integrityDateRaw": date}
+        for mod in modalities
+    ]
+
+    mongo.switch_db(args.cataloguedb)
+    mongo.upsert_modalities(results, "modalities")
+    mongo.disconnect()
+
+
+if __name__ == '__main__':
+    commands = argparser()
+    main(commands)
@@ -2,15 +2,26 @@
    manipulation, terminal commands etc.
 '''
 import os
+import re
 import sys
 import glob
 import csv
 import json
+import heapq
+import shutil
 import logging
+import tempfile
 from pathlib import Path
 from datetime import datetime, timedelta
 from bson import json_util
-from typing import List, Union, Dict, Tuple
+from typing import List, Union, Dict, Tuple, Iterator, Iterable
+
+# Rest of a number read in part, e.g. ".5" of "2.5"
+NUMBER_TAIL_RE = re.compile(r"[0-9.eE+-]*")
+# Stored by ExternalSort in place of None, sorted before any other value
+MISSING = "\x00"
+LOG_FORMAT = "%(asctime)s %(levelname)-8s %(message)s"
+LOG_DATEFMT = "%Y-%m-%d %H:%M:%S"
 
 
 def setup_logging(log_path: str, log_name: str, level: str) -> str:
@@ -24,8 +35,13 @@ def setup_logging(log_path: str, log_name: str, level: str) -> str:
         level (str): INFO|DEBUG
 
     Returns:
-        str: Current run log path and name.
+        str: Current run log path and name, or the log already set up in
+             this process, e.g. by a long-running service.
     '''
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.FileHandler):
+            return handler.baseFilename
+
     now = datetime.now()
     filename = os.path.join(log_path, (f"{now.year}-{now.month:02}-"
                                        f"{now.day:02}_{now.hour:02}-"
@@ -42,8 +58,8 @@ def setup_logging(log_path: str, log_name: str, level: str) -> str:
         log_handlers.append(logging.StreamHandler(sys.stdout))
 
     logging.basicConfig(
-        format="%(asctime)s %(levelname)-8s %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
+        format=LOG_FORMAT,
+        datefmt=LOG_DATEFMT,
         level=getattr(logging, level.upper()),
         handlers=log_handlers,
     )
@@ -51,6 +67,21 @@ def setup_logging(log_path: str, log_name: str, level: str) -> str:
     return filename
 
 
+def setup_worker_logging(log: str) -> None:
+    '''Initialiser of multiprocessing pools, logging workers to the log of
+       the parent process. Forked workers inherit the handlers of their
+       parent, spawned workers, e.g. in the collector service, do not.
+
+    Args:
+        log (str): Log path and name returned by setup_logging().
+    '''
+    if logging.getLogger().handlers:
+        return
+
+    logging.basicConfig(format=LOG_FORMAT, datefmt=LOG_DATEFMT, level=logging.DEBUG,
+                        handlers=[logging.FileHandler(log, mode="a")])
+
+
 def json_dump(data: Union[Dict, List], filename: str) -> None:
     '''Dumps dictionary to JSON file.
 
@@ -96,6 +127,149 @@ def load_json(json_path: str) -> dict:
     return data
 
 
+def iter_json(json_path: str, chunk_size: int = 1 << 16) -> Iterator[Dict]:
+    '''Incrementally parses a JSON file containing a top-level array and
+       yields one element at a time, so that only the current element and
+       a read buffer are held in memory.
+
+    Args:
+        json_path (str): Path and name of input JSON file.
+        chunk_size (int, optional): Number of characters read at a time.
+                                    Defaults to 64k.
+
+    Raises:
+        ValueError: If the file is not a valid JSON array or is truncated.
+
+    Yields:
+        Dict: Array element.
+    '''
+    decoder = json.JSONDecoder()
+
+    with open(json_path, encoding="utf-8") as json_file:
+        buffer = json_file.read(chunk_size)
+
+        # Leading whitespace may span several reads
+        while buffer and buffer.isspace():
+            buffer = json_file.read(chunk_size)
+
+        buffer = buffer.lstrip()
+        eof = not buffer
+
+        if not buffer.startswith("["):
+            raise ValueError(f"{json_path} does not contain a JSON array")
+
+        pos = 1
+
+        while True:
+            # Skip separators between elements
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+                following = end
+
+                while following < len(buffer) and buffer[following] in " \t\r\n":
+                    following += 1
+
+                # An element is complete once followed by a separator, e.g.
+                # "2" of "2.5" split across reads is followed by ".5"
+                if (following < len(buffer) and buffer[following] in ",]") or eof:
+                    yield element
+                    pos = end
+                    continue
+
+                if following < len(buffer) and not NUMBER_TAIL_RE.fullmatch(buffer, end):
+                    raise ValueError(f"{json_path} is not a valid JSON array")
+            except json.JSONDecodeError as error:
+                if eof:
+                    raise ValueError(f"{json_path} is truncated") from error
+
+            chunk = json_file.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+            if eof and not buffer.strip():
+                raise ValueError(f"{json_path} is truncated")
+
+
+class ExternalSort:
+    '''Sorts rows of strings larger than memory. Rows are buffered up to
+       run_size, written to disk as sorted runs, and merged when iterated.
+       Values must not contain tabs or newlines. The runs are removed once
+       iterated, or on leaving the sort as a context manager.
+    '''
+    def __init__(self, tmp_dir: str = None, run_size: int = 1000000):
+        self.run_size = run_size
+        self.tmp_dir = tempfile.mkdtemp(prefix="external_sort_", dir=tmp_dir)
+        self.buffer: List[Tuple] = []
+        self.runs: List[str] = []
+        self.count = 0
+
+    def add(self, row: Iterable) -> None:
+        '''Adds a row.
+
+        Args:
+            row (Iterable): Row of values, None is stored as MISSING, so that
+                            it is told apart from empty strings.
+        '''
+        self.buffer.append(tuple(MISSING if value is None else str(value) for value in row))
+        self.count += 1
+
+        if len(self.buffer) >= self.run_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        self.buffer.sort()
+        path = os.path.join(self.tmp_dir, f"run_{len(self.runs)}.tsv")
+
+        with open(path, "w", encoding="utf-8") as run:
+            run.writelines("\t".join(row) + "\n" for row in self.buffer)
+
+        self.runs.append(path)
+        self.buffer = []
+
+    def _read_run(self, path: str) -> Iterator[Tuple]:
+        with open(path, encoding="utf-8") as run:
+            for line in run:
+                yield tuple(line.rstrip("\n").split("\t"))
+
+    def __iter__(self) -> Iterator[Tuple]:
+        '''Yields all rows in sorted order. The sort can only be iterated
+           once, after which its files are removed.
+        '''
+        try:
+            if self.runs:
+                if self.buffer:
+                    self._flush()
+
+                logging.info("Merging %s sorted runs of %s rows.", len(self.runs),
+                             self.count)
+                yield from heapq.merge(*(self._read_run(path) for path in self.runs))
+            else:
+                self.buffer.sort()
+                yield from self.buffer
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        '''Removes the sorted runs.
+        '''
+        self.buffer = []
+        self.runs = []
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def __enter__(self) -> "ExternalSort":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
 def load_csv(csv_path) -> List:
     '''Loads CSV and returns a list.
 
@@ -167,6 +341,24 @@ def split_path(file_path: str) -> Tuple[str, str]:
     return path, filename
 
 
+def study_month(study_date: str) -> Union[str, None]:
+    '''Returns the study month of a DICOM study date, formatted as the
+       monthly counts.
+
+    Args:
+        study_date (str): Study date, YYYYMMDD.
+
+    Returns:
+        Union[str, None]: YYYY/M, None if the date is missing or malformed.
+    '''
+    try:
+        date = datetime.strptime(str(study_date), "%Y%m%d")
+    except ValueError:
+        return None
+
+    return f"{date.year}/{date.month}"
+
+
 def fill_blanks(counts: List[Dict], min_date: str = None, max_date: str = None) -> List[Dict]:
     '''Takes a list of counts per month and fills in
        missing months with counts of 0 for plotting.
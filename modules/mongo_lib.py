@@ -1,35 +1,80 @@
 '''Library class that holds general Mongo database-related functionality.
 '''
 import os
+import time
 import logging
-from typing import List, Dict, Union
+import threading
+from datetime import datetime
+from typing import List, Dict, Set, Tuple, Union, Optional
 import pymongo
+import pymongo.cursor
+import pymongo.command_cursor
+import pymongo.change_stream
+from bson import ObjectId
+
+# Collection holding the completed units of collector runs
+CHECKPOINTS = "checkpoints"
+# Collection holding the catalogue version, bumped on catalogue writes
+CATALOGUE_VERSION = "catalogue_version"
+# Minimum seconds between version bumps of a long series of writes
+VERSION_INTERVAL = 10
+# Catalogue collections read by the UI, whose writes bump the version
+VERSIONED = ("modalities", "tags", "views", "bodyparts", "modality_blocklist")
 
 
 # pylint: disable=R0904
 class MongoLib:
     '''Class handling MongoDB connection and querying.
     '''
+    # Clients shared by the instances of each process, see share_client()
+    shared = False
+    _clients: Dict[int, pymongo.MongoClient] = {}
+    _clients_lock = threading.Lock()
+
     def __init__(self, log):
         self.client = None
         self.db = None
         self.db_name = ''
+        # Databases written since their catalogue version was last bumped
+        self.changed: Set[str] = set()
+        self.bumped = 0.0
 
         logging.getLogger(log)
         self.connect()
 
+    @classmethod
+    def share_client(cls) -> None:
+        '''Makes the instances of each process share one connection pool
+           kept open on disconnect(), e.g. in a long-running service. Forked
+           processes open their own client.
+        '''
+        cls.shared = True
+
     def connect(self) -> None:
         '''Connect to MongoDB database based on credentials
         available via env vars.
         '''
+        if self.shared:
+            with self._clients_lock:
+                if os.getpid() not in self._clients:
+                    self._clients[os.getpid()] = self._new_client()
+
+                self.client = self._clients[os.getpid()]
+
+            return
+
+        self.client = self._new_client()
+
+    def _new_client(self) -> pymongo.MongoClient:
         try:
-            self.client = pymongo.MongoClient(
+            client = pymongo.MongoClient(
                 os.environ.get("MONGOHOST"),
                 username=os.environ.get("MONGOUSER"),
                 password=os.environ.get("MONGOPASS"),
                 authSource=os.environ.get("MONGOAUTHDB")
             )
             logging.info("Successful connection to database.")
+            return client
         except (Exception, pymongo.errors.PyMongoError) as error:
             logging.error("Failed connection to database: %s.", error)
             raise error
@@ -63,19 +108,22 @@ class MongoLib:
                               self.db_name, collection, error)
             raise error
 
-    def create_index(self, collection: str, index: str,
+    def create_index(self, collection: str, index: Union[str, List[str]],
                      uniq: bool = False) -> None:
         '''Creates an index in a given collection.
 
         Args:
             collection (str): Collection name.
-            index (str): Index name.
+            index (Union[str, List[str]]): Index name, or list of field names
+                                           for a compound index.
             uniq (bool, optional): Whether the index is unique.
                                    Defaults to False.
         '''
+        fields = [index] if isinstance(index, str) else index
+
         try:
             self.db[collection].create_index(
-                [(index, pymongo.ASCENDING)],
+                [(field, pymongo.ASCENDING) for field in fields],
                 unique=uniq
             )
             logging.info("%s: Successfully created an index for %s in %s",
@@ -85,6 +133,30 @@ class MongoLib:
                               self.db_name, index, collection, error)
             raise error
 
+    def has_index(self, collection: str, index: Union[str, List[str]]) -> bool:
+        '''Checks whether a collection has an index led by given fields.
+
+        Args:
+            collection (str): Collection name.
+            index (Union[str, List[str]]): Field name, or list of field names
+                                           of a compound index.
+
+        Raises:
+            error: PyMongo error on index_information().
+
+        Returns:
+            bool: True if an index starts with the fields, in order.
+        '''
+        fields = [index] if isinstance(index, str) else index
+
+        try:
+            return any([key for key, _ in info["key"]][:len(fields)] == fields
+                       for info in self.db[collection].index_information().values())
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed listing indexes of %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
     def list_collections(self) -> List[str]:
         '''Lists collections in current database.
 
@@ -103,13 +175,15 @@ class MongoLib:
                               self.db_name, error)
             raise error
 
-    def sample(self, collection: str, number: int) -> List[Dict]:
+    def sample(self, collection: str, number: int, selection: Dict = None) -> List[Dict]:
         '''Finds and returns a given number of sample documents in a
            given collection.
 
         Args:
             collection (str): Collection name.
             number (int): Number of documents/samples.
+            selection (Dict, optional): Projection applied to the samples.
+                                        Defaults to None, whole documents.
 
         Raises:
             error: PyMongo error on aggregate.
@@ -117,10 +191,13 @@ class MongoLib:
         Returns:
             List[Dict]: List of Mongo documents.
         '''
-        query = [
+        query: List[Dict] = [
             {"$sample": {"size": number}}
         ]
 
+        if selection:
+            query.append({"$project": selection})
+
         try:
             samples = self.db[collection].aggregate(query)
             logging.info(("%s: Successfully extracted %s sample document(s) "
@@ -132,6 +209,29 @@ class MongoLib:
                               collection, error)
             raise error
 
+    def estimated_count(self, collection: str) -> int:
+        '''Returns the number of documents in a collection from its
+           metadata, without scanning it.
+
+        Args:
+            collection (str): Collection name.
+
+        Raises:
+            error: PyMongo error on estimated_document_count().
+
+        Returns:
+            int: Estimated number of documents.
+        '''
+        try:
+            count = self.db[collection].estimated_document_count()
+            logging.info("%s: Successfully estimated document count of %s",
+                         self.db_name, collection)
+            return count
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed estimating document count of %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
     def search(self, collection: str, condition: Dict = None, selection: Dict = None) -> Dict:
         '''Finds and returns all documents in a given collection.
 
@@ -164,6 +264,89 @@ class MongoLib:
                               "%s: %s"), self.db_name, collection, error)
             raise error
 
+    def search_sorted(self, collection: str, condition: Dict, selection: Dict,
+                      sort: str, batch_size: int = 10000) -> pymongo.cursor.Cursor:
+        '''Finds documents in a given collection in ascending order of a
+           field. The order is streamed from an index when one covers the
+           condition and sort, and sorted on disk by the server otherwise.
+
+        Args:
+            collection (str): Collection name.
+            condition (Dict): Search condition.
+            selection (Dict): Attribute selection.
+            sort (str): Field to sort on.
+            batch_size (int, optional): Cursor batch size. Defaults to 10000.
+
+        Raises:
+            error: PyMongo Error on find().
+
+        Returns:
+            Cursor: Cursor over the sorted documents, to be iterated by the
+                    caller.
+        '''
+        try:
+            docs = self.db[collection].find(
+                condition, selection, batch_size=batch_size,
+                allow_disk_use=True
+            ).sort(sort, pymongo.ASCENDING)
+            logging.info("%s: Successfully searched for %s in %s sorted by %s",
+                         self.db_name, condition, collection, sort)
+            return docs
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed sorted search in %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
+    def search_page(self, collection: str, condition: Dict, selection: Dict,
+                    sort: List, skip: int, limit: int) -> List[Dict]:
+        '''Returns one page of the documents matching a condition, e.g. for
+           a paginated table.
+
+        Args:
+            collection (str): Collection name.
+            condition (Dict): Search condition.
+            selection (Dict): Attribute selection.
+            sort (List): [(<FIELD>, <pymongo.ASCENDING|DESCENDING>)]
+            skip (int): Number of documents before the page.
+            limit (int): Page size.
+
+        Raises:
+            error: PyMongo Error on find().
+
+        Returns:
+            List[Dict]: Page documents.
+        '''
+        try:
+            docs = list(self.db[collection].find(condition, selection)
+                        .sort(sort).skip(skip).limit(limit))
+            logging.info("%s: Successfully searched page of %s in %s",
+                         self.db_name, condition, collection)
+            return docs
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed page search in %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
+    def count(self, collection: str, condition: Dict) -> int:
+        '''Returns the number of documents matching a condition.
+
+        Args:
+            collection (str): Collection name.
+            condition (Dict): Search condition.
+
+        Raises:
+            error: PyMongo Error on count_documents().
+
+        Returns:
+            int: Number of documents.
+        '''
+        try:
+            return self.db[collection].count_documents(condition)
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed counting %s in %s: %s",
+                              self.db_name, condition, collection, error)
+            raise error
+
     def count_images(self, collection: str):
         '''Counts the number of documents in a collection.
 
@@ -325,13 +508,16 @@ class MongoLib:
                                "%s: %s"), self.db_name, collection, error)
             raise error
 
-    def get_field_values(self, collection: str, field: str, count: bool = False) -> List:
+    def get_field_values(self, collection: str, field: str, count: bool = False,
+                         condition: Dict = None) -> List:
         '''Returns list of distinct values in given field.
 
         Args:
             collection (str): Collection name.
             field (str): Field name.
             count (bool): Frequency count. Default to False.
+            condition (Dict, optional): Condition of the documents considered.
+                                        Defaults to all documents.
 
         Raises:
             error: PyMongo error on distinct().
@@ -341,10 +527,10 @@ class MongoLib:
         '''
         try:
             if count:
-                query = [{"$sortByCount": f"${field}"}]
+                query = [{"$match": condition or {}}, {"$sortByCount": f"${field}"}]
                 values = self.db[collection].aggregate(query, allowDiskUse=True)
             else:
-                values = self.db[collection].distinct(field)
+                values = self.db[collection].distinct(field, condition)
 
             logging.info(("%s: Successfully extracted %s values from "
                           "collection %s"), self.db_name, field, collection)
@@ -367,6 +553,7 @@ class MongoLib:
         '''
         try:
             self.db[collection].insert_many(docs)
+            self._written(collection)
             logging.info("%s: Successful bulk-insert of %s documents into %s",
                          self.db_name, len(docs), collection)
         except (Exception, pymongo.errors.PyMongoError) as error:
@@ -374,6 +561,26 @@ class MongoLib:
                               self.db_name, collection, error)
             raise error
 
+    def delete_many(self, collection: str, condition: Dict) -> None:
+        '''Deletes all documents matching a condition.
+
+        Args:
+            collection (str): Collection name.
+            condition (Dict): Delete condition.
+
+        Raises:
+            error: PyMongo error on delete_many().
+        '''
+        try:
+            result = self.db[collection].delete_many(condition)
+            self._written(collection)
+            logging.info("%s: Successfully deleted %s documents from %s",
+                         self.db_name, result.deleted_count, collection)
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed deleting documents from %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
     def update_mod_tag_quality(self, modality: str, tag: Dict, collection: str = "modalities") -> None:
         '''Update a modality's tag. Subdocument update.
 
@@ -391,6 +598,7 @@ class MongoLib:
             update = {"$set": tag_set}
 
             self.db[collection].update_one(query, update)
+            self._written(collection)
             logging.debug("%s: Successful update of tag %s for modality %s.",
                           self.db_name, tag["tag"], modality)
         except (Exception, pymongo.errors.PyMongoError) as error:
@@ -417,6 +625,7 @@ class MongoLib:
                 update = {"$set": modality}
 
                 self.db[collection].update_one(query, update, upsert=True)
+                self._written(collection)
                 logging.debug("%s: Successful upsert of modality %s.",
                               self.db_name, mod_name)
             except (Exception, pymongo.errors.PyMongoError) as error:
@@ -442,6 +651,7 @@ class MongoLib:
                 update = {"$set": tag}
 
                 self.db[collection].update_one(query, update, upsert=True)
+                self._written(collection)
                 logging.debug("%s: Successful upsert of tag %s to %s.",
                               self.db_name, tag, collection)
             except (Exception, pymongo.errors.PyMongoError) as error:
@@ -449,6 +659,91 @@ class MongoLib:
                                   self.db_name, tag, collection)
                 raise error
 
+    def bulk_upsert(self, docs: List[Dict], collection: str, key: str) -> None:
+        '''Upserts a list of documents in a single unordered bulk write,
+           matching existing documents on the given key.
+
+        Args:
+            docs (List[Dict]): List of documents.
+            collection (str): Collection name.
+            key (str): Attribute identifying a document, e.g. tag or modality.
+
+        Raises:
+            error: PyMongo error on bulk_write().
+        '''
+        if not docs:
+            return
+
+        requests = [
+            pymongo.UpdateOne({key: doc[key]}, {"$set": doc}, upsert=True)
+            for doc in docs
+        ]
+
+        try:
+            result = self.db[collection].bulk_write(requests, ordered=False)
+            self._written(collection)
+            logging.info(("%s: Successful bulk upsert to %s: %s matched, "
+                          "%s upserted."), self.db_name, collection,
+                         result.matched_count, result.upserted_count)
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed bulk upsert to %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
+    def bulk_replace(self, docs: List[Dict], collection: str) -> None:
+        '''Replaces, or inserts, a list of documents by _id in a single
+           unordered bulk write.
+
+        Args:
+            docs (List[Dict]): List of documents with an _id.
+            collection (str): Collection name.
+
+        Raises:
+            error: PyMongo error on bulk_write().
+        '''
+        if not docs:
+            return
+
+        requests = [pymongo.ReplaceOne({"_id": doc["_id"]}, doc, upsert=True)
+                    for doc in docs]
+
+        try:
+            result = self.db[collection].bulk_write(requests, ordered=False)
+            self._written(collection)
+            logging.info(("%s: Successful bulk replace to %s: %s matched, "
+                          "%s upserted."), self.db_name, collection,
+                         result.matched_count, result.upserted_count)
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed bulk replace to %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
+    def bulk_update(self, collection: str, requests: List, ordered: bool = True) -> None:
+        '''Applies a list of write operations in a single bulk write.
+
+        Args:
+            collection (str): Collection name.
+            requests (List): List of pymongo write operations, e.g. UpdateOne.
+            ordered (bool, optional): Apply the operations in order and stop
+                                      on the first error. Defaults to True.
+
+        Raises:
+            error: PyMongo error on bulk_write().
+        '''
+        if not requests:
+            return
+
+        try:
+            result = self.db[collection].bulk_write(requests, ordered=ordered)
+            self._written(collection)
+            logging.info(("%s: Successful bulk update of %s: %s matched, "
+                          "%s upserted."), self.db_name, collection,
+                         result.matched_count, result.upserted_count)
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed bulk update of %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
     def upsert_obj(self, obj: Dict, collection: str, condition, update) -> None:
         '''Upsert tags to collection tags. If the tag exists, update, if it
            does not, insert.
@@ -463,6 +758,7 @@ class MongoLib:
 
         try:
             self.db[collection].update_one(condition, update, upsert=True)
+            self._written(collection)
             logging.debug("%s: Successful upsert to %s.",
                            self.db_name, collection)
         except (Exception, pymongo.errors.PyMongoError) as error:
@@ -506,6 +802,314 @@ class MongoLib:
                                "%s: %s"), self.db_name, tag, collection, error)
             raise error
 
+    def aggregate(self, collection: str, query: List[Dict],
+                  batch_size: int = 0) -> pymongo.command_cursor.CommandCursor:
+        '''Runs a given aggregation pipeline.
+
+        Args:
+            collection (str): Collection name.
+            query (List[Dict]): Aggregation pipeline.
+            batch_size (int, optional): Cursor batch size. Defaults to 0,
+                                        the server default.
+
+        Raises:
+            error: PyMongo Error on aggregate.
+
+        Returns:
+            CommandCursor: Cursor over the pipeline output, to be iterated
+                           by the caller.
+        '''
+        try:
+            if batch_size:
+                results = self.db[collection].aggregate(
+                    query, allowDiskUse=True, batchSize=batch_size
+                )
+            else:
+                results = self.db[collection].aggregate(query, allowDiskUse=True)
+
+            logging.info("%s: Successfully ran aggregation on %s",
+                         self.db_name, collection)
+            return results
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed running aggregation on %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
+    def get_last_id(self, collection: str) -> Optional[ObjectId]:
+        '''Returns the highest _id in a given collection.
+
+        Args:
+            collection (str): Collection name.
+
+        Raises:
+            error: PyMongo Error on find_one().
+
+        Returns:
+            Optional[ObjectId]: Highest _id, None if the collection is empty.
+        '''
+        try:
+            doc = self.db[collection].find_one({}, {"_id": 1},
+                                               sort=[("_id", pymongo.DESCENDING)])
+            logging.info("%s: Successfully extracted last _id from %s",
+                         self.db_name, collection)
+            return doc["_id"] if doc else None
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed extracting last _id from %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
+    def get_version(self) -> int:
+        '''Returns the version of the catalogue in the current database.
+
+        Raises:
+            error: PyMongo error on find_one().
+
+        Returns:
+            int: Version, 0 if the catalogue was never written.
+        '''
+        try:
+            doc = self.db[CATALOGUE_VERSION].find_one({"_id": "catalogue"})
+            return doc["version"] if doc else 0
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed reading catalogue version: %s",
+                              self.db_name, error)
+            raise error
+
+    def bump_version(self, db_name: str = None) -> None:
+        '''Increments the version of the catalogue in a database,
+           invalidating the pages cached by the UI.
+
+        Args:
+            db_name (str, optional): Database name. Defaults to the current
+                                     database.
+
+        Raises:
+            error: PyMongo error on update_one().
+        '''
+        db_name = db_name or self.db_name
+
+        try:
+            self.client[db_name][CATALOGUE_VERSION].update_one(
+                {"_id": "catalogue"},
+                {"$inc": {"version": 1},
+                 "$set": {"versionDate": datetime.today().strftime("%Y-%m-%d %H:%M:%S")}},
+                upsert=True
+            )
+            self.changed.discard(db_name)
+            self.bumped = time.monotonic()
+            logging.debug("%s: Bumped catalogue version", db_name)
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed bumping catalogue version: %s",
+                              db_name, error)
+            raise error
+
+    def flush_version(self) -> None:
+        '''Bumps the catalogue version of every database written since its
+           last bump. Long-running writers call it once a batch of writes
+           is complete.
+
+        Raises:
+            error: PyMongo error on update_one().
+        '''
+        for db_name in list(self.changed):
+            self.bump_version(db_name)
+
+    def _written(self, collection: str) -> None:
+        # Raw collections, sketches, rollups and run or watcher state are not
+        # shown by the UI, and would otherwise invalidate its cache constantly
+        if collection not in VERSIONED:
+            return
+
+        self.changed.add(self.db_name)
+
+        # Writes throttled since the last bump are flushed with this one
+        if time.monotonic() - self.bumped >= VERSION_INTERVAL:
+            self.flush_version()
+
+    def save_checkpoint(self, run_id: str, collector: str, unit: str) -> None:
+        '''Records a unit of work of a collector run as completed, e.g. a tag
+           or collection. Saving the same unit again only updates its date.
+
+        Args:
+            run_id (str): Run ID.
+            collector (str): Collector name, e.g. tag_quality.
+            unit (str): Unit of work.
+
+        Raises:
+            error: PyMongo error on update_one().
+        '''
+        try:
+            self.db[CHECKPOINTS].update_one(
+                {"_id": {"collector": collector, "run": run_id, "unit": unit}},
+                {"$set": {"completedDate": datetime.today().strftime("%Y-%m-%d %H:%M:%S")}},
+                upsert=True
+            )
+            logging.debug("%s: Saved checkpoint %s of %s run %s", self.db_name,
+                          unit, collector, run_id)
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed saving checkpoint %s of %s run %s: %s",
+                              self.db_name, unit, collector, run_id, error)
+            raise error
+
+    def load_checkpoints(self, run_id: str, collector: str) -> Set[str]:
+        '''Returns the completed units of work of a collector run.
+
+        Args:
+            run_id (str): Run ID.
+            collector (str): Collector name.
+
+        Raises:
+            error: PyMongo error on find().
+
+        Returns:
+            Set[str]: Completed units.
+        '''
+        try:
+            docs = self.db[CHECKPOINTS].find(
+                {"_id.collector": collector, "_id.run": run_id}, {"_id": 1}
+            )
+            units = {doc["_id"]["unit"] for doc in docs}
+            logging.info("%s: Found %s completed units of %s run %s", self.db_name,
+                         len(units), collector, run_id)
+            return units
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed loading checkpoints of %s run %s: %s",
+                              self.db_name, collector, run_id, error)
+            raise error
+
+    def finish_run(self, run_id: str, collector: str) -> None:
+        '''Marks a collector run as finished, once all its units completed.
+
+        Args:
+            run_id (str): Run ID.
+            collector (str): Collector name.
+
+        Raises:
+            error: PyMongo error on update_many().
+        '''
+        try:
+            self.db[CHECKPOINTS].update_many(
+                {"_id.collector": collector, "_id.run": run_id},
+                {"$set": {"finished": True}}
+            )
+            logging.debug("%s: Finished %s run %s", self.db_name, collector, run_id)
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed finishing %s run %s: %s",
+                              self.db_name, collector, run_id, error)
+            raise error
+
+    def last_run(self, collector: str) -> Optional[str]:
+        '''Returns the ID of the collector run that last completed a unit,
+           unless that run finished.
+
+        Args:
+            collector (str): Collector name.
+
+        Raises:
+            error: PyMongo error on find_one().
+
+        Returns:
+            Optional[str]: Run ID, None if the collector has no checkpoints
+                           or its last run finished.
+        '''
+        try:
+            doc = self.db[CHECKPOINTS].find_one(
+                {"_id.collector": collector}, sort=[("completedDate", pymongo.DESCENDING)]
+            )
+            return doc["_id"]["run"] if doc and not doc.get("finished", False) else None
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed finding last run of %s: %s",
+                              self.db_name, collector, error)
+            raise error
+
+    def start_run(self, collector: str, run_id: str = None,
+                  resume: bool = False) -> Tuple[str, Set[str]]:
+        '''Starts or resumes a collector run. A resumed run without an ID
+           continues the last run of the collector if it did not finish, and
+           starts a new run otherwise.
+
+        Args:
+            collector (str): Collector name.
+            run_id (str, optional): Run ID. Defaults to a new timestamp ID.
+            resume (bool, optional): Load the completed units of the run.
+                                     Defaults to False.
+
+        Returns:
+            Tuple[str, Set[str]]: (<RUN ID>, <COMPLETED UNITS>)
+        '''
+        if resume and run_id is None:
+            run_id = self.last_run(collector)
+
+        if run_id is None:
+            run_id = datetime.today().strftime("%Y%m%d%H%M%S")
+
+        completed = self.load_checkpoints(run_id, collector) if resume else set()
+        logging.info("Run %s of %s, %s units already completed. Resume with "
+                     "--resume --run-id %s", run_id, collector, len(completed), run_id)
+
+        return run_id, completed
+
+    def watch(self, pipeline: List[Dict], resume_after: Dict = None,
+              batch_size: int = 1000, max_await_time_ms: int = 1000,
+              full_document_before_change: str = None
+              ) -> pymongo.change_stream.DatabaseChangeStream:
+        '''Opens a change stream on the current database. Requires a replica
+           set or sharded cluster.
+
+        Args:
+            pipeline (List[Dict]): Pipeline filtering the change events.
+            resume_after (Dict, optional): Resume token of the last processed
+                                           event. Defaults to None, start now.
+            batch_size (int, optional): Cursor batch size. Defaults to 1000.
+            max_await_time_ms (int, optional): Maximum time the server waits
+                                               for new events before
+                                               try_next() returns None.
+                                               Defaults to 1000.
+            full_document_before_change (str, optional): Pre-image mode, e.g.
+                                                         "whenAvailable".
+                                                         Defaults to None.
+
+        Raises:
+            error: PyMongo Error on watch().
+
+        Returns:
+            DatabaseChangeStream: Change stream, to be iterated by the caller.
+        '''
+        try:
+            stream = self.db.watch(
+                pipeline,
+                resume_after=resume_after,
+                batch_size=batch_size,
+                max_await_time_ms=max_await_time_ms,
+                full_document_before_change=full_document_before_change
+            )
+            logging.info("%s: Successfully opened change stream", self.db_name)
+            return stream
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed opening change stream: %s",
+                              self.db_name, error)
+            raise error
+
+    def enable_pre_images(self, collection: str) -> None:
+        '''Records pre-images of changed documents in a given collection, so
+           that change streams can report the contents of deleted documents.
+
+        Args:
+            collection (str): Collection name.
+
+        Raises:
+            error: PyMongo Error on collMod.
+        '''
+        try:
+            self.db.command("collMod", collection,
+                            changeStreamPreAndPostImages={"enabled": True})
+            logging.info("%s: Successfully enabled pre-images for %s",
+                         self.db_name, collection)
+        except (Exception, pymongo.errors.PyMongoError) as error:
+            logging.exception("%s: Failed enabling pre-images for %s: %s",
+                              self.db_name, collection, error)
+            raise error
+
     def run_facet(self, collection: str, facet) -> List:
         '''Runs a given facet.
 
@@ -535,8 +1139,11 @@ class MongoLib:
             raise error
 
     def disconnect(self) -> None:
-        '''Disconnect from the database.
+        '''Disconnect from the database, bumping the catalogue version if
+           it changed since the last bump.
         '''
-        if self.client is not None:
+        self.flush_version()
+
+        if self.client is not None and not self.shared:
             self.client.close()
             logging.info("Successful disconnection from %s", self.db_name)
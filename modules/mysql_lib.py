@@ -2,13 +2,16 @@
 '''
 import os
 import logging
-from typing import List, Tuple
+from typing import List, Tuple, Iterator
 import mysql.connector as mysql
 
 
 class MySQLib:
     '''Class handling relational database connection and querying.
     '''
+    # Size of the connection pool of each process, see share_connections()
+    pool_size = 0
+
     def __init__(self, log):
         self.conn = None
         self.db = None
@@ -17,16 +20,41 @@ class MySQLib:
         self.connect()
         self.cur = self.conn.cursor()
 
+    @classmethod
+    def share_connections(cls, pool_size: int = 5) -> None:
+        '''Makes the instances of each process take their connections from
+           a pool, to which disconnect() returns them, e.g. in a long-running
+           service. Instances open their own connection when the pool is
+           exhausted.
+
+        Args:
+            pool_size (int, optional): Connections kept open per process.
+                                       Defaults to 5.
+        '''
+        cls.pool_size = pool_size
+
     def connect(self):
         '''Connect to relational database based on credentials available via
         env vars.
         '''
+        credentials = {
+            "user": os.environ.get("MYSQLUSER"),
+            "password": os.environ.get("MYSQLPASS"),
+            "host": os.environ.get("MYSQLHOST")
+        }
+
         try:
-            self.conn = mysql.connect(
-                user=os.environ.get("MYSQLUSER"),
-                password=os.environ.get("MYSQLPASS"),
-                host=os.environ.get("MYSQLHOST")
-            )
+            if self.pool_size:
+                try:
+                    # Pools are named per process, as forked processes cannot
+                    # share connections
+                    self.conn = mysql.connect(pool_name=f"metacat_{os.getpid()}",
+                                              pool_size=self.pool_size, **credentials)
+                except mysql.errors.PoolError:
+                    self.conn = mysql.connect(**credentials)
+            else:
+                self.conn = mysql.connect(**credentials)
+
             logging.info("Successful connection to database.")
         except mysql.Error as error:
             logging.exception("Failed connection to database: %s.", error)
@@ -73,6 +101,43 @@ class MySQLib:
                               self.db, query, error)
             raise error
 
+    def stream_query(self, query: str, batch_size: int = 10000) -> Iterator[Tuple]:
+        '''Executes a given query on an unbuffered cursor and yields its rows
+           as they are fetched, without holding the result set in memory.
+           The connection cannot run other queries until the rows are
+           exhausted or the generator is closed.
+
+        Args:
+            query (str): Query string.
+            batch_size (int, optional): Rows fetched at a time.
+                                        Defaults to 10000.
+
+        Raises:
+            error: Mysql error on query.
+
+        Yields:
+            Tuple: Result rows.
+        '''
+        cursor = self.conn.cursor(buffered=False)
+
+        try:
+            cursor.execute(query)
+            logging.info("%s: Streaming query %s.", self.db, query)
+
+            while True:
+                rows = cursor.fetchmany(batch_size)
+
+                if not rows:
+                    break
+
+                yield from rows
+        except mysql.Error as error:
+            logging.exception("%s: Failed streaming query %s: %s",
+                              self.db, query, error)
+            raise error
+        finally:
+            cursor.close()
+
     def list_tables(self) -> List[Tuple]:
         '''Returns a list of tables in the current database.
 
@@ -0,0 +1,333 @@
+'''Library that holds mergeable probabilistic sketches used to summarise
+   large raw collections in bounded memory.
+'''
+import math
+import hashlib
+from typing import Dict, List
+import numpy as np
+
+
+def hash64(value: str) -> int:
+    '''Returns a 64-bit hash of a given value.
+
+    Args:
+        value (str): Value to hash, e.g. a UID.
+
+    Returns:
+        int: Unsigned 64-bit hash.
+    '''
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+
+    return int.from_bytes(digest, "big")
+
+
+class HyperLogLog:
+    '''HyperLogLog distinct value counter. Sketches of the same precision
+       can be merged, and merging is idempotent, so a value added to several
+       sketches is only counted once in their union.
+    '''
+    MIN_PRECISION = 4
+    MAX_PRECISION = 18
+
+    def __init__(self, error: float = 0.01, precision: int = None):
+        if precision is None:
+            precision = math.ceil(2 * math.log2(1.04 / error))
+
+        self.precision = min(max(precision, self.MIN_PRECISION), self.MAX_PRECISION)
+        self.size = 1 << self.precision
+        self.registers = np.zeros(self.size, dtype=np.uint8)
+
+    @property
+    def error(self) -> float:
+        '''Standard relative error of the estimate.
+        '''
+        return 1.04 / math.sqrt(self.size)
+
+    def add(self, value: str) -> None:
+        '''Adds a value to the sketch.
+
+        Args:
+            value (str): Value, e.g. a UID.
+        '''
+        hashed = hash64(value)
+        index = hashed >> (64 - self.precision)
+        remainder = hashed & ((1 << (64 - self.precision)) - 1)
+        rank = (64 - self.precision) - remainder.bit_length() + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog") -> None:
+        '''Merges another sketch into this one.
+
+        Args:
+            other (HyperLogLog): Sketch of the same precision.
+
+        Raises:
+            ValueError: If the precisions differ.
+        '''
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge HyperLogLog of precision "
+                             f"{other.precision} into {self.precision}")
+
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    def count(self) -> int:
+        '''Returns the estimated number of distinct values added.
+
+        Returns:
+            int: Estimate.
+        '''
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size ** 2 / np.sum(np.ldexp(1.0, -self.registers.astype(np.int32)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+
+        # Linear counting for small cardinalities
+        if estimate <= 2.5 * self.size and zeros:
+            estimate = self.size * math.log(self.size / zeros)
+
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        '''Serialises the sketch.
+
+        Returns:
+            bytes: Precision byte followed by the registers.
+        '''
+        return bytes([self.precision]) + self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "HyperLogLog":
+        '''Deserialises a sketch.
+
+        Args:
+            data (bytes): Output of to_bytes().
+
+        Returns:
+            HyperLogLog: Sketch.
+        '''
+        sketch = cls(precision=data[0])
+        sketch.registers = np.frombuffer(data[1:], dtype=np.uint8).copy()
+
+        return sketch
+
+
+class BloomFilter:
+    '''Bloom filter set membership sketch. Never reports a value that was
+       added as absent, and reports an absent value as present with
+       probability error. Filters of the same size can be merged.
+    '''
+    def __init__(self, capacity: int, error: float = 0.001, size: int = None,
+                 hashes: int = None):
+        capacity = max(capacity, 1)
+
+        if size is None:
+            size = math.ceil(-capacity * math.log(error) / math.log(2) ** 2)
+
+        if hashes is None:
+            hashes = max(round(size / capacity * math.log(2)), 1)
+
+        self.size = ((size + 7) // 8) * 8
+        self.hashes = hashes
+        self.bits = np.zeros(self.size // 8, dtype=np.uint8)
+
+    def _positions(self, value: str) -> List[int]:
+        digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:], "big") | 1
+
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, value: str) -> None:
+        '''Adds a value to the filter.
+
+        Args:
+            value (str): Value, e.g. a UID.
+        '''
+        for position in self._positions(value):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(value))
+
+    @property
+    def error(self) -> float:
+        '''False positive rate measured from the share of bits set, which
+           exceeds the configured rate if more values than the capacity were
+           added.
+        '''
+        return float((np.unpackbits(self.bits).sum() / self.size) ** self.hashes)
+
+    def merge(self, other: "BloomFilter") -> None:
+        '''Merges another filter into this one.
+
+        Args:
+            other (BloomFilter): Filter of the same size and hashes.
+
+        Raises:
+            ValueError: If the sizes or hashes differ.
+        '''
+        if other.size != self.size or other.hashes != self.hashes:
+            raise ValueError(f"Cannot merge BloomFilter of size {other.size} "
+                             f"into {self.size}")
+
+        np.bitwise_or(self.bits, other.bits, out=self.bits)
+
+    def to_bytes(self) -> bytes:
+        '''Serialises the filter.
+
+        Returns:
+            bytes: Number of hashes byte followed by the bits.
+        '''
+        return bytes([self.hashes]) + self.bits.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "BloomFilter":
+        '''Deserialises a filter.
+
+        Args:
+            data (bytes): Output of to_bytes().
+
+        Returns:
+            BloomFilter: Filter.
+        '''
+        bloom = cls(1, size=(len(data) - 1) * 8, hashes=data[0])
+        bloom.bits = np.frombuffer(data[1:], dtype=np.uint8).copy()
+
+        return bloom
+
+
+class QuantileSketch:
+    '''Relative-error quantile sketch over positive values, bucketing values
+       on a logarithmic scale (DDSketch). Any quantile is returned within
+       a relative accuracy of the true value. Merging adds bucket counts,
+       so merged sketches are identical to a sketch of all values.
+    '''
+    def __init__(self, accuracy: float = 0.01):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.zeros = 0
+        self.buckets: Dict[int, int] = {}
+
+    @property
+    def count(self) -> int:
+        '''Number of values added.
+        '''
+        return self.zeros + sum(self.buckets.values())
+
+    def add_many(self, values: np.ndarray) -> None:
+        '''Adds values to the sketch. Values of 0 or less are counted as 0.
+
+        Args:
+            values (np.ndarray): Values, e.g. images per series.
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        positive = values[values > 0]
+        self.zeros += int(len(values) - len(positive))
+
+        if len(positive):
+            indexes, counts = np.unique(np.ceil(np.log(positive) / self.log_gamma),
+                                        return_counts=True)
+
+            for index, count in zip(indexes.astype(np.int64).tolist(), counts.tolist()):
+                self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def _value(self, index: int) -> float:
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def merge(self, other: "QuantileSketch") -> None:
+        '''Merges another sketch into this one.
+
+        Args:
+            other (QuantileSketch): Sketch of the same accuracy.
+
+        Raises:
+            ValueError: If the accuracies differ.
+        '''
+        if other.accuracy != self.accuracy:
+            raise ValueError(f"Cannot merge QuantileSketch of accuracy "
+                             f"{other.accuracy} into {self.accuracy}")
+
+        self.zeros += other.zeros
+
+        for index, count in other.buckets.items():
+            self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def quantile(self, quantile: float) -> float:
+        '''Returns the estimated value at a given quantile.
+
+        Args:
+            quantile (float): Quantile between 0 and 1, e.g. 0.99.
+
+        Returns:
+            float: Estimate, 0 if the sketch is empty.
+        '''
+        rank = quantile * (self.count - 1)
+
+        if rank < self.zeros:
+            return 0.0
+
+        seen = self.zeros
+
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+
+            if seen > rank:
+                return self._value(index)
+
+        return 0.0
+
+    def histogram(self) -> List[Dict]:
+        '''Returns a compact histogram of the values with power of two bins.
+           Buckets are binned by their upper bound, so values within the
+           relative accuracy below a bin edge may fall in the next bin.
+
+        Returns:
+            List[Dict]: [{"low": <BOUND>, "high": <BOUND>, "count": <COUNT>}]
+        '''
+        bins: Dict[int, int] = {}
+
+        for index, count in self.buckets.items():
+            power = max(math.floor(index * self.log_gamma / math.log(2) + 1e-9), 0)
+            bins[power] = bins.get(power, 0) + count
+
+        histogram = [{"low": 0, "high": 1, "count": self.zeros}] if self.zeros else []
+        histogram += [{"low": 2 ** power, "high": 2 ** (power + 1), "count": bins[power]}
+                      for power in sorted(bins)]
+
+        return histogram
+
+    def to_bytes(self) -> bytes:
+        '''Serialises the sketch.
+
+        Returns:
+            bytes: Accuracy and zero count, followed by bucket indexes and
+                   counts.
+        '''
+        indexes = np.array(sorted(self.buckets), dtype=np.int32)
+        counts = np.array([self.buckets[index] for index in indexes.tolist()], dtype=np.int64)
+
+        return (np.array([self.accuracy], dtype=np.float64).tobytes() +
+                np.array([self.zeros, len(indexes)], dtype=np.int64).tobytes() +
+                indexes.tobytes() + counts.tobytes())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "QuantileSketch":
+        '''Deserialises a sketch.
+
+        Args:
+            data (bytes): Output of to_bytes().
+
+        Returns:
+            QuantileSketch: Sketch.
+        '''
+        sketch = cls(float(np.frombuffer(data[:8], dtype=np.float64)[0]))
+        zeros, size = np.frombuffer(data[8:24], dtype=np.int64).tolist()
+        indexes = np.frombuffer(data[24:24 + 4 * size], dtype=np.int32)
+        counts = np.frombuffer(data[24 + 4 * size:], dtype=np.int64)
+        sketch.zeros = zeros
+        sketch.buckets = dict(zip(indexes.tolist(), counts.tolist()))
+
+        return sketch
@@ -0,0 +1,201 @@
+'''Library that holds the compiled DICOM standard lookup artifact.
+   The artifact is a read-only SQLite database mapping tag keywords to
+   their standard metadata, so that it can be memory-mapped and queried
+   without parsing the Innolitics files or querying MongoDB.
+'''
+import os
+import json
+import hashlib
+import logging
+import sqlite3
+from typing import List, Dict, Iterable, Optional
+
+# Catalogue attribute names of the compact lookup columns
+LOOKUP_ATTRS = ("dicomID", "valueRepresentation", "description",
+                "informationEntity", "basicProfile")
+
+SCHEMA = '''
+CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID;
+CREATE TABLE tags (
+    keyword TEXT PRIMARY KEY,
+    dicomID TEXT,
+    valueRepresentation TEXT,
+    description TEXT,
+    informationEntity TEXT,
+    basicProfile TEXT,
+    meta TEXT
+) WITHOUT ROWID;
+CREATE TABLE modalities (name TEXT PRIMARY KEY, meta TEXT) WITHOUT ROWID;
+'''
+
+
+def fingerprint(filepaths: List[str], chunk_size: int = 1 << 20) -> str:
+    '''Returns a content fingerprint of the given files, independent of
+       their location and order.
+
+    Args:
+        filepaths (List[str]): Paths of the files to fingerprint.
+        chunk_size (int, optional): Bytes read at a time. Defaults to 1MB.
+
+    Returns:
+        str: SHA-256 hex digest over the names and contents of the files.
+    '''
+    digest = hashlib.sha256()
+
+    for filepath in sorted(filepaths, key=os.path.basename):
+        file_digest = hashlib.sha256()
+
+        with open(filepath, "rb") as input_file:
+            for chunk in iter(lambda: input_file.read(chunk_size), b""):
+                file_digest.update(chunk)
+
+        digest.update(os.path.basename(filepath).encode("utf-8"))
+        digest.update(file_digest.digest())
+
+    return digest.hexdigest()
+
+
+def compile_lookup(path: str, file_fingerprint: str, tags: Iterable[Dict],
+                   modalities: Iterable[Dict]) -> None:
+    '''Writes the lookup artifact. The file is built next to the target and
+       atomically moved in place, so readers never see a partial artifact.
+
+    Args:
+        path (str): Artifact path.
+        file_fingerprint (str): Fingerprint of the standard files.
+        tags (Iterable[Dict]): Tag metadata in catalogue format, with the
+                               keyword as tag.
+        modalities (Iterable[Dict]): Modality metadata with the standard
+                                     name as name.
+    '''
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    conn = sqlite3.connect(tmp_path)
+
+    try:
+        conn.executescript(SCHEMA)
+        conn.execute("INSERT INTO info VALUES ('fingerprint', ?)",
+                     (file_fingerprint,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((tag["tag"], *(tag.get(attr, None) for attr in LOOKUP_ATTRS),
+              json.dumps(tag)) for tag in tags if tag["tag"])
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO modalities VALUES (?, ?)",
+            ((mod["name"], json.dumps(mod)) for mod in modalities)
+        )
+        conn.commit()
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+    os.replace(tmp_path, path)
+    logging.info("Compiled DICOM standard lookup %s.", path)
+
+
+class StandardLookup:
+    '''Class giving read-only access to the DICOM standard lookup artifact.
+    '''
+    def __init__(self, path: str, mmap_size: int = 1 << 28):
+        self.path = path
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro&immutable=1",
+                                    uri=True, check_same_thread=False)
+        self.conn.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+
+    @property
+    def fingerprint(self) -> Optional[str]:
+        '''Fingerprint of the standard files the artifact was compiled from.
+        '''
+        row = self.conn.execute(
+            "SELECT value FROM info WHERE key = 'fingerprint'"
+        ).fetchone()
+
+        return row[0] if row else None
+
+    def get(self, keyword: str) -> Optional[Dict]:
+        '''Returns the compact standard metadata of a tag.
+
+        Args:
+            keyword (str): Tag keyword, e.g. StudyDate.
+
+        Returns:
+            Optional[Dict]: {"dicomID": <TAG_ID>,
+                             "valueRepresentation": <VR>,
+                             "description": <DESCRIPTION>,
+                             "informationEntity": <LEVEL>,
+                             "basicProfile": <PROFILE>}
+        '''
+        row = self.conn.execute(
+            f"SELECT {', '.join(LOOKUP_ATTRS)} FROM tags WHERE keyword = ?",
+            (keyword,)
+        ).fetchone()
+
+        return dict(zip(LOOKUP_ATTRS, row)) if row else None
+
+    def tag_meta(self, keyword: str) -> Optional[Dict]:
+        '''Returns the full catalogue-formatted standard metadata of a tag.
+
+        Args:
+            keyword (str): Tag keyword.
+
+        Returns:
+            Optional[Dict]: Tag metadata.
+        '''
+        row = self.conn.execute(
+            "SELECT meta FROM tags WHERE keyword = ?", (keyword,)
+        ).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def modality_meta(self, name: str) -> Optional[Dict]:
+        '''Returns the standard metadata of a modality.
+
+        Args:
+            name (str): Standard name, e.g. "CT Image".
+
+        Returns:
+            Optional[Dict]: Modality metadata.
+        '''
+        row = self.conn.execute(
+            "SELECT meta FROM modalities WHERE name = ?", (name,)
+        ).fetchone()
+
+        return json.loads(row[0]) if row else None
+
+    def close(self) -> None:
+        '''Closes the artifact.
+        '''
+        self.conn.close()
+
+
+def open_lookup(path: str) -> Optional[StandardLookup]:
+    '''Opens the lookup artifact if it exists and is readable.
+
+    Args:
+        path (str): Artifact path.
+
+    Returns:
+        Optional[StandardLookup]: Lookup, or None if unavailable.
+    '''
+    if not os.path.isfile(path):
+        return None
+
+    lookup = None
+
+    try:
+        lookup = StandardLookup(path)
+
+        if lookup.fingerprint is not None:
+            return lookup
+    except sqlite3.Error as error:
+        logging.warning("Failed opening DICOM standard lookup %s: %s",
+                        path, error)
+
+    if lookup is not None:
+        lookup.close()
+
+    return None
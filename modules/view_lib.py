@@ -0,0 +1,405 @@
+'''Library that builds the template-ready view documents of the catalogue
+   UI. Collectors refresh the views at the end of their runs, so that each
+   UI page reads a single precomputed document.
+   View documents, in the views collection:
+   {"_id": "index", "modalities": [<MODALITY SUMMARY>], "viewDate": <TIMESTAMP>}
+   {"_id": "modality/<MODALITY>", "modality": <MODALITY FIELDS>,
+    "tagStats": <TAG STATS>, "counts": <CHART SERIES>, "viewDate": <TIMESTAMP>}
+   {"_id": "report", "tagStats": <TAG STATS>, "monthlyCounts": <CHART SERIES>,
+    "viewDate": <TIMESTAMP>}
+'''
+import logging
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional
+from modules.mongo_lib import MongoLib
+
+VIEWS = "views"
+# Modality fields of the index page cards
+INDEX_FIELDS = ["modality", "promotionStatus", "promotionStatusDate",
+                "totalNoImagesRaw", "totalNoImagesStaging", "totalNoImagesLive"]
+# Modality fields of the modality page, cards and count charts
+MODALITY_FIELDS = ["modality", "description", "descriptionSource",
+                   "countsDateRaw", "countsDateStaging", "countsDateLive",
+                   "totalNoImagesRaw", "totalNoSeriesRaw", "totalNoStudiesRaw",
+                   "totalNoImagesStaging", "totalNoSeriesStaging", "totalNoStudiesStaging",
+                   "totalNoImagesLive", "totalNoSeriesLive", "totalNoStudiesLive",
+                   "avgNoImagesPerSeriesRaw", "minNoImagesPerSeriesRaw",
+                   "maxNoImagesPerSeriesRaw", "stdDevImagesPerSeriesRaw",
+                   "avgNoSeriesPerStudyRaw", "minNoSeriesPerStudyRaw",
+                   "maxNoSeriesPerStudyRaw", "stdDevSeriesPerStudyRaw",
+                   "countsPerMonthRaw", "countsPerMonthStaging", "countsPerMonthLive"]
+# Tag fields of the tag statistics charts
+TAG_STATS_FIELDS = ["public", "promotionStatus", "basicProfile"]
+
+
+def modalities_pipeline() -> List[Dict]:
+    '''Returns the aggregation pipeline of the index page, joining the
+       modalities with the modality blocklist.
+
+    Returns:
+        List[Dict]: Aggregation pipeline on the modalities collection.
+    '''
+    return [
+        {"$project": {"_id": 0, **{field: 1 for field in INDEX_FIELDS}}},
+        {"$lookup": {"from": "modality_blocklist", "localField": "modality",
+                     "foreignField": "modality", "as": "blocklist"}},
+        {"$set": {"blockReason": {"$arrayElemAt": ["$blocklist.blockReason", 0]}}},
+        {"$project": {"blocklist": 0}}
+    ]
+
+
+def modality_pipeline(modality: str) -> List[Dict]:
+    '''Returns the aggregation pipeline of a modality page, returning the
+       fields of the page and the tags of the modality joined with their
+       metadata.
+
+    Args:
+        modality (str): Modality name.
+
+    Returns:
+        List[Dict]: Aggregation pipeline on the modalities collection, with
+                    a single output document {"modality": [<MODALITY>],
+                    "tags": [<TAG>]}.
+    '''
+    return [
+        {"$match": {"modality": modality}},
+        {"$facet": {
+            "modality": [
+                {"$project": {"_id": 0, **{field: 1 for field in MODALITY_FIELDS}}}
+            ],
+            "tags": [
+                {"$unwind": "$tags"},
+                {"$project": {"_id": 0, "tag": "$tags.tag",
+                              "completenessRaw": "$tags.completenessRaw"}},
+                {"$lookup": {"from": "tags", "localField": "tag",
+                             "foreignField": "tag", "as": "meta"}},
+                {"$unwind": "$meta"},
+                {"$match": {"meta.modalities": modality}},
+                {"$project": {"tag": 1, "completenessRaw": 1,
+                              **{field: f"$meta.{field}" for field in TAG_STATS_FIELDS}}}
+            ]
+        }}
+    ]
+
+
+def format_counts(modality: Dict) -> Dict:
+    '''Formats a modality's count metadata for plotting.
+
+    Args:
+        modality (Dict): Modality metadata.
+
+    Returns:
+        Dict: Dictionary of lists for plotting.
+    '''
+    plot_format = {
+        "dates": [],
+        "images_raw": [],
+        "series_raw": [],
+        "study_raw": [],
+        "images_staging": [],
+        "series_staging": [],
+        "study_staging": [],
+        "images_live": [],
+        "series_live": [],
+        "study_live": [],
+    }
+
+    for attr in modality:
+        if "countsPerMonth" in attr:
+            modality[attr] = fix_month_counts(modality[attr])
+
+            if "Raw" in attr:
+                for count in modality[attr]:
+                    plot_format["dates"].append(count["date"])
+                    plot_format["images_raw"].append(count["imageCount"])
+                    plot_format["series_raw"].append(count["seriesCount"])
+                    plot_format["study_raw"].append(count["studyCount"])
+
+            if "Staging" in attr:
+                for count in modality[attr]:
+                    plot_format["images_staging"].append(count["imageCount"])
+                    plot_format["series_staging"].append(count["seriesCount"])
+                    plot_format["study_staging"].append(count["studyCount"])
+
+            if "Live" in attr:
+                for count in modality[attr]:
+                    plot_format["images_live"].append(count["imageCount"])
+                    plot_format["series_live"].append(count["seriesCount"])
+                    plot_format["study_live"].append(count["studyCount"])
+        elif any(term in attr for term in ["No", "std"]):
+            modality[attr] = "{:,}".format(float(modality[attr]))
+
+    return plot_format
+
+
+def tag_stats(tags: List[Dict], modality: bool=False) -> Dict:
+    stats = {
+        "public": {
+          "Public": 0,
+          "Private": 0
+        },
+        "confidentiality": {},
+        "promotion": {}
+    }
+
+    if modality:
+        stats["sparseness"] = {
+            "Unknown": 0,
+            "<50%": 0,
+            "50-60%": 0,
+            "60-70%": 0,
+            "70-80%": 0,
+            "80-90%": 0,
+            ">=90%": 0
+        }
+
+    for tag in tags:
+        # Group tags by public status, tags not yet checked are unknown
+        public = tag.get("public", "Unknown")
+
+        if public == "true":
+            stats["public"]["Public"] += 1
+        elif public == "Unknown":
+            stats["public"]["Unknown"] = stats["public"].get("Unknown", 0) + 1
+        else:
+            stats["public"]["Private"] += 1
+
+        # Group tags by promotion status
+        promotion = tag.get("promotionStatus", "Unknown")
+
+        if promotion in stats["promotion"].keys():
+            stats["promotion"][promotion] += 1
+        else:
+            stats["promotion"][promotion] = 0 
+
+        # Group tags by confidentiality profile
+        if tag.get("basicProfile", None):
+            if tag["basicProfile"] in stats["confidentiality"].keys():
+                stats["confidentiality"][tag["basicProfile"]] += 1
+            else:
+                stats["confidentiality"][tag["basicProfile"]] = 0
+        else:
+            if "Unknown" in stats["confidentiality"].keys():
+                stats["confidentiality"]["Unknown"] += 1
+            else:
+                stats["confidentiality"]["Unknown"] = 0
+
+        if modality:
+            # Group tags by completeness
+            if tag.get("completenessRaw", None):
+                frequency = float(tag["completenessRaw"])
+
+                if frequency > 0 and frequency < 50:
+                    stats["sparseness"]["<50%"] += 1
+                elif frequency >= 50 and frequency < 60:
+                    stats["sparseness"]["50-60%"] += 1
+                elif frequency >= 60 and frequency < 70:
+                    stats["sparseness"]["60-70%"] += 1
+                elif frequency >= 70 and frequency < 80:
+                    stats["sparseness"]["70-80%"] += 1
+                elif frequency >= 80 and frequency < 90:
+                    stats["sparseness"]["80-90%"] += 1
+                elif frequency >= 90:
+                    stats["sparseness"][">=90%"] += 1
+            else:
+                stats["sparseness"]["Unknown"] += 1
+
+    return stats
+
+
+def monthly_counts(modalities: List[Dict], stage: str) -> Dict:
+    '''Formats the monthly counts of the available modalities at a stage
+       for plotting, over the months of their raw counts.
+
+    Args:
+        modalities (List[Dict]): Modality metadata with monthly counts.
+        stage (str): Raw, Staging or Live.
+
+    Returns:
+        Dict: Dictionary of dates and counts per modality for plotting.
+    '''
+    min_date = datetime.now()
+    max_date = datetime.strptime("2010/01", "%Y/%m")
+    available = [mod for mod in modalities
+                 if mod.get("promotionStatus", "Unknown") == "available"]
+
+    for mod in modalities:
+        for attr in mod:
+            if "countsPerMonth" in attr:
+                mod[attr] = fix_month_counts(mod[attr])
+
+    for mod in available:
+        months = [datetime.strptime(count["date"], "%Y/%m") for count in mod.get("countsPerMonthRaw", [])]
+
+        if months:
+            min_date = min(min_date, *months)
+            max_date = max(max_date, *months)
+
+    # Months from the first month up to, but excluding, the last month
+    months = []
+    month = min_date
+
+    while month < max_date:
+        months.append(month)
+        month = month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1, day=1)
+
+    dates = {
+        "dates": [month.strftime("%Y/%m") for month in months],
+        "image_counts": {},
+        "series_counts": {},
+        "study_counts": {}
+    }
+
+    for mod in available:
+        by_month = {datetime.strptime(count["date"], "%Y/%m"): count
+                    for count in mod.get(f"countsPerMonth{stage}", [])}
+        counts = [by_month[month] for month in months if month in by_month]
+
+        dates["image_counts"][mod["modality"]] = [count["imageCount"] for count in counts]
+        dates["series_counts"][mod["modality"]] = [count["seriesCount"] for count in counts]
+        dates["study_counts"][mod["modality"]] = [count["studyCount"] for count in counts]
+
+    return dates
+
+
+def fix_month_counts(counts: List[Dict]) -> List[Dict]:
+    '''Monthly count cleaning required for live datasets.
+       Edge cases such as dates below the expected minimum date and
+       dates such as "1/1" can cause the counts at different stages to be
+       misaligned.
+
+    Args:
+        counts (List): List of counts by monthly date.
+
+    Returns:
+        List[Dict]: Cleaned counts in the same format.
+    '''
+    fixed_counts = []
+    mincount = datetime.strptime("2010/01", "%Y/%m")
+
+    for count in counts:
+        if count.get("date", None):
+            fcount = datetime.strptime(count["date"], "%Y/%m")
+
+            if count["date"] != "1/1" and fcount >= mincount:
+                fixed_counts.append(count)
+
+    return fixed_counts
+
+
+def index_view(mongo: MongoLib) -> Dict:
+    '''Builds the view of the index page.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+
+    Returns:
+        Dict: View document.
+    '''
+    return {"_id": "index",
+            "modalities": list(mongo.aggregate("modalities", modalities_pipeline()))}
+
+
+def modality_view(mongo: MongoLib, modality: str) -> Optional[Dict]:
+    '''Builds the view of a modality page.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+        modality (str): Modality name.
+
+    Returns:
+        Optional[Dict]: View document, None if the modality does not exist.
+    '''
+    page = list(mongo.aggregate("modalities", modality_pipeline(modality)))
+
+    if not page or not page[0]["modality"]:
+        return None
+
+    mod_meta = page[0]["modality"][0]
+    counts = format_counts(mod_meta)
+
+    # Monthly counts are only shown through the chart series
+    for stage in ("Raw", "Staging", "Live"):
+        mod_meta.pop(f"countsPerMonth{stage}", None)
+
+    return {"_id": f"modality/{modality}", "modality": mod_meta,
+            "tagStats": tag_stats(page[0]["tags"], modality=True), "counts": counts}
+
+
+def report_view(mongo: MongoLib) -> Dict:
+    '''Builds the view of the report page.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+
+    Returns:
+        Dict: View document.
+    '''
+    modalities = list(mongo.search("modalities", {}, {
+        "modality": 1, "countsPerMonthRaw": 1, "countsPerMonthStaging": 1,
+        "countsPerMonthLive": 1, "promotionStatus": 1
+    }))
+    tags = list(mongo.search("tags", {}, {
+        "_id": 0, **{field: 1 for field in TAG_STATS_FIELDS}
+    }))
+
+    return {"_id": "report", "tagStats": tag_stats(tags),
+            "monthlyCounts": monthly_counts(modalities, "Live")}
+
+
+def load_view(mongo: MongoLib, view_id: str) -> Optional[Dict]:
+    '''Returns a view document.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+        view_id (str): View identifier, e.g. index or modality/CT.
+
+    Returns:
+        Optional[Dict]: View document, None if it was never built.
+    '''
+    for view in mongo.search(VIEWS, {"_id": view_id}):
+        return view
+
+    return None
+
+
+def refresh_views(mongo: MongoLib, modalities: Iterable[str] = None) -> bool:
+    '''Rebuilds the view documents of the catalogue UI. Views of modalities
+       no longer in the catalogue are removed on a full refresh. Collectors
+       refresh the views once their data is written, so failures are logged
+       rather than raised.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+        modalities (Iterable[str], optional): Modalities whose views to
+                                              rebuild, with the index and
+                                              report. Defaults to all.
+
+    Returns:
+        bool: Whether the views were refreshed.
+    '''
+    full = modalities is None
+
+    try:
+        if full:
+            modalities = mongo.get_field_values("modalities", "modality")
+
+        views = [index_view(mongo), report_view(mongo)]
+        views += [view for view in (modality_view(mongo, mod) for mod in modalities if mod)
+                  if view is not None]
+        date = datetime.today().strftime("%Y-%m-%d %H:%M:%S")
+
+        for view in views:
+            view["viewDate"] = date
+
+        mongo.bulk_replace(views, VIEWS)
+
+        if full:
+            mongo.delete_many(VIEWS, {"_id": {"$nin": [view["_id"] for view in views]}})
+    except Exception as error:
+        logging.exception("Failed refreshing catalogue views: %s", error)
+        return False
+
+    logging.info("Refreshed %s catalogue views.", len(views))
+
+    return True
@@ -3,22 +3,42 @@
 . /home/metacat/test/config.env
 cd /home/metacat/metadata_collection
 
+# Check the streaming and sketch helpers, without any database
+python3 ../test/library_checks.py &&
 # Create base metadata for new modalities and tags
 python3 populate_catalogue.py -d dicom -i -l logs/ &&
 # Create blocklists
 python3 create_blocklists.py -m ../docs/modality_blocklist.json -t ../docs/tag_blocklist.json -b "Unknown" -l logs/
 # Set tag public status (public/private)
 python3 public_status.py -l logs/ &&
-# Perform raw counts
+# Perform raw counts with each counting method, ending with the exact facet counts
+python3 mongo_counts.py -d dicom -o modality --method stream -l logs/ &&
+python3 mongo_counts.py -d dicom -o modality --method rollup -l logs/ &&
+python3 mongo_counts.py -d dicom -o modality --method hll -l logs/ &&
 python3 mongo_counts.py -d dicom -o modality -l logs/ &&
+# Build the count cube, and query a rollup of it
+python3 count_cube.py -d dicom -o modality -l logs/ &&
+python3 count_cube.py -d dicom -o modality -r -g year -b Manufacturer -f logs/count_cube_rollup.json -l logs/ &&
+# Detect duplicate and orphan UIDs, with small runs to merge several of them
+python3 uid_integrity.py -d dicom -r 1000 -f logs/uid_integrity_samples.csv -l logs/
+# Ended here, as backgrounding the watcher would background the whole chain
+COUNTS=$?
+# Follow raw changes, and check that an insert and a delete reach the counts
+python3 catalogue_watcher.py -d dicom -o modality -i 1 --enable-pre-images -l logs/ &
+WATCHER=$!
+sleep 5
+python3 ../test/watcher_smoke.py -d dicom -m CT -l logs/
+SMOKE=$?
+kill -TERM $WATCHER && wait $WATCHER
+[ $COUNTS -eq 0 ] && [ $SMOKE -eq 0 ] &&
 # Set promotion status for blocked modalities and tags with default to unavailable for all
 python3 promotion_status.py -d analytics -s blocked -l logs/ &&
-# Perform staging counts
-python3 mysql_counts.py -d data_load2 -s Staging -l logs/ &&
+# Perform staging and live counts
+python3 mysql_counts.py -d data_load2 smi -s Staging Live -l logs/ &&
+# Reconcile raw and staging series
+python3 reconcile.py -d dicom -o modality -r data_load2 -s Staging --create-indexes -f logs/reconcile_staging.csv -l logs/ &&
 # Set promotion status to processing if in the staging database
 python3 promotion_status.py -d data_load2 -s processing -l logs/ &&
-# Perform live counts
-python3 mysql_counts.py -d smi -s Live -l logs/ &&
 # Set promotion status to available if in the live database
 python3 promotion_status.py -d smi -s available -l logs/ &&
 # Analyse tag quality for public tags in the raw database
@@ -0,0 +1,255 @@
+'''Deterministic checks of the streaming and sketch helpers that the
+   collectors rely on, run without any database:
+   python3 test/library_checks.py
+'''
+
+import os
+import sys
+import json
+import tempfile
+import unittest
+import numpy as np
+import modules.file_lib as flib
+from modules.sketch_lib import HyperLogLog, QuantileSketch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..",
+                                "metadata_collection"))
+
+import reconcile  # noqa: E402 pylint: disable=C0413
+import uid_integrity  # noqa: E402 pylint: disable=C0413
+
+
+def external_sort(rows, run_size=2):
+    '''Returns an ExternalSort of rows, spilling runs every run_size rows.
+    '''
+    sort = flib.ExternalSort(run_size=run_size)
+
+    for row in rows:
+        sort.add(row)
+
+    return sort
+
+
+class ExternalSortChecks(unittest.TestCase):
+    def test_merges_runs_in_order(self):
+        rows = [("b", "2"), ("a", "9"), ("c", "1"), ("a", "1"), ("b", "1")]
+        sort = external_sort(rows)
+
+        self.assertEqual(len(sort.runs), 2)
+        self.assertEqual(list(sort), sorted(rows))
+
+    def test_sorts_in_memory_below_run_size(self):
+        sort = external_sort([("b",), ("a",)], run_size=10)
+
+        self.assertEqual(sort.runs, [])
+        self.assertEqual(list(sort), [("a",), ("b",)])
+
+    def test_missing_sorts_before_values(self):
+        sort = external_sort([("1.2", "CT"), (None, "CT"), ("1.1", None)])
+
+        self.assertEqual(list(sort), [(flib.MISSING, "CT"), ("1.1", flib.MISSING),
+                                      ("1.2", "CT")])
+
+    def test_removes_runs_once_iterated(self):
+        sort = external_sort([("b",), ("a",), ("c",)])
+
+        self.assertTrue(os.listdir(sort.tmp_dir))
+        list(sort)
+        self.assertFalse(os.path.exists(sort.tmp_dir))
+
+    def test_removes_runs_on_exit(self):
+        with external_sort([("b",), ("a",), ("c",)]) as sort:
+            tmp_dir = sort.tmp_dir
+
+        self.assertFalse(os.path.exists(tmp_dir))
+
+
+class UIDIntegrityChecks(unittest.TestCase):
+    def test_find_duplicates(self):
+        by_sop = external_sort([
+            ("CT", "1.1", "image_CT"), ("CT", "1.1", "image_CT"),
+            ("CT", "1.1", "image_CT_old"), ("CT", "1.2", "image_CT"),
+            # Same UID in another modality is not a duplicate
+            ("MR", "1.2", "image_MR"),
+            # Images without SOPInstanceUID are not duplicates of each other
+            ("CT", None, "image_CT"), ("CT", None, "image_CT"),
+            ("CT", "", "image_CT"), ("CT", "", "image_CT"),
+        ])
+        counts, samples = {}, {}
+
+        uid_integrity.find_duplicates(by_sop, counts, samples, 10)
+
+        self.assertEqual(counts, {"CT": {"duplicateImagesRaw": 2, "duplicateUIDsRaw": 1,
+                                         "orphanImagesRaw": 0, "orphanSeriesRaw": 0}})
+        self.assertEqual(samples[("CT", "duplicate")].rows,
+                         [("1.1", 3, "image_CT;image_CT_old")])
+
+    def test_find_orphans(self):
+        by_series = external_sort([
+            ("1.2", "CT", "1"), ("1.2", "CT", "2"), ("1.3", "CT", "3"),
+            ("1.4", "MR", "4"), ("1.5", "MR", "5"), (None, "CT", "6"),
+            (None, "CT", "7"),
+        ])
+        # Repeated series documents must not hide the series that follow
+        series = external_sort([("1.2",), ("1.2",), ("1.4",), ("1.9",)])
+        counts, samples = {}, {}
+
+        uid_integrity.find_orphans(by_series, series, counts, samples, 10)
+
+        self.assertEqual(counts["CT"]["orphanImagesRaw"], 3)
+        self.assertEqual(counts["CT"]["orphanSeriesRaw"], 2)
+        self.assertEqual(counts["MR"]["orphanImagesRaw"], 1)
+        self.assertEqual(counts["MR"]["orphanSeriesRaw"], 1)
+        # Images without SeriesInstanceUID sort first and are sampled as ""
+        self.assertEqual(samples[("CT", "orphan")].rows, [("", 2, ""), ("1.3", 1, "")])
+        self.assertEqual(samples[("MR", "orphan")].rows, [("1.5", 1, "")])
+        # The series sort is drained, removing its runs
+        self.assertFalse(os.path.exists(by_series.tmp_dir))
+        self.assertFalse(os.path.exists(series.tmp_dir))
+
+    def test_reservoir_is_bounded_and_seeded(self):
+        first, second = uid_integrity.Reservoir(3), uid_integrity.Reservoir(3)
+
+        for number in range(100):
+            first.add((number,))
+            second.add((number,))
+
+        self.assertEqual(len(first.rows), 3)
+        self.assertEqual(first.seen, 100)
+        self.assertEqual(first.rows, second.rows)
+
+
+class ReconcileChecks(unittest.TestCase):
+    def test_distinct_sorted(self):
+        rows = [(None, None), ("1", "2020/1"), ("1", "2020/1"), ("2", None)]
+
+        self.assertEqual(list(reconcile.distinct_sorted(rows, "Raw")),
+                         [("1", "2020/1"), ("2", None)])
+
+        with self.assertRaises(ValueError):
+            list(reconcile.distinct_sorted([("2", None), ("1", None)], "Raw"))
+
+    def test_merge_join(self):
+        raw = [("1", "2020/1"), ("1", "2020/1"), ("2", "2020/2"), ("4", "2020/2")]
+        relational = [("2", "2020/2"), ("3", "2020/3"), ("4", None), ("5", "2021/1")]
+
+        self.assertEqual(list(reconcile.merge_join(raw, relational)), [
+            (("1", "2020/1"), None),
+            (("2", "2020/2"), ("2", "2020/2")),
+            (None, ("3", "2020/3")),
+            (("4", "2020/2"), ("4", None)),
+            (None, ("5", "2021/1")),
+        ])
+
+    def test_merge_join_one_sided(self):
+        self.assertEqual(list(reconcile.merge_join(iter(()), [("1", None)])),
+                         [(None, ("1", None))])
+        self.assertEqual(list(reconcile.merge_join([("1", None)], iter(()))),
+                         [(("1", None), None)])
+
+    def test_reconcile_counts_per_month(self):
+        joined = [(("1", "2020/10"), None), (("2", "2020/2"), ("2", "2020/2")),
+                  (None, ("3", "2020/2")), (("4", None), ("4", None))]
+        result = reconcile.reconcile(joined)
+
+        self.assertEqual((result["matchedSeries"], result["missingSeries"],
+                          result["extraSeries"]), (2, 1, 1))
+        self.assertEqual(result["perMonth"], [
+            {"date": "2020/2", "matchedSeries": 1, "missingSeries": 0, "extraSeries": 1},
+            {"date": "2020/10", "matchedSeries": 0, "missingSeries": 1, "extraSeries": 0},
+        ])
+
+
+class SketchChecks(unittest.TestCase):
+    def test_hyperloglog(self):
+        first, second = HyperLogLog(0.01), HyperLogLog(0.01)
+
+        for number in range(20000):
+            first.add(f"1.2.{number}")
+
+        for number in range(10000, 30000):
+            second.add(f"1.2.{number}")
+
+        self.assertLess(abs(first.count() - 20000), 20000 * 3 * first.error)
+
+        # Merging is idempotent, so overlapping values count once
+        count = first.count()
+        first.merge(first)
+        self.assertEqual(first.count(), count)
+        first.merge(second)
+        self.assertLess(abs(first.count() - 30000), 30000 * 3 * first.error)
+        self.assertEqual(HyperLogLog.from_bytes(first.to_bytes()).count(), first.count())
+
+        with self.assertRaises(ValueError):
+            first.merge(HyperLogLog(precision=first.precision - 1))
+
+    def test_quantile_sketch(self):
+        values = np.concatenate([np.zeros(100), np.arange(1, 1001)])
+        whole, first, second = QuantileSketch(0.01), QuantileSketch(0.01), QuantileSketch(0.01)
+        whole.add_many(values)
+        first.add_many(values[::2])
+        second.add_many(values[1::2])
+        first.merge(second)
+
+        # Merged sketches are identical to a sketch of all values
+        self.assertEqual((first.zeros, first.buckets), (whole.zeros, whole.buckets))
+        self.assertEqual(whole.count, 1100)
+        self.assertEqual(whole.quantile(0.05), 0.0)
+
+        for quantile in (0.5, 0.9, 0.99):
+            exact = float(np.quantile(values, quantile, method="lower"))
+            self.assertLessEqual(abs(whole.quantile(quantile) - exact), 0.01 * exact)
+
+        restored = QuantileSketch.from_bytes(whole.to_bytes())
+        self.assertEqual((restored.zeros, restored.buckets), (whole.zeros, whole.buckets))
+        self.assertEqual(sum(row["count"] for row in whole.histogram()), 1100)
+
+
+class IterJSONChecks(unittest.TestCase):
+    def write(self, text):
+        json_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False,
+                                                encoding="utf-8")
+
+        with json_file:
+            json_file.write(text)
+
+        self.addCleanup(os.remove, json_file.name)
+
+        return json_file.name
+
+    def test_elements_across_chunks(self):
+        data = [{"tag": "a,]", "values": [1, 2, {"b": "}"}]}, "x", None, True,
+                {"keyword": "é" * 10}]
+        path = self.write(json.dumps(data, indent=2))
+
+        for chunk_size in (1, 2, 3, 7, 1 << 16):
+            self.assertEqual(list(flib.iter_json(path, chunk_size)), data)
+
+    def test_numbers_across_chunks(self):
+        path = self.write("[1, 2.5, -30, 4e-2, 12345]")
+
+        for chunk_size in range(1, 12):
+            self.assertEqual(list(flib.iter_json(path, chunk_size)), [1, 2.5, -30, 4e-2, 12345])
+
+    def test_leading_whitespace_across_chunks(self):
+        self.assertEqual(list(flib.iter_json(self.write("\n    [1]"), 2)), [1])
+
+    def test_empty_array(self):
+        self.assertEqual(list(flib.iter_json(self.write("[ ]"), 1)), [])
+
+    def test_not_an_array(self):
+        with self.assertRaises(ValueError):
+            list(flib.iter_json(self.write('{"a": 1}')))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            list(flib.iter_json(self.write("[1 2, 3]"), 4))
+
+    def test_truncated(self):
+        for text in ('[{"a": 1}, {"b"', '[{"a": 1},', "["):
+            with self.assertRaises(ValueError):
+                list(flib.iter_json(self.write(text), 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
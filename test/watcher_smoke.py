@@ -0,0 +1,122 @@
+'''Checks that a running catalogue watcher applies raw changes to the
+   catalogue counts. Inserts a copy of an image document of a modality,
+   waits for its raw image count to grow by one, deletes the copy and waits
+   for the count to return. Requires a replica set, see docker-compose.yml.
+'''
+
+import sys
+import time
+import argparse
+import logging
+import modules.file_lib as flib
+from modules.mongo_lib import MongoLib
+
+
+def argparser() -> argparse.Namespace:
+    '''Terminal argument parser function.
+
+    Returns:
+        argparse.Namespace: Terminal arguments.
+    '''
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pacsdb", "-d",
+                        help="Name of PACS database. Default to dicom.",
+                        type=str, required=False, default="dicom")
+    parser.add_argument("--cataloguedb", "-c",
+                        help="Name of catalogue database. Default to analytics.",
+                        type=str, required=False, default="analytics")
+    parser.add_argument("--modality", "-m",
+                        help="Modality to change. Default to CT.",
+                        type=str, required=False, default="CT")
+    parser.add_argument("--timeout", "-t",
+                        help=("Seconds to wait for each change to be applied. "
+                              "Default to 60."), type=float, required=False,
+                        default=60.0)
+    parser.add_argument("--log", "-l",
+                        help=("Log directory path. Default to current"
+                              " directory."),
+                        type=str, required=False, default=".")
+
+    return parser.parse_args()
+
+
+def raw_images(mongo: MongoLib, modality: str) -> int:
+    '''Returns the raw image count of a modality in the catalogue.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+        modality (str): Modality name.
+
+    Returns:
+        int: Raw image count, 0 if not counted yet.
+    '''
+    for mod in mongo.search("modalities", {"modality": modality}, {"totalNoImagesRaw": 1}):
+        return int(mod.get("totalNoImagesRaw", 0) or 0)
+
+    return 0
+
+
+def wait_for_count(mongo: MongoLib, modality: str, expected: int, timeout: float) -> bool:
+    '''Waits for the raw image count of a modality to reach a value.
+
+    Args:
+        mongo (MongoLib): MongoLib instance using the catalogue database.
+        modality (str): Modality name.
+        expected (int): Expected raw image count.
+        timeout (float): Seconds to wait.
+
+    Returns:
+        bool: Whether the count was reached.
+    '''
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if raw_images(mongo, modality) == expected:
+            return True
+
+        time.sleep(1)
+
+    return False
+
+
+def main(args: argparse.Namespace) -> None:
+    '''Main function inserting and deleting a raw document.
+
+    Args:
+        args (argparse.Namespace): Carries terminal arguments from argparse().
+    '''
+    log = flib.setup_logging(args.log, "watcher_smoke", "debug")
+    logging.getLogger(log)
+
+    collection = f"image_{args.modality}"
+    pacs = MongoLib(log)
+    pacs.switch_db(args.pacsdb)
+    catalogue = MongoLib(log)
+    catalogue.switch_db(args.cataloguedb)
+
+    before = raw_images(catalogue, args.modality)
+    doc = pacs.db[collection].find_one({}, {"_id": 0})
+
+    if doc is None:
+        sys.exit(f"No document to copy in {collection}.")
+
+    doc_id = pacs.db[collection].insert_one(doc).inserted_id
+    inserted = wait_for_count(catalogue, args.modality, before + 1, args.timeout)
+
+    pacs.db[collection].delete_one({"_id": doc_id})
+    deleted = wait_for_count(catalogue, args.modality, before, args.timeout)
+
+    pacs.disconnect()
+    catalogue.disconnect()
+
+    if not (inserted and deleted):
+        logging.error("Watcher did not apply the %s of a %s document.",
+                      "insert" if not inserted else "delete", args.modality)
+        sys.exit(1)
+
+    logging.info("Watcher applied the insert and delete of a %s document.", args.modality)
+
+
+if __name__ == '__main__':
+    commands = argparser()
+    main(commands)